@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+
+"""
+bench_copydif.py
+
+Benchmarks for copydif.py. Builds synthetic source and target trees (many
+tiny files, a few huge files, a target that is mostly unchanged, and one
+that is mostly changed), times copy_differing_files() and main() end to
+end, counts calls to os module functions, and compares the results with
+a baseline file.
+
+Times depend on the machine, so the baseline should be saved (with
+--save-baseline) on the machine where the comparison is made.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+import copydif
+
+app_version = "2026.10.1"
+
+app_title = f"bench_copydif.py (v{app_version})"
+
+DEFAULT_BASELINE = Path(__file__).with_name("bench_copydif_baseline.json")
+
+MIB = 1024 * 1024
+
+#  Functions in the os module whose calls are counted. Calls made through
+#  other modules (such as the builtin open) are not seen, and pathlib uses
+#  some of these only on newer versions of Python, so counts are compared
+#  only with a baseline from the same version.
+COUNTED_CALLS = (
+    "copy_file_range",
+    "fstat",
+    "link",
+    "lstat",
+    "mkdir",
+    "open",
+    "read",
+    "rename",
+    "replace",
+    "scandir",
+    "sendfile",
+    "stat",
+    "unlink",
+    "utime",
+    "write",
+)
+
+SUPPORT_SETS = ("supports_dir_fd", "supports_fd", "supports_follow_symlinks")
+
+
+class Scenario(NamedTuple):
+    name: str
+    make_source: Callable[[Path, float], None]
+    make_target: Callable[[Path, Path], None]
+
+
+class BenchOptions(NamedTuple):
+    scenarios: list[str]
+    scale: float
+    repeat: int
+    jobs: int
+    baseline: Path
+    save_baseline: bool
+    tolerance: float
+    work_dir: str | None
+
+
+def write_files(root: Path, n_files: int, size: int, n_dirs: int = 1, seed: int = 0):
+    """
+    Writes n_files files of the given size, spread over n_dirs
+    sub-directories, with contents from a seeded random generator.
+    """
+    rng = random.Random(seed)  # noqa: S311 (reproducible data, not secrets)
+    for i in range(n_files):
+        dir_path = root / f"d{i % n_dirs:03d}" if n_dirs > 1 else root
+        dir_path.mkdir(parents=True, exist_ok=True)
+        data = rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+        (dir_path / f"f{i:06d}.dat").write_bytes(data)
+
+
+def tiny_source(source: Path, scale: float):
+    write_files(source, max(1, int(2000 * scale)), 64, n_dirs=20)
+
+
+def huge_source(source: Path, scale: float):
+    write_files(source, 4, max(1, int(16 * MIB * scale)), seed=1)
+
+
+def empty_target(source: Path, target: Path):
+    target.mkdir()
+
+
+def synced_target(source: Path, target: Path, percent_changed: int):
+    """
+    Makes the target a copy of the source, with the given percentage of its
+    files given a different modification time, so they will be copied.
+    """
+    shutil.copytree(source, target)
+    files = sorted(p for p in target.rglob("*") if p.is_file())
+    step = 100 / percent_changed
+    for i in range(int(len(files) * percent_changed / 100)):
+        p = files[int(i * step)]
+        t = p.stat().st_mtime - 3600
+        os.utime(p, (t, t))
+
+
+SCENARIOS = [
+    Scenario("tiny_files", tiny_source, empty_target),
+    Scenario("huge_files", huge_source, empty_target),
+    Scenario(
+        "mostly_unchanged",
+        tiny_source,
+        lambda source, target: synced_target(source, target, 2),
+    ),
+    Scenario(
+        "mostly_changed",
+        tiny_source,
+        lambda source, target: synced_target(source, target, 90),
+    ),
+]
+
+
+@contextlib.contextmanager
+def count_os_calls():
+    """
+    Context manager that replaces the functions in COUNTED_CALLS with
+    wrappers that count calls, and yields the Counter. A wrapper is added to
+    the same os.supports_* sets as the function, so code that checks those
+    sets (such as shutil.copystat) still uses it.
+    """
+    counts = Counter()
+    replaced = {}
+    for name in COUNTED_CALLS:
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+
+        def wrapper(*args, _name=name, _func=func, **kwargs):
+            counts[_name] += 1
+            return _func(*args, **kwargs)
+
+        for set_name in SUPPORT_SETS:
+            support = getattr(os, set_name)
+            if func in support:
+                support.add(wrapper)
+        replaced[name] = (func, wrapper)
+        setattr(os, name, wrapper)
+    try:
+        yield counts
+    finally:
+        for name, (func, wrapper) in replaced.items():
+            setattr(os, name, func)
+            for set_name in SUPPORT_SETS:
+                getattr(os, set_name).discard(wrapper)
+
+
+def run_function(source: Path, target: Path, jobs: int) -> copydif.DifCopier:
+    copier = copydif.DifCopier(copydif.AppOptions(jobs=jobs))
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            copydif.copy_differing_files(str(source), str(target), True, copier)
+        finally:
+            copier.close()
+    return copier
+
+
+def run_main(source: Path, target: Path, jobs: int, stats_file: Path) -> dict:
+    args = [
+        str(source),
+        str(target),
+        "--recursive",
+        f"--jobs={jobs}",
+        f"--stats-json={stats_file}",
+    ]
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = copydif.main(args)
+    if result:
+        raise RuntimeError(f"copydif.main() returned {result}")
+    return json.loads(stats_file.read_text())
+
+
+def best_time(func, reset, repeat: int) -> tuple[float, object]:
+    """
+    Calls reset() then func() (timed) repeat times. Returns the shortest
+    time and the last result of func().
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        reset()
+        t0 = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - t0
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def bench_scenario(scenario: Scenario, work: Path, opts: BenchOptions) -> dict:
+    """
+    Builds the scenario's trees in the work directory and returns its
+    results.
+    """
+    source = work / "source"
+    target = work / "target"
+    stats_file = work / "stats.json"
+    scenario.make_source(source, opts.scale)
+
+    def reset():
+        if target.exists():
+            shutil.rmtree(target)
+        scenario.make_target(source, target)
+
+    func_seconds, copier = best_time(
+        lambda: run_function(source, target, opts.jobs), reset, opts.repeat
+    )
+    main_seconds, _ = best_time(
+        lambda: run_main(source, target, opts.jobs, stats_file), reset, opts.repeat
+    )
+
+    #  Calls are counted in a separate run, so the wrappers do not slow
+    #  down the timed runs.
+    reset()
+    with count_os_calls() as counts:
+        run_function(source, target, opts.jobs)
+
+    shutil.rmtree(source)
+    shutil.rmtree(target)
+
+    return {
+        "function_seconds": round(func_seconds, 6),
+        "main_seconds": round(main_seconds, 6),
+        "files_checked": copier.files_checked,
+        "files_copied": copier.files_copied,
+        "bytes_copied": copier.bytes_copied,
+        "throughput_mib_s": round(copier.bytes_copied / MIB / func_seconds, 3),
+        "os_calls": dict(sorted(counts.items())),
+    }
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Returns a list of regressions: times, or total os calls, more than
+    tolerance (a fraction) above the baseline. Calls are not compared if
+    the baseline is from a different version of Python.
+    """
+    same_python = baseline.get("python") == results["python"]
+    regressions = []
+    for name, cur in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base is None or base.get("scale") != cur["scale"]:
+            continue
+        values = [
+            (key, cur[key], base[key]) for key in ("function_seconds", "main_seconds")
+        ]
+        if same_python:
+            values.append(
+                (
+                    "os_calls",
+                    sum(cur["os_calls"].values()),
+                    sum(base["os_calls"].values()),
+                )
+            )
+        regressions.extend(
+            f"{name}: {key} {value:g} is more than {tolerance:.0%} above the "
+            f"baseline ({base_value:g})"
+            for key, value, base_value in values
+            if value > base_value * (1 + tolerance)
+        )
+    return regressions
+
+
+def print_results(results: dict, baseline: dict):
+    base_scenarios = baseline.get("scenarios", {})
+    print(
+        f"{'Scenario':<18} {'function s':>11} {'main s':>9} {'copied':>7} "
+        f"{'MiB/s':>9} {'os calls':>9}  (baseline function s)"
+    )
+    for name, r in results["scenarios"].items():
+        base = base_scenarios.get(name, {})
+        print(
+            f"{name:<18} {r['function_seconds']:>11.4f} {r['main_seconds']:>9.4f} "
+            f"{r['files_copied']:>7} {r['throughput_mib_s']:>9.1f} "
+            f"{sum(r['os_calls'].values()):>9}  "
+            f"({base.get('function_seconds', '-')})"
+        )
+
+
+def get_opts(arglist=None) -> BenchOptions:
+    names = [s.name for s in SCENARIOS]
+    ap = argparse.ArgumentParser(
+        description="Benchmark copydif.py using synthetic source and target "
+        "trees, and compare the results with a baseline."
+    )
+
+    ap.add_argument(
+        "scenarios",
+        nargs="*",
+        metavar="scenario",
+        help=f"Scenarios to run ({', '.join(names)}). By default, all are run.",
+    )
+
+    ap.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiply the number of tiny files, and the size of the huge "
+        "files, by this factor. Results are compared only with a baseline "
+        "for the same scale. Default is 1.",
+    )
+
+    ap.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of timed runs of each kind. The best time is used. Default is 3.",
+    )
+
+    ap.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of copydif copy jobs. Default is 1.",
+    )
+
+    ap.add_argument(
+        "--baseline",
+        type=str,
+        default=str(DEFAULT_BASELINE),
+        help="Name of the baseline (JSON) file. Default is "
+        f"'{DEFAULT_BASELINE.name}' in the same directory as this script.",
+    )
+
+    ap.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save the results as the baseline, instead of comparing them.",
+    )
+
+    ap.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.5,
+        help="Report a regression when a result is more than this fraction "
+        "above the baseline. Default is 0.5 (50%%).",
+    )
+
+    ap.add_argument(
+        "--work-dir",
+        type=str,
+        help="Directory in which to build the trees. By default, a temporary "
+        "directory is used.",
+    )
+
+    args = ap.parse_args(arglist)
+
+    for name in args.scenarios:
+        if name not in names:
+            ap.error(f"unknown scenario '{name}' (choose from {', '.join(names)})")
+
+    if args.repeat < 1 or args.jobs < 1 or args.scale <= 0:
+        ap.error("--repeat and --jobs must be at least 1, and --scale above 0")
+
+    return BenchOptions(
+        scenarios=args.scenarios or names,
+        scale=args.scale,
+        repeat=args.repeat,
+        jobs=args.jobs,
+        baseline=Path(args.baseline),
+        save_baseline=args.save_baseline,
+        tolerance=args.tolerance,
+        work_dir=args.work_dir,
+    )
+
+
+def main(arglist=None) -> int:
+    print(f"\n{app_title}\n")
+
+    opts = get_opts(arglist)
+
+    results = {
+        "copydif_version": copydif.app_version,
+        "python": platform.python_version(),
+        "scenarios": {},
+    }
+    with tempfile.TemporaryDirectory(dir=opts.work_dir) as tmp:
+        for scenario in SCENARIOS:
+            if scenario.name not in opts.scenarios:
+                continue
+            print(f"Running {scenario.name}...")
+            work = Path(tmp) / scenario.name
+            work.mkdir()
+            r = bench_scenario(scenario, work, opts)
+            results["scenarios"][scenario.name] = {"scale": opts.scale, **r}
+
+    baseline = {}
+    if opts.baseline.exists():
+        baseline = json.loads(opts.baseline.read_text())
+
+    print()
+    print_results(results, baseline)
+
+    if opts.save_baseline:
+        opts.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"\nSaved baseline: {opts.baseline}")
+        return 0
+
+    if not baseline:
+        print(f"\nNo baseline to compare ('{opts.baseline}' not found).")
+        return 0
+
+    regressions = compare_results(results, baseline, opts.tolerance)
+    if regressions:
+        print("\nREGRESSIONS:")
+        for text in regressions:
+            print(f"  {text}")
+        return 1
+
+    print(f"\nNo regressions (tolerance {opts.tolerance:.0%}).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
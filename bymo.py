@@ -1,14 +1,746 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
 import argparse
+import math
+import os
+import re
 import shutil
-from datetime import datetime
+import sqlite3
+import struct
+import time
+from bisect import bisect_right
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from fnmatch import translate
+from itertools import islice
 from pathlib import Path
+from typing import NamedTuple
 
-app_version = "2024.07.1"
+app_version = "2026.10.5"
 
 app_title = f"bymo.py (v{app_version})"
 
+DATE_SOURCES = ("mtime", "exif", "auto")
+
+#  Only this much of the start of a JPEG or PNG file is read for the date.
+HEADER_BYTES = 64 * 1024
+
+#  Number of files to assign to buckets (and to look up in the date cache,
+#  and parse) at once.
+BATCH_SIZE = 256
+
+#  Batches with fewer files to parse than this are parsed in this process.
+PARSE_POOL_MIN = 16
+
+#  Buckets are precomputed for a batch only when the range of its dates
+#  adds no more than this many buckets for each file in it (or
+#  MIN_PRECOMPUTE in all). Otherwise, names are computed for each file.
+BUCKETS_PER_FILE = 4
+MIN_PRECOMPUTE = 64
+
+JPEG_EXTS = (".jpg", ".jpeg", ".jpe")
+PNG_EXTS = (".png",)
+MP4_EXTS = (".mp4", ".m4v", ".mov", ".3gp")
+MEDIA_EXTS = JPEG_EXTS + PNG_EXTS + MP4_EXTS
+
+#  EXIF tags (in the TIFF structure) used for the capture date.
+EXIF_IFD_TAG = 0x8769
+EXIF_DATE_TAGS = (0x9003, 0x9004)  # DateTimeOriginal, DateTimeDigitized
+TIFF_DATE_TAG = 0x0132  # DateTime
+TIFF_ASCII = 2
+
+MP4_EPOCH = datetime(1904, 1, 1, tzinfo=timezone.utc)
+
+#  Capture dates before this, or more than this many seconds after the
+#  current time, are not plausible (such as from a camera clock that was
+#  never set) and are ignored.
+MIN_CAPTURE_DATE = datetime(1900, 1, 1, tzinfo=timezone.utc).timestamp()
+MAX_CAPTURE_AHEAD = 2 * 86400
+
+#  Limit on the number of boxes read while looking for the MP4 'mvhd' box.
+MP4_MAX_BOXES = 64
+
+
+class AppOptions(NamedTuple):
+    do_move: bool = False
+    keep_spaces: bool = False
+    filespecs: list[str] | None = None
+    bucket: str = "month"
+    nested: bool = False
+    what_if: bool = False
+    jobs: int = 4
+    recursive: bool = False
+    date_source: str = "mtime"
+    date_cache: str | None = None
+
+
+class Move(NamedTuple):
+    src: str
+    dst: Path
+    dst_dir: str
+
+
+def add_months(start: datetime, months: int) -> datetime:
+    n = start.month - 1 + months
+    return datetime(start.year + n // 12, n % 12 + 1, 1)
+
+
+def year_start(dt: datetime) -> datetime:
+    return datetime(dt.year, 1, 1)
+
+
+def quarter_start(dt: datetime) -> datetime:
+    return datetime(dt.year, (dt.month - 1) // 3 * 3 + 1, 1)
+
+
+def month_start(dt: datetime) -> datetime:
+    return datetime(dt.year, dt.month, 1)
+
+
+def week_start(dt: datetime) -> datetime:
+    return day_start(dt) - timedelta(days=dt.weekday())
+
+
+def day_start(dt: datetime) -> datetime:
+    return datetime(dt.year, dt.month, dt.day)
+
+
+class Granularity(NamedTuple):
+    """
+    A kind of bucket. start returns the start of the bucket that a (local)
+    date and time is in, and step returns the start of the next bucket.
+    parts returns the parts of the name of the bucket starting at a date,
+    which are joined with '_', or used as nested sub-directories.
+    patterns are regular expressions that match the parts. seconds is the
+    shortest length of a bucket, used to estimate how many buckets a range
+    of dates has.
+    """
+
+    start: Callable[[datetime], datetime]
+    step: Callable[[datetime], datetime]
+    parts: Callable[[datetime], tuple]
+    patterns: tuple
+    seconds: int
+
+
+GRANULARITIES = {
+    "year": Granularity(
+        year_start,
+        lambda d: datetime(d.year + 1, 1, 1),
+        lambda d: (f"{d.year:04d}",),
+        (r"\d{4}",),
+        365 * 86400,
+    ),
+    "quarter": Granularity(
+        quarter_start,
+        lambda d: add_months(d, 3),
+        lambda d: (f"{d.year:04d}", f"Q{(d.month - 1) // 3 + 1}"),
+        (r"\d{4}", "Q[1-4]"),
+        90 * 86400,
+    ),
+    "month": Granularity(
+        month_start,
+        lambda d: add_months(d, 1),
+        lambda d: (f"{d.year:04d}", f"{d.month:02d}"),
+        (r"\d{4}", r"\d{2}"),
+        28 * 86400,
+    ),
+    "week": Granularity(
+        week_start,
+        lambda d: d + timedelta(days=7),
+        lambda d: (f"{d.isocalendar()[0]:04d}", f"W{d.isocalendar()[1]:02d}"),
+        (r"\d{4}", r"W\d{2}"),
+        7 * 86400 - 3600,
+    ),
+    "day": Granularity(
+        day_start,
+        lambda d: d + timedelta(days=1),
+        lambda d: (f"{d.year:04d}", f"{d.month:02d}", f"{d.day:02d}"),
+        (r"\d{4}", r"\d{2}", r"\d{2}"),
+        86400 - 3600,
+    ),
+}
+
+
+class Buckets:
+    """
+    Maps a file date (timestamp) to the name of the sub-directory for it,
+    such as '2022_02' for the month, or '2022/02' when nested. The start
+    timestamps of the buckets are computed (in local time) for the range of
+    dates seen so far, so naming a file is a bisect over them rather than
+    building a datetime for each file. The range is extended when a date
+    outside of it is seen; prepare can be used to cover the dates in a
+    batch of files at once. A date far outside of the range (such as a
+    bad date in a file) is named on its own instead of extending the
+    range to it.
+    """
+
+    def __init__(self, granularity: str = "month", nested: bool = False):
+        self.kind = GRANULARITIES[granularity]
+        self.nested = nested
+        self.sep = os.sep if nested else "_"
+        #  Nested sub-directories are recognized by the first part.
+        patterns = self.kind.patterns[:1] if nested else self.kind.patterns
+        self.dir_match = re.compile("_".join(patterns)).fullmatch
+        self.starts = []
+        self.names = []
+        self.end = None
+
+    def in_range(self, timestamp: float) -> bool:
+        return bool(self.starts) and self.starts[0] <= timestamp < self.end
+
+    def prepare(self, low: float, high: float, n_files: int = 1):
+        """
+        Computes the buckets for the range of timestamps from low to high
+        (the dates of n_files files), along with the range already covered.
+        Does nothing if that would add too many buckets for the number of
+        files, or if the range cannot be represented as dates.
+        """
+        covered = 0
+        if self.starts:
+            if self.starts[0] <= low and high < self.end:
+                return
+            covered = self.end - self.starts[0]
+            low = min(low, self.starts[0])
+            high = max(high, self.starts[-1])
+        added = (high - low - covered) / self.kind.seconds
+        if added > max(MIN_PRECOMPUTE, n_files * BUCKETS_PER_FILE):
+            return
+        try:
+            start = self.kind.start(datetime.fromtimestamp(low))
+            ts = start.timestamp()
+        except (ValueError, OverflowError, OSError):
+            return
+        starts = []
+        names = []
+        while ts <= high:
+            starts.append(ts)
+            names.append(self.sep.join(self.kind.parts(start)))
+            try:
+                start = self.kind.step(start)
+                ts = start.timestamp()
+            except (ValueError, OverflowError, OSError):
+                #  The last bucket (such as year 9999) has no end.
+                ts = math.inf
+        self.starts = starts
+        self.names = names
+        self.end = ts
+
+    def name(self, timestamp: float) -> str | None:
+        """
+        Returns the name of the bucket for the timestamp, or None if it
+        cannot be represented as a date.
+        """
+        if not self.in_range(timestamp):
+            self.prepare(timestamp, timestamp)
+            if not self.in_range(timestamp):
+                return self.name_of(timestamp)
+        return self.names[bisect_right(self.starts, timestamp) - 1]
+
+    def name_of(self, timestamp: float) -> str | None:
+        """
+        Returns the name of the bucket for the timestamp, computed on its
+        own, or None if it cannot be represented as a date.
+        """
+        try:
+            start = self.kind.start(datetime.fromtimestamp(timestamp))
+        except (ValueError, OverflowError, OSError):
+            return None
+        return self.sep.join(self.kind.parts(start))
+
+    def is_bucket(self, name: str) -> bool:
+        """
+        Returns True if the name looks like one of the sub-directories that
+        files are moved to, so those can be skipped when walking a
+        directory tree.
+        """
+        return self.dir_match(name) is not None
+
+
+def batches(items, size: int):
+    """
+    Yields lists of up to size items.
+    """
+    it = iter(items)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def spec_matcher(filespecs: list[str]):
+    """
+    Returns a function that checks whether a file name matches any of the
+    (wildcard) file specifications, or None if there are none.
+    """
+    if not filespecs:
+        return None
+    flags = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+    return re.compile("|".join(translate(spec) for spec in filespecs), flags).match
+
+
+def plausible_date(timestamp: float | None) -> float | None:
+    """
+    Returns the timestamp if it is a plausible capture date, otherwise None.
+    """
+    if timestamp is None:
+        return None
+    if not MIN_CAPTURE_DATE <= timestamp <= time.time() + MAX_CAPTURE_AHEAD:
+        return None
+    return timestamp
+
+
+def parse_date_text(text: str) -> float | None:
+    """
+    Returns the timestamp for a date and time in the EXIF format
+    ('YYYY:MM:DD HH:MM:SS', local time), ISO 8601, or RFC 1123 (as used
+    for the PNG 'Creation Time' keyword), or None if it cannot be parsed
+    or is not a plausible capture date.
+    """
+    text = text.strip().rstrip("\x00")
+    parsers = (
+        lambda t: datetime.strptime(t[:19], "%Y:%m:%d %H:%M:%S"),
+        datetime.fromisoformat,
+        parsedate_to_datetime,
+    )
+    for parse in parsers:
+        try:
+            return plausible_date(parse(text).timestamp())
+        except (TypeError, ValueError, IndexError, OverflowError, OSError):  # noqa: PERF203
+            pass
+    return None
+
+
+def tiff_capture_time(data: bytes) -> float | None:
+    """
+    Returns the capture date from EXIF data (a TIFF structure), using
+    DateTimeOriginal or DateTimeDigitized, then DateTime.
+    """
+    if data[:2] == b"II":
+        order = "<"
+    elif data[:2] == b"MM":
+        order = ">"
+    else:
+        return None
+
+    def read_ifd(offset: int) -> dict:
+        tags = {}
+        (count,) = struct.unpack_from(order + "H", data, offset)
+        for i in range(count):
+            tag, kind, n, value = struct.unpack_from(
+                order + "HHI4s", data, offset + 2 + 12 * i
+            )
+            tags[tag] = (kind, n, value)
+        return tags
+
+    def read_text(entry) -> str | None:
+        kind, n, value = entry
+        if kind != TIFF_ASCII:
+            return None
+        if n <= len(value):
+            raw = value[:n]
+        else:
+            (offset,) = struct.unpack(order + "I", value)
+            raw = data[offset : offset + n]
+        return raw.decode("ascii", "replace")
+
+    try:
+        (ifd0,) = struct.unpack_from(order + "I", data, 4)
+        tags = read_ifd(ifd0)
+        found = []
+        if EXIF_IFD_TAG in tags:
+            (offset,) = struct.unpack(order + "I", tags[EXIF_IFD_TAG][2])
+            exif_tags = read_ifd(offset)
+            found = [exif_tags[t] for t in EXIF_DATE_TAGS if t in exif_tags]
+        if TIFF_DATE_TAG in tags:
+            found.append(tags[TIFF_DATE_TAG])
+        for entry in found:
+            text = read_text(entry)
+            ts = None if text is None else parse_date_text(text)
+            if ts is not None:
+                return ts
+    except struct.error:
+        return None
+    return None
+
+
+def jpeg_capture_time(data: bytes) -> float | None:
+    """
+    Returns the capture date from the EXIF (APP1) segment at the start of
+    JPEG data.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    while pos + 4 <= len(data):
+        marker, length = struct.unpack_from(">HH", data, pos)
+        #  Image data follows the start-of-scan marker.
+        if marker >> 8 != 0xFF or marker == 0xFFDA:  # noqa: PLR2004
+            return None
+        segment = data[pos + 4 : pos + 2 + length]
+        if marker == 0xFFE1 and segment[:6] == b"Exif\x00\x00":  # noqa: PLR2004
+            return tiff_capture_time(segment[6:])
+        pos += 2 + length
+    return None
+
+
+def png_capture_time(data: bytes) -> float | None:
+    """
+    Returns the capture date from an eXIf chunk, or a tEXt chunk with the
+    'Creation Time' keyword, before the image data in PNG data.
+    """
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+    pos = 8
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack_from(">I4s", data, pos)
+        if kind in (b"IDAT", b"IEND"):
+            return None
+        chunk = data[pos + 8 : pos + 8 + length]
+        if kind == b"eXIf":
+            return tiff_capture_time(chunk)
+        if kind == b"tEXt":
+            keyword, _, text = chunk.partition(b"\x00")
+            if keyword == b"Creation Time":
+                return parse_date_text(text.decode("latin-1"))
+        #  Length, type, data, and CRC.
+        pos += 12 + length
+    return None
+
+
+def mp4_capture_time(f) -> float | None:
+    """
+    Returns the creation time from the 'mvhd' box in the 'moov' box of an
+    MP4 (ISO base media, or QuickTime) file. Only box headers are read;
+    other boxes (such as the media data) are skipped by seeking.
+    """
+    end = os.fstat(f.fileno()).st_size
+    pos = 0
+    for _ in range(MP4_MAX_BOXES):
+        if pos + 8 > end:
+            return None
+        f.seek(pos)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", f.read(8))
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return None
+        if kind == b"moov":
+            #  Descend into the movie box.
+            end = pos + size
+            pos += header
+            continue
+        if kind == b"mvhd":
+            version = f.read(4)[0]
+            fmt = ">Q" if version == 1 else ">I"
+            (created,) = struct.unpack(fmt, f.read(struct.calcsize(fmt)))
+            if created == 0:
+                return None
+            return plausible_date(MP4_EPOCH.timestamp() + created)
+        pos += size
+    return None
+
+
+def read_capture_time(file_path: str) -> float | None:
+    """
+    Returns the capture date (timestamp) recorded in a JPEG, PNG, or MP4
+    file, or None if there is none. Only the start of the file (or, for
+    MP4, the box headers) is read. Dates that are not plausible (see
+    plausible_date) are treated as missing.
+    """
+    ext = os.path.splitext(file_path)[1].lower()  # noqa: PTH122
+    try:
+        with open(file_path, "rb") as f:  # noqa: PTH123
+            if ext in MP4_EXTS:
+                return mp4_capture_time(f)
+            data = f.read(HEADER_BYTES)
+    except (OSError, struct.error, IndexError):
+        return None
+    if ext in JPEG_EXTS:
+        return jpeg_capture_time(data)
+    if ext in PNG_EXTS:
+        return png_capture_time(data)
+    return None
+
+
+def default_date_cache() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    base = Path(cache_home) if cache_home else Path.home() / ".cache"
+    return base / "bymo" / "dates.sqlite"
+
+
+class DateReader:
+    """
+    Gets the date used to pick the sub-directory for each file, from the
+    file modification time ('mtime'), the capture date recorded in the file
+    ('exif'; files without one are not moved), or the capture date if
+    there is one, otherwise the modification time ('auto').
+
+    Capture dates are cached (in a SQLite database) keyed by the inode,
+    size, and modification time (ns) of the file, so a file is parsed only
+    once even after it has been moved (renamed). Files that are not in the
+    cache are parsed in batches by a pool of processes.
+    """
+
+    def __init__(self, source: str, cache_file: str | Path, jobs: int = 4):
+        self.source = source
+        self.jobs = max(1, jobs)
+        self.executor = None
+        cache_path = Path(cache_file)
+        if str(cache_path) != ":memory:":
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.con = sqlite3.connect(str(cache_path))
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS dates (ino INTEGER, size INTEGER, "
+            "mtime_ns INTEGER, taken REAL, PRIMARY KEY (ino, size, mtime_ns))"
+        )
+
+    def timed(self, files):
+        """
+        Takes (prefix, DirEntry) pairs and yields (prefix, DirEntry,
+        timestamp) for each of them, in order. The timestamp is None for a
+        file that has no capture date when the source is 'exif'.
+        """
+        for batch in batches(files, BATCH_SIZE):
+            yield from self.timed_batch(batch)
+
+    def timed_batch(self, batch: list) -> list:
+        keys = []
+        found = {}
+        missing = {}
+        for _, entry in batch:
+            if not entry.name.lower().endswith(MEDIA_EXTS):
+                keys.append(None)
+                continue
+            st = entry.stat()
+            key = (entry.inode(), st.st_size, st.st_mtime_ns)
+            keys.append(key)
+            row = self.con.execute(
+                "SELECT taken FROM dates WHERE ino = ? AND size = ? AND mtime_ns = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                missing[key] = entry.path
+            else:
+                found[key] = row[0]
+        if missing:
+            found.update(self.parse(missing))
+        results = []
+        for (prefix, entry), key in zip(batch, keys):
+            taken = found.get(key)
+            if taken is None and self.source == "auto":
+                taken = entry.stat().st_mtime
+            results.append((prefix, entry, taken))
+        return results
+
+    def parse(self, missing: dict) -> dict:
+        """
+        Parses the files (in the pool when there are enough of them), and
+        records the results, including files without a capture date.
+        Returns a dict of the capture date for each key.
+        """
+        paths = list(missing.values())
+        if len(paths) < PARSE_POOL_MIN:
+            dates = [read_capture_time(p) for p in paths]
+        else:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.jobs)
+            chunk = max(1, len(paths) // (self.jobs * 4))
+            dates = list(self.executor.map(read_capture_time, paths, chunksize=chunk))
+        parsed = dict(zip(missing, dates))
+        self.con.executemany(
+            "INSERT OR REPLACE INTO dates VALUES (?, ?, ?, ?)",
+            [(*key, taken) for key, taken in parsed.items()],
+        )
+        self.con.commit()
+        return parsed
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.con.close()
+
+
+def iter_files(dir_path: Path, filespecs: list[str], bucket, recursive: bool):
+    """
+    Yields (prefix, DirEntry) for the files to move, where prefix is the
+    relative path ('' or 'a/b/') of the directory the file is in.
+    """
+    match = spec_matcher(filespecs)
+    #  Directories are kept as relative path prefixes ('' or 'a/b/').
+    stack = [""]
+    while stack:
+        prefix = stack.pop()
+        sub_dirs = []
+        with os.scandir(dir_path / prefix) as entries:
+            for entry in entries:
+                if recursive and entry.is_dir(follow_symlinks=False):
+                    if not bucket.is_bucket(entry.name):
+                        sub_dirs.append(f"{prefix}{entry.name}{os.sep}")
+                    continue
+                if not entry.is_file():
+                    continue
+                if match is None:
+                    #  Do not move this script.
+                    if entry.path == __file__:
+                        continue
+                elif not match(entry.name):
+                    continue
+                yield prefix, entry
+        stack.extend(reversed(sub_dirs))
+
+
+def iter_moves(  # noqa: PLR0913, PLR0917
+    dir_path: Path,
+    filespecs: list[str],
+    bucket: Buckets,
+    keep_spaces: bool,
+    recursive: bool = False,
+    dates: DateReader | None = None,
+):
+    """
+    Reads the directory in a single pass and yields the moves for the files
+    in it (that match filespecs, if any) as they are found. The modification
+    time comes from the directory entry, which is read along with the name
+    on Windows and with one stat() call on other systems. When dates is
+    given, it supplies the date for each file instead.
+
+    When recursive is True, the sub-directories are walked too (depth
+    first, without following links), and files are moved to bucket
+    sub-directories of the directory they are in. Sub-directories with
+    bucket names are skipped. Only the paths of the directories waiting to
+    be walked are kept, so memory use does not grow with the number of
+    files.
+    """
+    files = iter_files(dir_path, filespecs, bucket, recursive)
+    if dates is None:
+        timed = ((prefix, e, e.stat().st_mtime) for prefix, e in files)
+    else:
+        timed = dates.timed(files)
+    for batch in batches(timed, BATCH_SIZE):
+        stamps = [ts for _, _, ts in batch if ts is not None]
+        if stamps:
+            bucket.prepare(min(stamps), max(stamps), len(stamps))
+        for prefix, entry, ts in batch:
+            name = None if ts is None else bucket.name(ts)
+            #  Files without a usable date are not moved.
+            if name is None:
+                continue
+            dst_dir = prefix + name
+            dst_name = entry.name if keep_spaces else entry.name.replace(" ", "_")
+            yield Move(prefix + entry.name, Path(dst_dir) / dst_name, dst_dir)
+
+
+class MoveExecutor:
+    """
+    Moves the planned files. Each sub-directory is created (if needed) once,
+    and checked for whether it is on the same device as the source
+    directory. If it is, files are moved into it with os.replace (a
+    rename). Otherwise files are copied and removed (shutil.move) by a pool
+    of threads, with at most jobs * 2 moves waiting. Results are printed in
+    the order the moves were queued.
+    """
+
+    def __init__(self, src_dir: Path, jobs: int = 4):
+        self.src_dev = src_dir.stat().st_dev
+        self.jobs = max(1, jobs)
+        self.executor = None
+        self.dirs = {}
+        self.pending = deque()
+        self.in_flight = 0
+        self.errors = 0
+
+    def make_dir(self, dst_dir: str) -> bool:
+        """
+        Creates the directory, if it does not exist, and returns True if it
+        is on the same device as the source directory.
+        """
+        same_dev = self.dirs.get(dst_dir)
+        if same_dev is None:
+            dir_path = Path(dst_dir)
+            dir_path.mkdir(parents=True, exist_ok=True)
+            same_dev = dir_path.stat().st_dev == self.src_dev
+            self.dirs[dst_dir] = same_dev
+        return same_dev
+
+    def move_file(self, mv: Move) -> OSError | None:
+        """
+        Moves the file now, and returns the error if it fails.
+        """
+        try:
+            if self.make_dir(mv.dst_dir):
+                Path(mv.src).replace(mv.dst)
+            else:
+                shutil.move(mv.src, mv.dst)
+        except OSError as e:
+            self.errors += 1
+            return e
+        return None
+
+    def move(self, mv: Move):
+        """
+        Moves the file, or queues it to be moved by the thread pool when it
+        goes to another device, and prints the results that are ready.
+        """
+        try:
+            same_dev = self.make_dir(mv.dst_dir)
+        except OSError as e:
+            self.errors += 1
+            self.pending.append((None, mv, e))
+            self.retire(self.jobs * 2)
+            return
+        if same_dev:
+            self.pending.append((None, mv, self.move_file(mv)))
+        else:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.jobs)
+            future = self.executor.submit(shutil.move, mv.src, mv.dst)
+            self.pending.append((future, mv, None))
+            self.in_flight += 1
+        self.retire(self.jobs * 2)
+
+    def retire(self, max_pending: int):
+        while self.pending:
+            future, mv, error = self.pending[0]
+            if (
+                future is not None
+                and not future.done()
+                and self.in_flight <= max_pending
+            ):
+                break
+            self.pending.popleft()
+            if future is not None:
+                self.in_flight -= 1
+                try:
+                    future.result()
+                except OSError as e:
+                    self.errors += 1
+                    error = e
+            report_move(mv, error, "(moved)")
+
+    def close(self):
+        self.retire(0)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def report_move(mv: Move, error: OSError | None, done_text: str):
+    print(f'Move "{mv.src}"')
+    print(f'  to "{mv.dst}"')
+    print(done_text if error is None else f"(FAILED: {error})")
+
 
 def get_input_lower(prompt):
     return input(prompt).lower()
@@ -32,8 +764,8 @@ def get_user_input(prompt, choices, default=None):
 def get_opts(arglist=None):
     ap = argparse.ArgumentParser(
         description="Move files in the current directory (folder) to "
-        "sub-directories named for the year and month the file was "
-        "last modified."
+        "sub-directories named for the year and month (or other period) the "
+        "file was last modified."
     )
 
     ap.add_argument(
@@ -66,97 +798,186 @@ def get_opts(arglist=None):
         dest="by_year",
         action="store_true",
         help="Move files to sub-directories named for only the year the file was "
-        "last modified (instead of year and month which is the default action)."
+        "last modified (instead of year and month which is the default action). "
+        "Same as '--bucket year'.",
     )
 
     ap.add_argument(
-        "--what-if",
-        dest="what_if",
-        action="store_true",
-        help="Print the list of files that would be moved.",
+        "--bucket",
+        dest="bucket",
+        choices=list(GRANULARITIES),
+        default="month",
+        help="Period for the sub-directory names: 'year' (2022), 'quarter' "
+        "(2022_Q1), 'month' (2022_02; the default), 'week' (ISO week, "
+        "2022_W07), or 'day' (2022_02_14).",
     )
 
-    args = ap.parse_args(arglist)
-
-    return args.do_move, args.keep_spaces, args.filespecs, args.by_year, args.what_if
+    ap.add_argument(
+        "--nested",
+        dest="nested",
+        action="store_true",
+        help="Use nested sub-directories for the parts of the name, such as "
+        "2022/02/14 instead of 2022_02_14.",
+    )
 
+    ap.add_argument(
+        "-r",
+        "--recursive",
+        dest="recursive",
+        action="store_true",
+        help="Also move files in sub-directories, to year and month (or other "
+        "period) sub-directories of the directory each file is in. "
+        "Sub-directories with those names are skipped.",
+    )
 
-def main(arglist=None):  # noqa: PLR0912
-    print(f"#  {app_title}")
+    ap.add_argument(
+        "--date-source",
+        dest="date_source",
+        choices=DATE_SOURCES,
+        default="mtime",
+        help="Date used to pick the sub-directory: 'mtime' (the file "
+        "modification time; the default), 'exif' (the capture date recorded "
+        "in JPEG, PNG, and MP4 files; other files are not moved), or 'auto' "
+        "(the capture date when there is one, otherwise the modification "
+        "time).",
+    )
 
-    do_move, keep_spaces, filespecs, by_year, what_if = get_opts(arglist)
+    ap.add_argument(
+        "--date-cache",
+        dest="date_cache",
+        action="store",
+        help="SQLite file for caching capture dates, so files are only "
+        "parsed once. Default is 'bymo/dates.sqlite' in the user cache "
+        "directory ($XDG_CACHE_HOME or ~/.cache).",
+    )
 
-    p = Path.cwd()
+    ap.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=4,
+        action="store",
+        help="Number of files to copy at once when moving files to another "
+        "device (such as when a sub-directory is a mount point), and of "
+        "processes for reading capture dates. Files on the same device are "
+        "renamed, not copied. Default is 4.",
+    )
 
-    if len(filespecs) == 0:
-        files = [x for x in p.iterdir() if x.is_file() and x.name != __file__]
-    else:
-        files = []
-        for spec in filespecs:
-            files += sorted(p.glob(spec))
+    ap.add_argument(
+        "--what-if",
+        dest="what_if",
+        action="store_true",
+        help="Print the list of files that would be moved.",
+    )
 
-    dirs = []
-    moves = []
+    args = ap.parse_args(arglist)
 
-    fmt = "%Y" if by_year else "%Y_%m"
+    if args.jobs < 1:
+        ap.error("--jobs must be at least 1")
+
+    bucket = args.bucket
+    if args.by_year:
+        if bucket not in ("month", "year"):
+            ap.error("--by-year cannot be used with --bucket")
+        bucket = "year"
+
+    return AppOptions(
+        do_move=args.do_move,
+        keep_spaces=args.keep_spaces,
+        filespecs=args.filespecs,
+        bucket=bucket,
+        nested=args.nested,
+        what_if=args.what_if,
+        jobs=args.jobs,
+        recursive=args.recursive,
+        date_source=args.date_source,
+        date_cache=args.date_cache,
+    )
 
-    for f in files:
-        dst_dir = datetime.fromtimestamp(f.stat().st_mtime).strftime(fmt)
 
-        if dst_dir not in dirs:
-            dirs.append(dst_dir)
+def main(arglist=None):
+    print(f"#  {app_title}")
 
-        dst_name = f.name if keep_spaces else f.name.replace(" ", "_")
+    opts = get_opts(arglist)
 
-        moves.append((f.name, Path(dst_dir) / dst_name, dst_dir))
+    bucket = Buckets(opts.bucket, opts.nested)
 
-    dirs.sort()
+    dates = None
+    if opts.date_source != "mtime":
+        dates = DateReader(
+            opts.date_source, opts.date_cache or default_date_cache(), opts.jobs
+        )
 
-    if what_if:
-        print("\n#  Printing Unix 'mv' commands for '--what-if' output.\n")
-        for d in dirs:
-            print(f'mkdir "{d}"')
+    moves = iter_moves(
+        Path.cwd(), opts.filespecs, bucket, opts.keep_spaces, opts.recursive, dates
+    )
 
+    try:
+        if opts.what_if:
+            print("\n#  Printing Unix 'mv' commands for '--what-if' output.\n")
+            print_moves(moves, opts.nested)
+            return 0
+
+        mover = MoveExecutor(Path.cwd(), opts.jobs)
+        try:
+            run_moves(mover, moves, opts.do_move)
+        finally:
+            mover.close()
+    finally:
+        if dates is not None:
+            dates.close()
+
+    return 1 if mover.errors else 0
+
+
+def print_moves(moves, nested: bool = False):
+    """
+    Prints the 'mv' command for each move as it is planned, after the
+    'mkdir' command for its sub-directory the first time it is used.
+    """
+    mkdir = "mkdir -p" if nested else "mkdir"
+    dirs = set()
+    for mv in moves:
+        if mv.dst_dir not in dirs:
+            dirs.add(mv.dst_dir)
+            print(f'{mkdir} "{mv.dst_dir}"')
+        print(f'mv "{mv.src}" "{mv.dst}"')
+
+
+def run_moves(mover: MoveExecutor, moves, do_move: bool):
+    """
+    Moves the files as they are planned, asking before each one unless
+    do_move is True (or the user answers (a)ll). Each sub-directory is
+    created once, before the first file is moved to it.
+    """
     for mv in moves:
-        if what_if:
-            print(f'mv "{mv[0]}" "{mv[1]}"')
+        if do_move:
+            mover.move(mv)
             continue
 
-        print(f'Move "{mv[0]}"')
-        print(f'  to "{mv[1]}"')
-
-        dst_path = Path(mv[2])
+        print(f'Move "{mv.src}"')
+        print(f'  to "{mv.dst}"')
 
-        if do_move:
-            if not dst_path.exists():
-                dst_path.mkdir()
-            shutil.move(mv[0], mv[1])
-            print("(moved)")
-        else:
-            ans = get_user_input(
-                "Move (rename) file?  Enter (Y)es, (n)o, (a)ll, or (q)uit: ",
-                "y,n,a,q",
-                "y",
-            )
-
-            if ans == "n":
-                print("(Not moved)")
-                continue
+        ans = get_user_input(
+            "Move (rename) file?  Enter (Y)es, (n)o, (a)ll, or (q)uit: ",
+            "y,n,a,q",
+            "y",
+        )
 
-            if ans in ("y", "a"):
-                if not dst_path.exists():
-                    dst_path.mkdir()
-                shutil.move(mv[0], mv[1])
-                print("(Moved)")
+        if ans == "n":
+            print("(Not moved)")
+            continue
 
-            if ans == "a":
-                do_move = True
+        if ans == "q":
+            print("(Quit)")
+            break
 
-            if ans == "q":
-                print("(Quit)")
-                break
+        error = mover.move_file(mv)
+        print("(Moved)" if error is None else f"(FAILED: {error})")
 
-    return 0
+        if ans == "a":
+            do_move = True
 
 
 if __name__ == "__main__":
@@ -3,118 +3,2953 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import atexit
+import contextlib
+import errno
+import gzip
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import select
 import shutil
+import sqlite3
+import stat
+import struct
 import sys
+import tarfile
+import threading
 import time
-from datetime import datetime
+import warnings
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fnmatch import fnmatch
+from functools import partial
 from pathlib import Path
+from typing import NamedTuple
 
-app_version = "2024.02.1"
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+app_version = "2026.10.19"
 
 app_title = f"copydif.py (v{app_version})"
 
-log_file = None
+log_writer: LogWriter | None = None
+
+rate_limiter: TokenBucket | None = None
+
+NS_PER_SEC = 1_000_000_000
+
+COPY_BUFSIZE = 1024 * 1024
+
+HASH_MMAP_MIN = 16 * 1024 * 1024
+
+DELTA_BLOCK_SIZE = 1024 * 1024
+
+PART_SUFFIX = ".copydif-part"
+
+RESUME_CHECKPOINT = 64 * 1024 * 1024
+
+RESUME_VERIFY_SIZE = 64 * 1024
+
+#  Errors from os.copy_file_range meaning it cannot be used for the files
+#  (such as a target on another file system), so read and write is used.
+CFR_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}
+
+#  Files of at least this size use the separate pool of copy threads when
+#  the --large-jobs option is used.
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+
+#  A list-file with at least this many files in one directory (or any
+#  wildcard patterns) reads the directory instead of checking each file.
+LIST_SCAN_MIN = 32
+
+#  Events (from <sys/inotify.h>) that mark a file in a watched directory as
+#  changed. A file being written is reported when it is closed, rather than
+#  for each write.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_EVENT_SIZE = INOTIFY_EVENT.size
+
+#  In watch mode, a batch of changes is not held for more than this many
+#  times the debounce time, even if files keep changing.
+WATCH_MAX_DELAY = 10
+
+#  Suffix added to an archive's file name for the file that holds its
+#  member index.
+ARCHIVE_INDEX_SUFFIX = ".copydif-index"
+
+#  Data for a compressed tar archive is compressed in chunks of this size,
+#  each as a separate gzip member, by a pool of threads.
+GZIP_CHUNK_SIZE = 1024 * 1024
+
+#  Zip extra field header ID for the extended timestamp (Unix mtime).
+ZIP_EXTENDED_TIME = 0x5455
+ZIP_TIME_FIELD = struct.Struct("<Bl")
+
+ZIP64_MIN_SIZE = 2**31 - 1
+
+#  Most files of the same size to check for identical contents with
+#  --dedupe, so a common size cannot make each lookup slow.
+DEDUPE_CANDIDATES = 20
+
+LINK_SUFFIX = ".copydif-link"
+
+#  With --pipeline, the most directories to read ahead of the compare and
+#  copy stage.
+PIPELINE_AHEAD = 64
+
+SIZE_SUFFIXES = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+#  Linux ioctl request to clone (reflink) a file on filesystems, such as
+#  Btrfs and XFS, that can share data blocks between files.
+FICLONE = 0x40049409
+
+
+class AppOptions(NamedTuple):
+    source_spec: str | None = None
+    target_dirs: list[str] | None = None
+    recursive: bool = False
+    jobs: int = 1
+    state_file: str | None = None
+    compare: str = "time"
+    delta_min_size: int | None = None
+    resume_min_size: int | None = 64 * 1024 * 1024
+    bwlimit: int | None = None
+    order: str = "name"
+    pipeline: int | None = None
+    large_jobs: int | None = None
+    plan_file: str | None = None
+    apply_file: str | None = None
+    delete: bool = False
+    max_delete: int | None = None
+    max_delete_percent: float = 50.0
+    dedupe: bool = False
+    watch: bool = False
+    archive: bool = False
+    compress_level: int = 6
+    stats: bool = False
+    stats_json: str | None = None
+    stats_top: int = 10
+    watch_interval: float = 2.0
+    debounce: float = 0.5
+
+
+class LogWriter:
+    """
+    Writes lines to the log file, which is kept open for the run. Lines are
+    buffered and written when the buffer reaches flush_size characters,
+    when flush_secs seconds have passed since the last write, and when the
+    log is closed (including at exit). The time is only checked when a line
+    is written, so a caller that is about to wait (such as for changes in
+    watch mode) should call flush_log first. If background is True, a
+    thread does the writing so the caller does not wait on the log file.
+    """
+
+    flush_size = 64 * 1024
+    flush_secs = 1.0
+
+    def __init__(self, file_name: str, background: bool = False):
+        self.file = Path(file_name).open("a")  # noqa: SIM115
+        self.lines = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+        self.last_secs = None
+        self.dt = ""
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, text: str):
+        secs = int(time.time())
+        with self.lock:
+            #  The time stamp only has to be formatted once per second.
+            if secs != self.last_secs:
+                self.dt = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(secs))
+                self.last_secs = secs
+            line = f"[{self.dt}] {text.strip()}\n"
+            self.lines.append(line)
+            self.size += len(line)
+            due = (
+                self.size >= self.flush_size
+                or time.monotonic() - self.last_flush >= self.flush_secs
+            )
+            if due and self.thread is None:
+                self.flush_locked()
+        if due and self.thread is not None:
+            self.wake.set()
+
+    def flush_locked(self):
+        if self.lines:
+            self.file.write("".join(self.lines))
+            self.file.flush()
+            self.lines = []
+            self.size = 0
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait(self.flush_secs)
+            self.wake.clear()
+            self.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.thread is not None:
+            self.wake.set()
+            self.thread.join()
+        self.flush()
+        self.file.close()
+        atexit.unregister(self.close)
+
+
+def write_log(text: str):
+    if log_writer:
+        log_writer.write(text)
+
+
+def flush_log():
+    if log_writer:
+        log_writer.flush()
+
+
+def close_log():
+    global log_writer  # noqa: PLW0603
+    if log_writer:
+        log_writer.close()
+        log_writer = None
+
+
+def say(text: str):
+    """
+    Prints the text string, then passes it to write_log.
+    """
+    print(text)
+    write_log(text)
+
+
+def complain(text: str):
+    """
+    Like 'say', but prints the text string to stderr before passing
+    it to write_log.
+    """
+    sys.stderr.write(f"{text}\n")
+    write_log(text)
+
+
+class FileInfo(NamedTuple):
+    size: int
+    mtime_ns: int
+    ino: int = 0
+
+
+def entry_info(entry: os.DirEntry) -> FileInfo:
+    """
+    Returns the size, modification time, and inode number from a directory
+    entry. On Windows the stat information comes with the directory
+    listing. On other systems DirEntry.stat() makes one call that is cached
+    by the entry.
+    """
+    info = entry.stat()
+    return FileInfo(info.st_size, info.st_mtime_ns, info.st_ino)
+
+
+def scan_dir_index(
+    dir_path: Path | str, pattern: str | None = None, subdirs: list | None = None
+) -> dict:
+    """
+    Reads a directory in a single pass and returns a dictionary mapping
+    the name of each file to its FileInfo. If a pattern is given, only
+    names matching the (fnmatch style) pattern are included. If a subdirs
+    list is given, the names of sub-directories are appended to it.
+    Returns an empty dictionary if the directory does not exist.
+    """
+    index = {}
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if subdirs is not None and entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    continue
+                if pattern and not fnmatch(entry.name, pattern):
+                    continue
+                if entry.is_file():
+                    index[entry.name] = entry_info(entry)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return index
+
+
+def walk_source(source_dir: Path, pattern: str | None = None):
+    """
+    Generator that walks the source tree one directory at a time. Yields a
+    tuple of the directory path relative to source_dir and the index of
+    files in that directory. Only the pending sub-directory names are held
+    in memory, not the files in the whole tree. Symbolic links to
+    directories are not followed.
+    """
+    stack = [Path()]
+    while stack:
+        rel_dir = stack.pop()
+        subdirs = []
+        index = scan_dir_index(source_dir / rel_dir, pattern, subdirs)
+        yield rel_dir, index
+        stack.extend(rel_dir / name for name in sorted(subdirs, reverse=True))
+
+
+def same_time_and_size(info1: FileInfo, info2: FileInfo | None) -> bool:
+    """
+    Compares the file size and modified time. Returns False if either
+    does not match. Also returns False if info2 is None (the file does
+    not exist in the target).
+
+    Since the file modification times may have different numeric precision
+    on different operating systems, the times are compared in whole
+    seconds rather than comparing the full nanosecond values.
+    """
+    if info2 is None:
+        return False
+
+    if info1.size != info2.size:
+        return False
+
+    return info1.mtime_ns // NS_PER_SEC == info2.mtime_ns // NS_PER_SEC
+
+
+def file_digest(file_name: str) -> str | None:
+    """
+    Returns the BLAKE2b digest (as hex) of the file contents, or None if
+    the file cannot be read. Large files are read through mmap. This is a
+    module-level function so it can run in a process pool.
+    """
+    h = hashlib.blake2b()
+    try:
+        with Path(file_name).open("rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= HASH_MMAP_MIN:
+                with (
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m,
+                    memoryview(m) as mv,
+                ):
+                    for i in range(0, size, COPY_BUFSIZE):
+                        h.update(mv[i : i + COPY_BUFSIZE])
+            else:
+                for chunk in iter(lambda: f.read(COPY_BUFSIZE), b""):
+                    h.update(chunk)
+    except (OSError, ValueError):
+        return None
+    return h.hexdigest()
+
+
+class Hasher:
+    """
+    Gets file digests for the hash comparison mode. Digests are cached by
+    (path, size, mtime_ns, inode), so a file is hashed again only when one
+    of those changes. The cache is kept in the state file, if one is used,
+    so it carries over to later runs. With more than one job, files are
+    hashed in a process pool.
+    """
+
+    def __init__(self, jobs: int = 1, state: SyncState | None = None):
+        self.state = state
+        self.memo = {}
+        self.executor = ProcessPoolExecutor(jobs) if jobs > 1 else None
+
+    def digests(self, files: list[tuple[Path, FileInfo]]) -> list[str | None]:
+        """
+        Returns a list of digests for the given (path, FileInfo) items.
+        """
+        keys = [
+            (str(path.absolute()), info.size, info.mtime_ns, info.ino)
+            for path, info in files
+        ]
+        result = [self.cached(key) for key in keys]
+        todo = [i for i, d in enumerate(result) if d is None]
+        paths = [keys[i][0] for i in todo]
+        if self.executor is not None and len(todo) > 1:
+            computed = self.executor.map(file_digest, paths)
+        else:
+            computed = map(file_digest, paths)
+        for i, digest in zip(todo, computed):
+            result[i] = digest
+            if digest is not None:
+                self.memo[keys[i]] = digest
+                if self.state is not None:
+                    self.state.put_digest(keys[i], digest)
+        return result
+
+    def cached(self, key: tuple) -> str | None:
+        digest = self.memo.get(key)
+        if digest is None and self.state is not None:
+            digest = self.state.get_digest(key)
+        return digest
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def same_contents(
+    hasher: Hasher,
+    source_dir: Path,
+    source_index: dict,
+    target_dir: Path,
+    target_index: dict,
+) -> set:
+    """
+    Returns the set of names in source_index whose contents are the same
+    as the file of the same name in target_index. Only files of the same
+    size are hashed.
+    """
+    names = [
+        name
+        for name, info in source_index.items()
+        if name in target_index and target_index[name].size == info.size
+    ]
+    files = [(source_dir / name, source_index[name]) for name in names]
+    files += [(target_dir / name, target_index[name]) for name in names]
+    digests = hasher.digests(files)
+    n = len(names)
+    return {
+        name
+        for i, name in enumerate(names)
+        if digests[i] is not None and digests[i] == digests[n + i]
+    }
+
+
+class TokenBucket:
+    """
+    Limits the rate of copying to rate bytes per second, with bursts of up
+    to one second's worth. Shared by all copy threads.
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n: int):
+        """
+        Takes n bytes from the bucket, sleeping if the bucket is overdrawn
+        until the rate allows those bytes.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def throttle(n: int):
+    """
+    Waits as needed to keep copying within the --bwlimit rate.
+    """
+    if rate_limiter is not None:
+        rate_limiter.consume(n)
+
+
+def chunk_size() -> int:
+    #  Use smaller chunks when the rate is limited so the limit is smooth.
+    return COPY_BUFSIZE if rate_limiter is not None else COPY_BUFSIZE * 8
+
+
+def copy_fd_loop(copy_func, infd: int, outfd: int) -> int:
+    """
+    Calls copy_func(infd, outfd, offset) until it returns 0 (end of file).
+    The function must return the number of bytes copied. Returns the total
+    number of bytes copied.
+    """
+    offset = 0
+    while True:
+        n = copy_func(infd, outfd, offset)
+        if n == 0:
+            return offset
+        offset += n
+        throttle(n)
+
+
+def try_fd_copy(copy_func, infd: int, outfd: int) -> bool:
+    """
+    Copies with copy_fd_loop, and returns True if all of the source was
+    copied. Returns False, with both files back at the start and the target
+    empty, if the copy failed before writing anything or copied a different
+    number of bytes than the size of the source. Errors after data has
+    been written are raised.
+    """
+    try:
+        n = copy_fd_loop(copy_func, infd, outfd)
+    except OSError:
+        if os.lseek(outfd, 0, os.SEEK_CUR):
+            raise
+        return False
+    if n == os.fstat(infd).st_size:
+        return True
+    os.lseek(infd, 0, os.SEEK_SET)
+    os.lseek(outfd, 0, os.SEEK_SET)
+    os.ftruncate(outfd, 0)
+    return False
+
+
+def copy_contents(fsrc, fdst) -> str:
+    """
+    Copies the contents of the open file fsrc to the open file fdst. Tries
+    a reflink clone first, then os.copy_file_range, then os.sendfile, and
+    finally a buffered copy. A method that fails before any data has been
+    copied falls through to the next one, as does a method that copies a
+    different number of bytes than the size of the source (some file
+    systems report end of file at once). Returns the name of the method
+    that was used.
+    """
+    infd = fsrc.fileno()
+    outfd = fdst.fileno()
+
+    if fcntl is not None and sys.platform.startswith("linux"):
+        try:
+            fcntl.ioctl(outfd, FICLONE, infd)
+        except OSError:
+            pass
+        else:
+            return "reflink"
+
+    if hasattr(os, "copy_file_range") and try_fd_copy(
+        lambda i, o, _: os.copy_file_range(i, o, chunk_size()), infd, outfd
+    ):
+        return "copy_file_range"
+
+    if (
+        hasattr(os, "sendfile")
+        and sys.platform.startswith("linux")
+        and try_fd_copy(
+            lambda i, o, offset: os.sendfile(o, i, offset, chunk_size()),
+            infd,
+            outfd,
+        )
+    ):
+        return "sendfile"
+
+    fsrc.seek(0)
+    for chunk in iter(lambda: fsrc.read(COPY_BUFSIZE), b""):
+        fdst.write(chunk)
+        throttle(len(chunk))
+    return "buffered"
+
+
+def copy_file(source_file: Path, target_file: Path) -> str:
+    """
+    Copies the file contents using the fastest method available, then
+    copies the permission bits and modification time (as shutil.copy2
+    does). Returns the name of the method used for the contents.
+    """
+    with source_file.open("rb") as fsrc, target_file.open("wb") as fdst:
+        method = copy_contents(fsrc, fdst)
+    shutil.copystat(source_file, target_file)
+    return method
+
+
+def ready_target(target_file: Path, mode: str) -> str:
+    """
+    Gets the target file ready to be copied in the mode from copy_mode(),
+    and returns the mode to use. An existing target that is a hardlink
+    shared with other files (made by --dedupe) is removed rather than
+    written in place, since writing it would change the other files too.
+    """
+    if mode in {"copy", "delta"}:
+        try:
+            if target_file.stat().st_nlink > 1:
+                mode = "replace"
+        except OSError:
+            pass
+    if mode == "replace":
+        target_file.unlink(missing_ok=True)
+    return mode
+
+
+def fan_out_copy(source_file: Path, target_files: list[Path]) -> list:
+    """
+    Reads the source file once and writes each chunk to all of the target
+    files, then copies the permission bits and modification time. A target
+    that fails is dropped and the others continue. Returns a list with the
+    name of the copy method, or the exception, for each target.
+    """
+    results = [None] * len(target_files)
+    outs = []
+    with source_file.open("rb") as fsrc:
+        for i, target_file in enumerate(target_files):
+            try:
+                outs.append((i, target_file.open("wb")))
+            except OSError as e:  # noqa: PERF203
+                results[i] = e
+        try:
+            buf = bytearray(COPY_BUFSIZE)
+            view = memoryview(buf)
+            while outs:
+                n = fsrc.readinto(buf)
+                if not n:
+                    break
+                throttle(n)
+                for i, fdst in list(outs):
+                    try:
+                        fdst.write(view[:n])
+                    except OSError as e:  # noqa: PERF203
+                        results[i] = e
+                        outs.remove((i, fdst))
+                        fdst.close()
+        finally:
+            for i, fdst in outs:
+                try:
+                    fdst.close()
+                except OSError as e:  # noqa: PERF203
+                    results[i] = e
+    method = f"fan-out to {len(target_files)}"
+    for i, target_file in enumerate(target_files):
+        if results[i] is None:
+            try:
+                shutil.copystat(source_file, target_file)
+                results[i] = method
+            except OSError as e:
+                results[i] = e
+    return results
+
+
+def delta_copy(source_file: Path, target_file: Path) -> str:
+    """
+    Updates an existing target file in place. Blocks of the source and
+    target are compared, and only the blocks that differ are written. The
+    target is then truncated (or was extended) to the size of the source,
+    and the permission bits and modification time are copied. Returns a
+    description of the number of blocks written.
+    """
+    blocks = 0
+    changed = 0
+    offset = 0
+    with source_file.open("rb") as fsrc, target_file.open("r+b") as fdst:
+        for src_block in iter(lambda: fsrc.read(DELTA_BLOCK_SIZE), b""):
+            n = len(src_block)
+            if fdst.read(n) != src_block:
+                fdst.seek(offset)
+                fdst.write(src_block)
+                throttle(n)
+                changed += 1
+            offset += n
+            blocks += 1
+        fdst.truncate(offset)
+    shutil.copystat(source_file, target_file)
+    return f"delta, {changed} of {blocks} blocks"
+
+
+def part_paths(target_file: Path) -> tuple[Path, Path]:
+    """
+    Returns the paths for the temporary (partial) file and the checkpoint
+    file used by resumable_copy for the target file.
+    """
+    part = target_file.with_name(f".{target_file.name}{PART_SUFFIX}")
+    return part, part.with_name(f"{part.name}.ckpt")
+
+
+def is_part_name(name: str) -> bool:
+    return name.endswith((PART_SUFFIX, f"{PART_SUFFIX}.ckpt"))
+
+
+def read_checkpoint(ckpt: Path, info: FileInfo) -> dict | None:
+    """
+    Returns the checkpoint record if it is for a source file with the same
+    size and modification time as info, otherwise None.
+    """
+    try:
+        rec = json.loads(ckpt.read_text())
+        if rec["size"] == info.size and rec["mtime_ns"] == info.mtime_ns:
+            return rec
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def part_base_name(name: str) -> str | None:
+    """
+    Returns the name of the target file for a partial copy or checkpoint
+    file name, or None if it is not one.
+    """
+    for suffix in (PART_SUFFIX, f"{PART_SUFFIX}.ckpt"):
+        if name.startswith(".") and name.endswith(suffix):
+            return name[1 : -len(suffix)]
+    return None
+
+
+def resume_offset(source_file: Path, part: Path, ckpt: Path, info: FileInfo) -> int:
+    """
+    Returns the offset at which to resume copying into the partial file.
+    The checkpoint must be for the same source size and modification time,
+    and the last block before the checkpoint offset must match the source.
+    Otherwise returns 0 to copy from the start.
+    """
+    try:
+        rec = read_checkpoint(ckpt, info)
+        if rec is None:
+            return 0
+        offset = rec["offset"]
+        if not 0 < offset <= part.stat().st_size:
+            return 0
+        n = min(offset, RESUME_VERIFY_SIZE)
+        with source_file.open("rb") as fsrc, part.open("rb") as fpart:
+            fsrc.seek(offset - n)
+            fpart.seek(offset - n)
+            if fsrc.read(n) != fpart.read(n):
+                return 0
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+    return offset
+
+
+def copy_range(fsrc, fdst, offset: int, count: int, use_cfr: list) -> int:
+    """
+    Copies up to count bytes at offset from fsrc to the same offset in fdst.
+    Uses os.copy_file_range while use_cfr[0] is True (it is set to False
+    if that is not supported for these files, such as across file
+    systems), otherwise reads and writes. The offsets are explicit, so
+    falling back is safe at any offset. Returns the number of bytes copied
+    (0 at end of file).
+    """
+    if use_cfr[0]:
+        try:
+            return os.copy_file_range(
+                fsrc.fileno(), fdst.fileno(), count, offset, offset
+            )
+        except OSError as e:
+            if e.errno not in CFR_FALLBACK_ERRNOS:
+                raise
+            use_cfr[0] = False
+    fsrc.seek(offset)
+    data = fsrc.read(count)
+    fdst.seek(offset)
+    fdst.write(data)
+    return len(data)
+
+
+def resumable_copy(source_file: Path, target_file: Path, info: FileInfo) -> str:
+    """
+    Copies the file to a temporary file in the target directory, then
+    renames it to the target file, so the target is never left partly
+    written. Every RESUME_CHECKPOINT bytes the temporary file is flushed to
+    disk and the offset is saved in a checkpoint file. If a copy is
+    interrupted, the next run resumes from the last checkpoint. Returns a
+    description of the copy method.
+    """
+    part, ckpt = part_paths(target_file)
+    offset = resume_offset(source_file, part, ckpt, info)
+    start = offset
+    method = "resumable"
+    with source_file.open("rb") as fsrc, part.open("r+b" if offset else "wb") as fdst:
+        fdst.truncate(offset)
+        if offset == 0 and fcntl is not None and sys.platform.startswith("linux"):
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                offset = info.size
+                method = "reflink"
+            except OSError:
+                pass
+        use_cfr = [hasattr(os, "copy_file_range")]
+        since_ckpt = 0
+        while True:
+            n = copy_range(fsrc, fdst, offset, chunk_size(), use_cfr)
+            if n == 0:
+                break
+            throttle(n)
+            offset += n
+            since_ckpt += n
+            if since_ckpt >= RESUME_CHECKPOINT:
+                fdst.flush()
+                os.fsync(fdst.fileno())
+                save_checkpoint(ckpt, info, offset)
+                since_ckpt = 0
+    shutil.copystat(source_file, part)
+    part.replace(target_file)
+    with contextlib.suppress(FileNotFoundError):
+        ckpt.unlink()
+    if start:
+        method = f"resumed at {start:,}"
+    return method
+
+
+def save_checkpoint(ckpt: Path, info: FileInfo, offset: int):
+    tmp = ckpt.with_name(f"{ckpt.name}.tmp")
+    tmp.write_text(
+        json.dumps({"size": info.size, "mtime_ns": info.mtime_ns, "offset": offset})
+    )
+    tmp.replace(ckpt)
+
+
+def link_duplicate(
+    source_file: Path,
+    info: FileInfo,
+    target_file: Path,
+    candidates: list[tuple],
+    digests: dict,
+) -> bool:
+    """
+    Replaces target_file with a hardlink to one of the candidates, given as
+    (path, mtime_ns, ino, digest) rows of files of the same size from the
+    content index, that has the same contents as source_file. Returns False
+    if there is no such candidate, or linking fails (such as when it is on
+    another filesystem).
+
+    Digests are added to digests: the source's under the key None, and
+    those computed for candidates under their paths. A candidate that has
+    changed since it was indexed is added with a digest of None.
+    """
+    source_digest = digests.get(None) or file_digest(str(source_file))
+    if source_digest is None:
+        return False
+    digests[None] = source_digest
+    target_key = str(target_file.absolute())
+    for path, mtime_ns, ino, digest in candidates:
+        if path == target_key:
+            continue
+        try:
+            st = Path(path).stat()
+        except OSError:
+            digests[path] = None
+            continue
+        if (st.st_size, st.st_mtime_ns, st.st_ino) != (info.size, mtime_ns, ino):
+            digests[path] = None
+            continue
+        if digest is None:
+            digests[path] = digests.get(path) or file_digest(path)
+        if (digest or digests[path]) != source_digest:
+            continue
+        #  The link is made under a temporary name and renamed over the
+        #  target, so an existing target is replaced in one step.
+        tmp = target_file.with_name(f"{target_file.name}{LINK_SUFFIX}")
+        try:
+            tmp.unlink(missing_ok=True)
+            os.link(path, tmp)
+            tmp.replace(target_file)
+        except OSError:
+            with contextlib.suppress(OSError):
+                tmp.unlink()
+            continue
+        return True
+    return False
+
+
+class SyncState:
+    """
+    State file (SQLite database) that records the index of each target
+    directory after a successful sync, along with the modification time
+    of the directory. When the directory's modification time has not
+    changed on the next run, the recorded index is used instead of
+    reading the directory again.
+
+    Adding, removing, or renaming files changes a directory's modification
+    time, but changing the contents of an existing file does not. Files in
+    the target directory that are changed by something other than this
+    script may not be detected. Source directories are always read.
+    """
+
+    #  A directory modified within this many seconds of being recorded
+    #  is not trusted, since a later change in the same clock tick would
+    #  not change the modification time.
+    settle_ns = 2 * NS_PER_SEC
+
+    def __init__(self, file_name: str):
+        self.con = sqlite3.connect(file_name)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS target_dirs "
+            "(path TEXT PRIMARY KEY, mtime_ns INTEGER, files TEXT)"
+        )
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, "
+            "size INTEGER, mtime_ns INTEGER, ino INTEGER, digest TEXT)"
+        )
+        #  Content index of target files for --dedupe. The digest is NULL
+        #  until another file of the same size needs to be compared.
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS content (path TEXT PRIMARY KEY, "
+            "size INTEGER, mtime_ns INTEGER, ino INTEGER, digest TEXT)"
+        )
+        self.con.execute("CREATE INDEX IF NOT EXISTS content_size ON content (size)")
+
+    @staticmethod
+    def dir_key(dir_path: Path) -> str:
+        return str(dir_path.absolute())
+
+    def get_index(self, dir_path: Path) -> dict | None:
+        """
+        Returns the recorded index for the directory, or None if there is
+        no usable record.
+        """
+        row = self.con.execute(
+            "SELECT mtime_ns, files FROM target_dirs WHERE path = ?",
+            (self.dir_key(dir_path),),
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            mtime_ns = dir_path.stat().st_mtime_ns
+        except OSError:
+            return None
+        if mtime_ns != row[0]:
+            return None
+        return {k: FileInfo(*v) for k, v in json.loads(row[1]).items()}
+
+    def put_index(self, dir_path: Path, index: dict):
+        try:
+            mtime_ns = dir_path.stat().st_mtime_ns
+        except OSError:
+            self.forget(dir_path)
+            return
+        if time.time_ns() - mtime_ns < self.settle_ns:
+            self.forget(dir_path)
+            return
+        self.con.execute(
+            "INSERT OR REPLACE INTO target_dirs VALUES (?, ?, ?)",
+            (self.dir_key(dir_path), mtime_ns, json.dumps(index)),
+        )
+
+    def forget(self, dir_path: Path):
+        self.con.execute(
+            "DELETE FROM target_dirs WHERE path = ?", (self.dir_key(dir_path),)
+        )
+
+    def get_digest(self, key: tuple) -> str | None:
+        """
+        Returns the recorded digest for the key (path, size, mtime_ns, ino),
+        or None if there is no record matching all parts of the key.
+        """
+        row = self.con.execute(
+            "SELECT size, mtime_ns, ino, digest FROM digests WHERE path = ?",
+            (key[0],),
+        ).fetchone()
+        if row is None or tuple(row[:3]) != key[1:]:
+            return None
+        return row[3]
+
+    def put_digest(self, key: tuple, digest: str):
+        self.con.execute(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)", (*key, digest)
+        )
+
+    def put_content(self, files: list[tuple[str, FileInfo]], digest=None):
+        """
+        Adds (path, FileInfo) items to the content index. A recorded digest
+        is kept if the file's size, modification time, and inode have not
+        changed, unless a digest is given.
+        """
+        self.con.executemany(
+            "INSERT INTO content VALUES (?, ?, ?, ?, ?) ON CONFLICT (path) DO "
+            "UPDATE SET digest = CASE WHEN excluded.digest IS NOT NULL "
+            "THEN excluded.digest WHEN (size, mtime_ns, ino) = (excluded.size, "
+            "excluded.mtime_ns, excluded.ino) THEN digest END, "
+            "size = excluded.size, mtime_ns = excluded.mtime_ns, "
+            "ino = excluded.ino",
+            [(path, *info, digest) for path, info in files],
+        )
+
+    def content_candidates(self, size: int) -> list[tuple]:
+        """
+        Returns up to DEDUPE_CANDIDATES (path, mtime_ns, ino, digest) rows for
+        target files of the given size, those with a digest first.
+        """
+        return self.con.execute(
+            "SELECT path, mtime_ns, ino, digest FROM content WHERE size = ? "
+            "ORDER BY digest IS NULL LIMIT ?",
+            (size, DEDUPE_CANDIDATES),
+        ).fetchall()
+
+    def set_content_digest(self, path: str, digest: str | None):
+        """
+        Records the digest of a file in the content index, or removes the
+        file from the index if digest is None (it changed or is gone).
+        """
+        if digest is None:
+            self.con.execute("DELETE FROM content WHERE path = ?", (path,))
+        else:
+            self.con.execute(
+                "UPDATE content SET digest = ? WHERE path = ?", (digest, path)
+            )
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+
+class RunStats:
+    """
+    Counts and timings for a run, reported with the --stats and --stats-json
+    options. The time for each phase is the wall time spent in it by the
+    main thread, except for the copy phase, which is the total time spent
+    copying files (by all of the copy threads, when there are several).
+    The slowest copies are kept in a heap of at most top_n entries.
+    """
+
+    PHASES = ("list_parse", "source_scan", "target_scan", "compare", "copy")
+
+    def __init__(self, top_n: int = 10):
+        self.start = time.perf_counter()
+        self.phase_times = dict.fromkeys(self.PHASES, 0.0)
+        self.source_files = 0
+        self.target_files = 0
+        self.top_n = top_n
+        self.slowest = []
+
+    @contextlib.contextmanager
+    def timed(self, phase: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_times[phase] += time.perf_counter() - t0
+
+    def timed_iter(self, iterable, phase: str):
+        """
+        Generator that yields the items from iterable, adding the time taken
+        to get each one (such as reading a directory) to the phase.
+        """
+        it = iter(iterable)
+        while True:
+            with self.timed(phase):
+                item = next(it, None)
+            if item is None:
+                return
+            yield item
+
+    def add_copy(self, label: str, size: int, seconds: float):
+        self.phase_times["copy"] += seconds
+        if self.top_n < 1:
+            return
+        item = (seconds, label, size)
+        if len(self.slowest) < self.top_n:
+            heapq.heappush(self.slowest, item)
+        else:
+            heapq.heappushpop(self.slowest, item)
+
+    def as_dict(self, copier: DifCopier) -> dict:
+        wall_time = time.perf_counter() - self.start
+        return {
+            "version": app_version,
+            "wall_time": round(wall_time, 6),
+            "source_files_scanned": self.source_files,
+            "target_files_scanned": self.target_files,
+            "files_checked": copier.files_checked,
+            "files_copied": copier.files_copied,
+            "bytes_copied": copier.bytes_copied,
+            "files_linked": copier.files_linked,
+            "files_deleted": copier.files_deleted,
+            "errors": copier.errors,
+            "bytes_per_second": round(copier.bytes_copied / wall_time)
+            if wall_time > 0
+            else 0,
+            "phases": {k: round(v, 6) for k, v in self.phase_times.items()},
+            "slowest": [
+                {"name": label, "size": size, "seconds": round(seconds, 6)}
+                for seconds, label, size in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+    def report(self, copier: DifCopier) -> str:
+        d = self.as_dict(copier)
+        phases = ", ".join(
+            f"{name.replace('_', ' ')} {seconds:.3f}"
+            for name, seconds in d["phases"].items()
+        )
+        lines = [
+            "Statistics:",
+            f"  Wall time: {d['wall_time']:.3f} s",
+            (
+                f"  Files scanned: {d['source_files_scanned']} source, "
+                f"{d['target_files_scanned']} target"
+            ),
+            f"  Throughput: {d['bytes_per_second'] / 1024**2:,.2f} MiB/s",
+            f"  Phase times (s): {phases}",
+        ]
+        if d["slowest"]:
+            lines.append("  Slowest copies:")
+            lines.extend(
+                f"    {s['seconds']:.3f} s  {s['name']} ({s['size']:,} bytes)"
+                for s in d["slowest"]
+            )
+        return "\n".join(lines)
+
+
+class DifCopier:
+    """
+    Copies files and reports the results. With more than one job, copies
+    are run by a thread pool. At most jobs * 2 unfinished copies are
+    queued in the pool at a time, and at most max_queue results wait to be
+    reported, so the directory scan does not run far ahead of the copying.
+    Results are reported in the order the files were queued, so the output
+    and log are the same as for a single job.
+
+    A copy can have more than one target. Results are counted for each
+    target (by its position in target_roots) as well as in total.
+
+    If large_jobs is set in the options, files of LARGE_FILE_SIZE or more
+    are copied by a separate pool of that many threads (with its own limit
+    of large_jobs * 2 unfinished copies), so a few large files cannot hold
+    up all of the small ones. Finished small copies wait behind a large one
+    to be reported, up to max_queue of them.
+    """
+
+    max_queue = 1000
+
+    def __init__(
+        self,
+        opts: AppOptions | None = None,
+        state: SyncState | None = None,
+        hasher: Hasher | None = None,
+    ):
+        if opts is None:
+            opts = AppOptions()
+        self.jobs = max(1, opts.jobs)
+        self.delta_min_size = opts.delta_min_size
+        self.resume_min_size = opts.resume_min_size
+        self.max_delete = opts.max_delete
+        self.max_delete_percent = opts.max_delete_percent
+        self.state = state
+        self.hasher = hasher
+        self.dedupe = opts.dedupe
+        #  With --dedupe, the hasher is also used for files of the same
+        #  size that have different times, but not for all files unless
+        #  --compare=hash is used.
+        self.hash_all = hasher is not None and (
+            not opts.dedupe or opts.compare == "hash"
+        )
+        self.order = opts.order
+        self.pipeline = opts.pipeline
+        self.executor = ThreadPoolExecutor(self.jobs) if self.jobs > 1 else None
+        self.large_executor = None
+        #  Slots for unfinished copies in each pool. A slot is released by
+        #  the future's done-callback, not when the result is reported.
+        self.slots = {}
+        if self.executor is not None:
+            self.slots[self.executor] = threading.Semaphore(self.jobs * 2)
+        if opts.large_jobs and self.executor is not None:
+            self.large_executor = ThreadPoolExecutor(opts.large_jobs)
+            self.slots[self.large_executor] = threading.Semaphore(opts.large_jobs * 2)
+        self.pending = deque()
+        self.target_roots = []
+        self.target_counts = {}
+        self.index_cache = None
+        self.files_checked = 0
+        self.files_copied = 0
+        self.bytes_copied = 0
+        self.files_linked = 0
+        self.files_deleted = 0
+        self.delete_queued = 0
+        self.errors = 0
+        self.stats = RunStats(opts.stats_top)
+
+    def then(self, func):
+        """
+        Calls func() after the results of everything queued so far have
+        been reported.
+        """
+        if self.pending:
+            self.pending.append((None, lambda _: func()))
+            self.retire()
+        else:
+            func()
+
+    def make_dir(self, target_dir: Path):
+        target_dir.mkdir(parents=True, exist_ok=True)
+
+    def diff_reason(self, info: FileInfo, target_info: FileInfo | None) -> str:
+        if target_info is None:
+            return "missing"
+        if info.size != target_info.size:
+            return "size"
+        return "time" if self.hasher is None else "contents"
+
+    def target_label(self, label: str, t: int) -> str:
+        """
+        Returns the label for output. When there is more than one target,
+        the target directory is added to the label.
+        """
+        if len(self.target_roots) > 1:
+            return f"{label} -> {self.target_roots[t]}"
+        return label
+
+    def count(self, t: int, key: str, n: int = 1):
+        counts = self.target_counts.setdefault(
+            t, {"copied": 0, "bytes": 0, "linked": 0, "deleted": 0, "failed": 0}
+        )
+        counts[key] += n
+
+    def same(
+        self, source_file: Path, target_file: Path, label: str, info: FileInfo, t=0
+    ):
+        label = self.target_label(label, t)
+        self.then(lambda: say(f"  Same: {label}"))
+
+    def copy(
+        self,
+        source_file: Path,
+        targets: list[tuple[int, Path, FileInfo | None]],
+        label: str,
+        info: FileInfo,
+    ):
+        """
+        Copies source_file to each of the targets, given as tuples of the
+        target number, target file path, and FileInfo for the existing
+        target file (None if there is no existing file).
+        """
+        size = info.size
+        #  A resumable copy reads the source for each target, so a file
+        #  copied to several targets is read once for all of them instead.
+        resume = len(targets) == 1
+        jobs = [
+            (target_file, self.copy_mode(size, target_info, resume))
+            for _, target_file, target_info in targets
+        ]
+        nums = [t for t, _, _ in targets]
+        candidates = None
+        if self.dedupe and size:
+            candidates = self.state.content_candidates(size)
+
+        def done(timed):
+            self.report(label, nums, timed, size)
+            if self.dedupe:
+                self.record_content([f for f, _ in jobs], timed)
+
+        if self.executor is None:
+            done(self.timed_copy(source_file, info, jobs, candidates))
+            return
+        executor = self.executor
+        if self.large_executor is not None and size >= LARGE_FILE_SIZE:
+            executor = self.large_executor
+        slots = self.slots[executor]
+        if not slots.acquire(blocking=False):
+            #  Report what has finished while waiting for a slot.
+            self.retire()
+            slots.acquire()
+        future = executor.submit(self.timed_copy, source_file, info, jobs, candidates)
+        future.add_done_callback(lambda _: slots.release())
+        self.pending.append((future, done))
+        self.retire()
+
+    def delete_check(self, target_dir: Path, n_delete: int, n_target: int) -> bool:
+        """
+        Returns True if n_delete files can be deleted from a target directory
+        that has n_target files. Otherwise reports the reason and returns
+        False. Deletions are counted when they are queued, so the limit
+        for the run applies even though they are done later.
+        """
+        percent = 100.0 * n_delete / max(n_target, 1)
+        if percent > self.max_delete_percent:
+            complain(
+                f"  NOT DELETING {n_delete} files in '{target_dir}': "
+                f"{percent:.0f}% of the files is over the --max-delete-percent "
+                f"limit ({self.max_delete_percent:g}%)."
+            )
+            self.errors += 1
+            return False
+        if (
+            self.max_delete is not None
+            and self.delete_queued + n_delete > self.max_delete
+        ):
+            complain(
+                f"  NOT DELETING {n_delete} files in '{target_dir}': "
+                f"the --max-delete limit ({self.max_delete}) would be exceeded."
+            )
+            self.errors += 1
+            return False
+        self.delete_queued += n_delete
+        return True
+
+    def remove_part(self, part_file: Path):
+        """
+        Removes a stale partial copy or checkpoint file. This is done at
+        once (not queued), before any copy to the same target file is.
+        """
+        try:
+            part_file.unlink(missing_ok=True)
+        except OSError as e:
+            complain(f"  FAILED: remove {part_file} ({e})")
+            self.errors += 1
+
+    def delete(self, target_file: Path, label: str, t=0, done_func=None):
+        """
+        Deletes the target file after the results of everything queued so
+        far have been reported. If given, done_func() is called after the
+        file is deleted.
+        """
+        label = self.target_label(label, t)
+
+        def run_delete():
+            try:
+                target_file.unlink()
+            except OSError as e:
+                complain(f"  FAILED: delete {label} ({e})")
+                self.errors += 1
+                self.count(t, "failed")
+                return
+            say(f"  DELETE: {label}")
+            self.files_deleted += 1
+            self.count(t, "deleted")
+            if self.dedupe:
+                self.state.set_content_digest(str(target_file.absolute()), None)
+            if done_func is not None:
+                done_func()
+
+        self.then(run_delete)
+
+    def copy_mode(
+        self, size: int, target_info: FileInfo | None, resume: bool = True
+    ) -> str:
+        """
+        Returns how to copy a file of the given size: 'delta' to update an
+        existing target in place, 'resume' for a resumable copy through a
+        temporary file, 'replace' to remove the existing target before a
+        plain copy, or 'copy' for a plain copy.
+
+        With --dedupe, an existing target may be a hardlink shared with
+        other files, so it is never written in place (no delta copies).
+        Without --dedupe, run_copy checks for such links (left by an
+        earlier run with --dedupe) before writing.
+        """
+        if (
+            target_info is not None
+            and self.delta_min_size is not None
+            and size >= self.delta_min_size
+            and not self.dedupe
+        ):
+            return "delta"
+        if resume and self.resume_min_size is not None and size >= self.resume_min_size:
+            return "resume"
+        if target_info is not None and self.dedupe:
+            return "replace"
+        return "copy"
+
+    @staticmethod
+    def run_copy(
+        source_file: Path,
+        info: FileInfo,
+        jobs: list[tuple[Path, str]],
+        candidates: list | None = None,
+        digests: dict | None = None,
+    ):
+        """
+        Copies the file to each target in jobs, given as (target_file, mode)
+        tuples, where mode is from copy_mode(). If there is more than one
+        target in 'copy' mode, the source is read once and written to each
+        of them. Returns a list with the name of the copy method, or the
+        exception, for each target.
+
+        If candidates (from the --dedupe content index) are given, a target
+        is hardlinked to a candidate with the same contents instead of
+        being copied. Digests computed for that are added to digests.
+        """
+        results = [None] * len(jobs)
+        full = []
+        for i, (target_file, mode) in enumerate(jobs):
+            if candidates and link_duplicate(
+                source_file, info, target_file, candidates, digests
+            ):
+                results[i] = "hardlink"
+                continue
+            try:
+                how = ready_target(target_file, mode)
+                if how in {"copy", "replace"}:
+                    full.append(i)
+                elif how == "delta":
+                    results[i] = delta_copy(source_file, target_file)
+                else:
+                    results[i] = resumable_copy(source_file, target_file, info)
+            except OSError as e:
+                results[i] = e
+        try:
+            if len(full) == 1:
+                results[full[0]] = copy_file(source_file, jobs[full[0]][0])
+            elif full:
+                fanned = fan_out_copy(source_file, [jobs[i][0] for i in full])
+                for i, result in zip(full, fanned):
+                    results[i] = result
+        except OSError as e:
+            for i in full:
+                results[i] = e
+        return results
+
+    @classmethod
+    def timed_copy(cls, source_file: Path, info: FileInfo, jobs: list, candidates=None):
+        """
+        Runs run_copy() and returns a tuple of its results, the number of
+        seconds it took, and the digests computed for --dedupe.
+        """
+        t0 = time.perf_counter()
+        digests = {}
+        results = cls.run_copy(source_file, info, jobs, candidates, digests)
+        return results, time.perf_counter() - t0, digests
+
+    def record_content(self, target_files: list[Path], timed: tuple):
+        """
+        Updates the --dedupe content index after a copy: with the digests
+        of candidate files that were hashed (or removing those that had
+        changed), and with each target file that was copied or linked.
+        """
+        results, _, digests = timed
+        for path, digest in digests.items():
+            if path is not None:
+                self.state.set_content_digest(path, digest)
+        files = []
+        for target_file, result in zip(target_files, results):
+            if isinstance(result, str):
+                try:
+                    st = target_file.stat()
+                except OSError:
+                    continue
+                info = FileInfo(st.st_size, st.st_mtime_ns, st.st_ino)
+                files.append((str(target_file.absolute()), info))
+        self.state.put_content(files, digests.get(None))
+
+    def report(self, label: str, nums: list[int], timed: tuple, size: int):
+        results, seconds, _ = timed
+        self.stats.add_copy(label, size, seconds)
+        for t, result in zip(nums, results):
+            t_label = self.target_label(label, t)
+            if result == "hardlink":
+                say(f"  LINK: {t_label} (same contents as an existing file)")
+                self.files_linked += 1
+                self.count(t, "linked")
+            elif isinstance(result, str):
+                say(f"  COPY: {t_label} ({result})")
+                self.files_copied += 1
+                self.bytes_copied += size
+                self.count(t, "copied")
+                self.count(t, "bytes", size)
+            else:
+                complain(f"  FAILED: {t_label} ({result})")
+                self.errors += 1
+                self.count(t, "failed")
+
+    def retire(self, wait: bool = False):
+        """
+        Reports the finished results at the front of the queue. Waits for
+        the copy at the front when more than max_queue results are waiting,
+        or for all of them if wait is True.
+        """
+        while self.pending:
+            future, done_func = self.pending[0]
+            if (
+                future is not None
+                and not future.done()
+                and not wait
+                and len(self.pending) <= self.max_queue
+            ):
+                break
+            self.pending.popleft()
+            done_func(None if future is None else future.result())
+
+    def close(self):
+        self.retire(wait=True)
+        for executor in (self.executor, self.large_executor):
+            if executor is not None:
+                executor.shutdown()
+        self.executor = None
+        self.large_executor = None
+
+    def summary(self) -> str:
+        s = (
+            f"Summary: {self.files_checked} files checked, "
+            f"{self.files_copied} copied ({self.bytes_copied:,} bytes)"
+        )
+        if self.files_linked:
+            s += f", {self.files_linked} hardlinked"
+        if self.files_deleted:
+            s += f", {self.files_deleted} deleted"
+        if self.errors:
+            s += f", {self.errors} failed"
+        if len(self.target_roots) > 1:
+            for t, root in enumerate(self.target_roots):
+                c = self.target_counts.get(t, {})
+                s += (
+                    f"\n  {root}: {c.get('copied', 0)} copied "
+                    f"({c.get('bytes', 0):,} bytes), {c.get('deleted', 0)} "
+                    f"deleted, {c.get('failed', 0)} failed"
+                )
+        return s
+
+
+class PlanWriter(DifCopier):
+    """
+    Used in place of DifCopier to write a sync plan instead of copying. The
+    plan is a JSON Lines file with one record for each file checked (and
+    each target), with the action ('copy', 'same', or 'delete'), the reason
+    for copying, and the source size and modification time. The plan can
+    be run later with --apply.
+    """
+
+    def __init__(self, plan_file: str, hasher: Hasher | None = None):
+        super().__init__(AppOptions(), None, hasher)
+        self.plan_file = plan_file
+        self.file = Path(plan_file).open("w")  # noqa: SIM115
+
+    def make_dir(self, target_dir: Path):
+        pass
+
+    def write_record(  # noqa: PLR0913, PLR0917
+        self,
+        action: str,
+        source_file: Path,
+        target_file: Path,
+        label: str,
+        info: FileInfo,
+        reason: str,
+    ):
+        rec = {
+            "action": action,
+            "name": label,
+            "source": str(source_file),
+            "target": str(target_file),
+            "size": info.size,
+            "mtime_ns": info.mtime_ns,
+            "reason": reason,
+        }
+        self.file.write(json.dumps(rec) + "\n")
+
+    def same(
+        self, source_file: Path, target_file: Path, label: str, info: FileInfo, t=0
+    ):
+        self.write_record("same", source_file, target_file, label, info, "same")
+        say(f"  Same: {self.target_label(label, t)}")
+
+    def copy(
+        self,
+        source_file: Path,
+        targets: list[tuple[int, Path, FileInfo | None]],
+        label: str,
+        info: FileInfo,
+    ):
+        for t, target_file, target_info in targets:
+            reason = self.diff_reason(info, target_info)
+            self.write_record("copy", source_file, target_file, label, info, reason)
+            say(f"  Plan: {self.target_label(label, t)} ({reason})")
+            self.files_copied += 1
+            self.bytes_copied += info.size
+
+    def remove_part(self, part_file: Path):
+        pass
+
+    def delete(self, target_file: Path, label: str, t=0, done_func=None):
+        rec = {"action": "delete", "name": label, "target": str(target_file)}
+        self.file.write(json.dumps(rec) + "\n")
+        say(f"  Plan: delete {self.target_label(label, t)}")
+        self.files_deleted += 1
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+    def summary(self) -> str:
+        return (
+            f"Summary: {self.files_checked} files checked, "
+            f"{self.files_copied} to copy ({self.bytes_copied:,} bytes), "
+            f"{self.files_deleted} to delete. Plan written to '{self.plan_file}'."
+        )
+
+
+def apply_plan(plan_file: str, copier: DifCopier):
+    """
+    Runs the copies in a plan written by PlanWriter. The plan file is read
+    one line at a time. Consecutive records that copy the same source file
+    are run as one copy with several targets, so the source is read once.
+    A file is not copied if its size or modification time has changed
+    since the plan was made.
+    """
+    say(f"Applying plan: {plan_file}")
+    group = []
+    made_dirs = set()
+
+    def run_group():
+        rec = group[0]
+        info = FileInfo(rec["size"], rec["mtime_ns"])
+        copier.files_checked += 1
+        try:
+            st = Path(rec["source"]).stat()
+        except OSError as e:
+            complain(f"  FAILED: {rec['name']} ({e})")
+            copier.errors += 1
+            return
+        if not same_time_and_size(info, FileInfo(st.st_size, st.st_mtime_ns)):
+            complain(f"  SKIP: {rec['name']} (source changed since plan)")
+            copier.errors += 1
+            return
+        targets = []
+        for rec in group:
+            target_file = Path(rec["target"])
+            if target_file.parent not in made_dirs:
+                copier.make_dir(target_file.parent)
+                made_dirs.add(target_file.parent)
+            try:
+                st = target_file.stat()
+                target_info = FileInfo(st.st_size, st.st_mtime_ns)
+            except OSError:
+                target_info = None
+            targets.append((0, target_file, target_info))
+        copier.copy(Path(rec["source"]), targets, rec["name"], info)
+
+    with Path(plan_file).open() as f:
+        for line in f:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            if group and (
+                rec["action"] != "copy" or rec["source"] != group[0]["source"]
+            ):
+                run_group()
+                group.clear()
+            if rec["action"] == "copy":
+                group.append(rec)
+            elif rec["action"] == "delete":
+                target_file = Path(rec["target"])
+                if target_file.exists():
+                    copier.delete(target_file, rec["name"])
+        if group:
+            run_group()
+
+
+def archive_kind(archive: Path) -> str | None:
+    """
+    Returns the kind of archive for the file name ('tar', 'tgz', or 'zip'),
+    or None if it is not a supported archive name.
+    """
+    name = archive.name.lower()
+    if name.endswith(".zip"):
+        return "zip"
+    if name.endswith((".tar.gz", ".tgz")):
+        return "tgz"
+    if name.endswith(".tar"):
+        return "tar"
+    return None
+
+
+def archive_volume(archive: Path, n: int) -> Path:
+    """
+    Returns the path of volume n of a tar archive. Volume 0 is the archive
+    itself, and later volumes have a number before the suffix, such as
+    'backup.0001.tar.gz' for 'backup.tar.gz'.
+    """
+    if n == 0:
+        return archive
+    name = archive.name
+    suffix = ".tar.gz" if name.lower().endswith(".tar.gz") else archive.suffix
+    return archive.with_name(f"{name[: -len(suffix)]}.{n:04d}{suffix}")
+
+
+def archive_volumes(archive: Path) -> list[Path]:
+    """
+    Returns the existing volumes of the archive. A zip archive is updated in
+    place, so it has one volume.
+    """
+    if archive_kind(archive) == "zip":
+        return [archive] if archive.exists() else []
+    volumes = []
+    while True:
+        volume = archive_volume(archive, len(volumes))
+        if not volume.exists():
+            return volumes
+        volumes.append(volume)
+
+
+def zip_member_mtime_ns(zinfo: zipfile.ZipInfo) -> int:
+    """
+    Returns the modification time of a zip member. The extended timestamp
+    field, written by copydif (and Info-ZIP), is used if present, because
+    the standard zip date and time only have a precision of two seconds.
+    """
+    extra = zinfo.extra
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, size = struct.unpack_from("<HH", extra, pos)
+        #  The field starts with a flags byte, then the mtime if flag bit 0.
+        if header_id == ZIP_EXTENDED_TIME and size >= ZIP_TIME_FIELD.size:
+            flags, mtime = ZIP_TIME_FIELD.unpack_from(extra, pos + 4)
+            if flags & 1:
+                return mtime * NS_PER_SEC
+        pos += 4 + size
+    return int(time.mktime((*zinfo.date_time, 0, 0, -1))) * NS_PER_SEC
+
+
+def read_archive_members(archive: Path) -> dict:
+    """
+    Reads the member headers of each volume of the archive and returns a
+    dictionary mapping each member name to its FileInfo. A member in a later
+    volume (or added later to a zip archive) replaces one of the same name.
+    """
+    members = {}
+    for volume in archive_volumes(archive):
+        if archive_kind(archive) == "zip":
+            with zipfile.ZipFile(volume) as zf:
+                for zinfo in zf.infolist():
+                    if not zinfo.is_dir():
+                        members[zinfo.filename] = FileInfo(
+                            zinfo.file_size, zip_member_mtime_ns(zinfo)
+                        )
+        else:
+            with tarfile.open(volume, "r:*") as tf:
+                for member in tf:
+                    if member.isfile():
+                        members[member.name] = FileInfo(
+                            member.size, int(member.mtime * NS_PER_SEC)
+                        )
+    return members
+
+
+def archive_index_file(archive: Path) -> Path:
+    return archive.with_name(f"{archive.name}{ARCHIVE_INDEX_SUFFIX}")
+
+
+def volume_stats(volumes: list[Path]) -> dict:
+    stats = {}
+    for volume in volumes:
+        st = volume.stat()
+        stats[volume.name] = [st.st_size, st.st_mtime_ns]
+    return stats
+
+
+def load_archive_members(archive: Path) -> tuple[dict, bool]:
+    """
+    Returns the member index of the archive from its index file, if the
+    volumes have not changed since the index was saved. Otherwise the
+    archive is read, which means reading (and decompressing) all of it for
+    a compressed tar archive. Also returns whether the archive was read, in
+    which case the index file should be saved.
+    """
+    volumes = archive_volumes(archive)
+    index_file = archive_index_file(archive)
+    with contextlib.suppress(OSError, ValueError, KeyError, TypeError):
+        data = json.loads(index_file.read_text())
+        if data["volumes"] == volume_stats(volumes):
+            return {
+                name: FileInfo(size, mtime_ns)
+                for name, (size, mtime_ns) in data["members"].items()
+            }, False
+    if not volumes:
+        return {}, False
+    say(f"Reading archive index: {archive}")
+    return read_archive_members(archive), True
+
+
+def save_archive_members(archive: Path, members: dict):
+    data = {
+        "volumes": volume_stats(archive_volumes(archive)),
+        "members": {name: [info.size, info.mtime_ns] for name, info in members.items()},
+    }
+    archive_index_file(archive).write_text(json.dumps(data))
+
+
+class GzipChunkWriter:
+    """
+    File-like object that writes a gzip file made of separately compressed
+    members, one for each GZIP_CHUNK_SIZE bytes of data, so the chunks can
+    be compressed by a pool of threads (zlib releases the GIL while it
+    works). A gzip file with several members is read as one stream by the
+    gzip module, tarfile, and the gzip and tar tools.
+    """
+
+    def __init__(self, file_name: Path, level: int, jobs: int):
+        self.file = file_name.open("wb")
+        self.level = level
+        self.jobs = jobs
+        self.executor = ThreadPoolExecutor(jobs) if jobs > 1 else None
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.offset += len(data)
+        while len(self.buffer) >= GZIP_CHUNK_SIZE:
+            chunk = bytes(self.buffer[:GZIP_CHUNK_SIZE])
+            del self.buffer[:GZIP_CHUNK_SIZE]
+            self.compress(chunk)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.offset
+
+    def compress(self, chunk: bytes):
+        if self.executor is None:
+            self.file.write(gzip.compress(chunk, self.level, mtime=0))
+            return
+        self.pending.append(
+            self.executor.submit(gzip.compress, chunk, self.level, mtime=0)
+        )
+        #  Compressed chunks are written in order, keeping a few queued.
+        while self.pending and (
+            len(self.pending) > self.jobs * 2 or self.pending[0].done()
+        ):
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer:
+            self.compress(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.file.close()
+
+
+class ArchiveCopier(DifCopier):
+    """
+    Used in place of DifCopier when the target is an archive file. Files
+    are compared with the archive's member index, and changed files are
+    added as members. For a tar archive, each run that copies files writes
+    a new volume (an incremental backup), so existing volumes are never
+    rewritten. A zip archive is appended to in place. The member index is
+    saved in a file next to the archive, so the archive is not read again
+    on the next run unless it was changed by something else.
+    """
+
+    def __init__(self, archive: str, opts: AppOptions):
+        super().__init__(AppOptions(order=opts.order, stats_top=opts.stats_top))
+        self.archive = Path(archive)
+        self.kind = archive_kind(self.archive)
+        self.compress_level = opts.compress_level
+        self.compress_jobs = max(1, opts.jobs)
+        self.members, self.index_stale = load_archive_members(self.archive)
+        self.writer = None
+        self.gzip_writer = None
+
+        #  The member index is given to sync_dir as the index of each
+        #  directory in the archive, as if it had been read from the target.
+        self.index_cache = {}
+        for name, info in self.members.items():
+            parent, _, base = name.rpartition("/")
+            dir_index = self.index_cache.setdefault(self.archive / parent, {})
+            dir_index[base] = info
+
+    def make_dir(self, target_dir: Path):
+        pass
+
+    def open_writer(self):
+        if self.kind == "zip":
+            compression = zipfile.ZIP_DEFLATED if self.compress_level else 0
+            self.writer = zipfile.ZipFile(
+                self.archive,
+                "a",
+                compression=compression,
+                compresslevel=self.compress_level or None,
+            )
+            say(f"Updating archive: {self.archive}")
+            return
+        volume = archive_volume(self.archive, len(archive_volumes(self.archive)))
+        if self.kind == "tgz":
+            self.gzip_writer = GzipChunkWriter(
+                volume, self.compress_level, self.compress_jobs
+            )
+            self.writer = tarfile.open(  # noqa: SIM115
+                fileobj=self.gzip_writer, mode="w", format=tarfile.PAX_FORMAT
+            )
+        else:
+            self.writer = tarfile.open(  # noqa: SIM115
+                volume, "w", format=tarfile.PAX_FORMAT
+            )
+        say(f"Writing archive volume: {volume}")
+
+    def add_member(self, source_file: Path, arcname: str, info: FileInfo):
+        if self.writer is None:
+            self.open_writer()
+        if self.kind != "zip":
+            self.writer.add(str(source_file), arcname, recursive=False)
+            return
+        zinfo = zipfile.ZipInfo.from_file(source_file, arcname, strict_timestamps=False)
+        zinfo.compress_type = self.writer.compression
+        mtime = info.mtime_ns // NS_PER_SEC
+        if -(2**31) <= mtime < 2**31:
+            zinfo.extra = struct.pack(
+                "<HH", ZIP_EXTENDED_TIME, ZIP_TIME_FIELD.size
+            ) + ZIP_TIME_FIELD.pack(1, mtime)
+        with warnings.catch_warnings():
+            #  A changed file is added again; the last member of a name wins.
+            warnings.simplefilter("ignore", UserWarning)
+            with (
+                source_file.open("rb") as src,
+                self.writer.open(
+                    zinfo, "w", force_zip64=zinfo.file_size > ZIP64_MIN_SIZE
+                ) as dst,
+            ):
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+
+    def copy(
+        self,
+        source_file: Path,
+        targets: list[tuple[int, Path, FileInfo | None]],
+        label: str,
+        info: FileInfo,
+    ):
+        for t, target_file, _ in targets:
+            arcname = target_file.relative_to(self.archive).as_posix()
+            t0 = time.perf_counter()
+            try:
+                self.add_member(source_file, arcname, info)
+                result = self.kind
+                self.members[arcname] = info
+            except OSError as e:
+                result = e
+            timed = ([result], time.perf_counter() - t0, {})
+            self.report(label, [t], timed, info.size)
+
+    def close(self):
+        super().close()
+        if self.writer is not None:
+            self.writer.close()
+            if self.gzip_writer is not None:
+                self.gzip_writer.close()
+            self.writer = None
+            self.gzip_writer = None
+        elif not self.index_stale:
+            return
+        #  The index is saved when members were added, or when it was read
+        #  from the archive (missing or out of date), even if nothing was.
+        save_archive_members(self.archive, self.members)
+        self.index_stale = False
+
+
+class TargetDir:
+    """
+    A target directory being synced, with its index and the names of the
+    source files that are the same in the target.
+    """
+
+    def __init__(
+        self, path: Path, index: dict, ready: bool, changed: bool, partial=False
+    ):
+        self.path = path
+        self.index = index
+        self.ready = ready
+        self.changed = changed
+        #  A partial index has only the files that were asked about, so it
+        #  is not recorded in the state file.
+        self.partial = partial
+        self.same_names = set()
+        #  Number of files in the target as it was read, before copies are
+        #  added to the index. The --max-delete-percent limit is based on
+        #  this, so new copies do not count toward it.
+        self.n_read = len(index)
+
+
+def get_target(
+    copier: DifCopier, target_dir: Path, names: set | None = None
+) -> TargetDir:
+    """
+    Returns the TargetDir with the index of target_dir. The index comes from
+    the copier's index cache (list-file mode), the state file, or is read
+    from the directory, in that order. If names is given, the index has
+    only those files, which are checked one at a time (watch mode).
+    """
+    stats = copier.stats
+    if names is not None:
+        with stats.timed("target_scan"):
+            index = list_dir_stat(target_dir, names, {})
+            ready = bool(index) or target_dir.is_dir()
+        stats.target_files += len(index)
+        return TargetDir(target_dir, index, ready, False, partial=True)
+
+    cache = copier.index_cache
+    if cache is not None and target_dir in cache:
+        return TargetDir(target_dir, cache[target_dir], True, False)
+
+    state = copier.state
+    with stats.timed("target_scan"):
+        index = None if state is None else state.get_index(target_dir)
+    if index is not None:
+        target = TargetDir(target_dir, index, True, False)
+    else:
+        #  The target directory is read once, so each comparison is a
+        #  dictionary lookup instead of separate exists() and stat() calls.
+        with stats.timed("target_scan"):
+            index = scan_dir_index(target_dir)
+            exists = bool(index) or target_dir.is_dir()
+        target = scanned_target(copier, target_dir, index, exists)
+
+    if cache is not None:
+        cache[target_dir] = target.index
+    return target
+
+
+def scanned_target(
+    copier: DifCopier, target_dir: Path, index: dict, exists: bool
+) -> TargetDir:
+    """
+    Returns the TargetDir for an index that was read from target_dir. The
+    files are added to the --dedupe content index, if used.
+    """
+    copier.stats.target_files += len(index)
+    if copier.dedupe:
+        #  Files already in the target can be linked to by --dedupe.
+        copier.state.put_content(
+            [(str((target_dir / n).absolute()), info) for n, info in index.items()]
+        )
+    #  An index that was read is recorded in the state file.
+    return TargetDir(target_dir, index, exists, True)
+
+
+def list_dir_names(
+    dir_path: Path, pattern: str | None = None, subdirs: list | None = None
+) -> tuple[list[str], bool]:
+    """
+    Reads the names in a directory without getting file information (stat)
+    for each one, except on filesystems that do not give the file type
+    with each name. Returns the names of possible files (matching the
+    pattern, if given) and whether the directory exists. The names of
+    sub-directories are appended to subdirs, if given.
+    """
+    names = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if subdirs is not None:
+                        subdirs.append(entry.name)
+                    continue
+                if pattern and not fnmatch(entry.name, pattern):
+                    continue
+                names.append(entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+        return names, False
+    return names, True
+
+
+def file_info(path: Path) -> FileInfo | None:
+    """
+    Returns the FileInfo for a regular file (following symbolic links), or
+    None if it is not a regular file or cannot be read.
+    """
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return FileInfo(st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+class MetadataPipeline:
+    """
+    Reads the source and target directories for the --pipeline option. The
+    directories are read, and file information is fetched, by a pool of
+    threads through asyncio, so many requests can be in flight at once.
+    That hides the latency of each request on network filesystems (SMB,
+    NFS). Directories are read up to PIPELINE_AHEAD ahead of the compare
+    and copy stage, which runs in the event loop thread (so the copier and
+    state file are only used from that thread) and takes the directories in
+    the same order as walk_source.
+    """
+
+    def __init__(self, copier: DifCopier, concurrency: int):
+        self.copier = copier
+        self.concurrency = concurrency
+        self.executor = None
+        self.loop = None
+
+    async def call(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def stat_names(self, dir_path: Path, names: list[str]) -> dict:
+        """
+        Returns the index of the named files in the directory. File
+        information for the names is fetched concurrently, a slice of names
+        at a time, so a large directory does not create a task for each file
+        at once.
+        """
+        index = {}
+        step = self.concurrency * 4
+        for i in range(0, len(names), step):
+            chunk = names[i : i + step]
+            infos = await asyncio.gather(
+                *(self.call(file_info, dir_path / name) for name in chunk)
+            )
+            index.update(
+                (name, info) for name, info in zip(chunk, infos) if info is not None
+            )
+        return index
+
+    async def read_target(self, target_dir: Path) -> TargetDir:
+        state = self.copier.state
+        index = None if state is None else state.get_index(target_dir)
+        if index is not None:
+            return TargetDir(target_dir, index, True, False)
+        names, exists = await self.call(list_dir_names, target_dir)
+        index = await self.stat_names(target_dir, names)
+        return scanned_target(self.copier, target_dir, index, exists)
 
+    async def read_dir(
+        self, source_dir: Path, names: list[str], target_dirs: list[Path]
+    ) -> tuple[dict, list[TargetDir]]:
+        source_index, *targets = await asyncio.gather(
+            self.stat_names(source_dir, names),
+            *(self.read_target(t) for t in target_dirs),
+        )
+        return source_index, targets
 
-def write_log(text: str):
-    if log_file:
-        dt = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with Path(log_file).open("a") as f:
-            f.write(f"[{dt}] {text.strip()}\n")
+    async def walk(
+        self,
+        source_dir: Path,
+        pattern: str | None,
+        target_paths: list[Path],
+        recursive: bool,
+        queue: asyncio.Queue,
+    ):
+        """
+        Walks the source tree, in the same order as walk_source, and puts a
+        task that reads each directory (and the matching target directories)
+        on the queue. The queue is bounded, so the walk waits when it gets
+        too far ahead. None is put on the queue at the end.
+        """
+        try:
+            stack = [Path()]
+            while stack:
+                rel_dir = stack.pop()
+                dir_path = source_dir / rel_dir
+                subdirs = [] if recursive else None
+                #  The names are read here, since the sub-directory names are
+                #  needed to continue the walk. File information is fetched
+                #  by the task.
+                names, _ = await self.call(list_dir_names, dir_path, pattern, subdirs)
+                if subdirs:
+                    stack.extend(rel_dir / d for d in sorted(subdirs, reverse=True))
+                task = asyncio.ensure_future(
+                    self.read_dir(dir_path, names, [t / rel_dir for t in target_paths])
+                )
+                await queue.put((rel_dir, task))
+        except Exception:
+            await queue.put(None)
+            raise
+        await queue.put(None)
 
+    async def run(
+        self,
+        source_dir: Path,
+        pattern: str | None,
+        target_paths: list[Path],
+        recursive: bool,
+        delete_pattern: str | None,
+    ) -> bool:
+        """
+        Syncs the source tree to the targets. Returns False if no source
+        files were found.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(self.concurrency)
+        queue = asyncio.Queue(PIPELINE_AHEAD)
+        walker = asyncio.ensure_future(
+            self.walk(source_dir, pattern, target_paths, recursive, queue)
+        )
+        copier = self.copier
+        found = False
+        try:
+            while (item := await queue.get()) is not None:
+                rel_dir, task = item
+                #  In pipeline mode, the scan time is the time spent waiting
+                #  for a directory to be read.
+                with copier.stats.timed("source_scan"):
+                    source_index, targets = await task
+                copier.stats.source_files += len(source_index)
+                #  An empty source directory is still synced when deleting,
+                #  so extra files in the target are deleted.
+                if not source_index and delete_pattern is None:
+                    continue
+                found = found or bool(source_index)
+                prefix = "" if rel_dir == Path() else f"{rel_dir}{os.sep}"
+                sync_dir(
+                    copier,
+                    source_dir / rel_dir,
+                    source_index,
+                    targets,
+                    prefix,
+                    delete_pattern,
+                )
+            await walker
+        finally:
+            walker.cancel()
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None:
+                    item[1].cancel()
+            self.executor.shutdown()
+        return found
 
-def say(text: str):
+
+def ordered_names(source_index: dict, order: str) -> list[str]:
     """
-    Prints the text string, then passes it to write_log.
+    Returns the names in source_index in the order to process them: by name,
+    smallest files first, largest files first, or oldest modification time
+    first. Names are the secondary sort key, so the order is repeatable.
     """
-    print(text)
-    write_log(text)
+    if order == "small":
+        return sorted(source_index, key=lambda n: (source_index[n].size, n))
+    if order == "large":
+        return sorted(source_index, key=lambda n: (-source_index[n].size, n))
+    if order == "oldest":
+        return sorted(source_index, key=lambda n: (source_index[n].mtime_ns, n))
+    return sorted(source_index)
 
 
-def complain(text: str):
+def sync_dir(  # noqa: PLR0913, PLR0917
+    copier: DifCopier,
+    source_dir: Path,
+    source_index: dict,
+    target_dirs: list[Path],
+    prefix="",
+    delete_pattern: str | None = None,
+    names: set | None = None,
+):
     """
-    Like 'say', but prints the text string to stderr before passing
-    it to write_log.
+    Copies the files in source_index that differ from, or are not present
+    in, each of the target_dirs (given as paths, or as TargetDir objects
+    that already have their index). A target directory is created, if needed,
+    only when the first file is about to be copied into it. A file that is
+    needed by more than one target is read once for all of them.
+
+    If delete_pattern is given, files in a target directory that match the
+    pattern ('*' for all files) but are not in source_index are deleted.
+
+    If names is given, only those files are compared, and the target
+    directories are not read. The source_index then has the named files
+    that still exist in the source, and delete_pattern applies only to the
+    named files that do not.
     """
-    sys.stderr.write(f"{text}\n")
-    write_log(text)
+    targets = [
+        t if isinstance(t, TargetDir) else get_target(copier, t, names)
+        for t in target_dirs
+    ]
+
+    with copier.stats.timed("compare"):
+        for target in targets:
+            target.same_names = compare_target(copier, source_dir, source_index, target)
+
+    for target in targets:
+        remove_stale_parts(copier, source_dir, source_index, target)
+
+    for name in ordered_names(source_index, copier.order):
+        copier.files_checked += 1
+        info = source_index[name]
+        label = f"{prefix}{name}"
+        copies = []
+        for t, target in enumerate(targets):
+            if name in target.same_names:
+                copier.same(source_dir / name, target.path / name, label, info, t)
+                continue
+            if not target.ready:
+                copier.make_dir(target.path)
+                target.ready = True
+            copies.append((t, target.path / name, target.index.get(name)))
+            target.index[name] = info
+            target.changed = True
+        if copies:
+            copier.copy(source_dir / name, copies, label, info)
 
+    for t, target in enumerate(targets):
+        if delete_pattern is not None:
+            delete_extra(copier, source_index, target, t, prefix, delete_pattern)
 
-def file_time_str(secs):
-    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(secs))
+        if copier.state is not None and target.ready and target.changed:
+            index = None if target.partial else target.index
+            copier.then(partial(record_state, copier, t, target.path, index))
 
 
-def same_time_and_size(file1: Path, file2: Path):
+def remove_stale_parts(
+    copier: DifCopier, source_dir: Path, source_index: dict, target: TargetDir
+):
     """
-    Compares the file size and modified time. Returns False if either
-    does not match. Also returns False if file2 does not exist.
+    Removes partial copy and checkpoint files (from resumable_copy) in the
+    target that can no longer be resumed, because the checkpoint is missing
+    or does not match the source file, or the source file no longer exists.
+    Files for a source that exists but is not in source_index (such as one
+    that does not match the pattern) are left alone.
+    """
+    bases = {part_base_name(name) for name in target.index} - {None}
+    for base in bases:
+        info = source_index.get(base)
+        part, ckpt = part_paths(target.path / base)
+        if info is None:
+            if (source_dir / base).exists():
+                continue
+        elif read_checkpoint(ckpt, info) is not None:
+            continue
+        for file_path in (part, ckpt):
+            if target.index.pop(file_path.name, None) is not None:
+                copier.remove_part(file_path)
+                target.changed = True
 
-    Since the file modification times may have different numeric precision
-    on different operating systems, strings representing the times are
-    compared instead of comparing the floating point (st_mtime) values.
+
+def compare_target(
+    copier: DifCopier, source_dir: Path, source_index: dict, target: TargetDir
+) -> set:
     """
-    if not file2.exists():
-        return False
+    Returns the set of names in source_index that are the same in the
+    target, by time and size, or by contents if the copier has a hasher.
+    """
+    if copier.hash_all:
+        return same_contents(
+            copier.hasher, source_dir, source_index, target.path, target.index
+        )
+    same_names = {
+        name
+        for name, info in source_index.items()
+        if same_time_and_size(info, target.index.get(name))
+    }
+    if copier.dedupe:
+        #  A target file hardlinked by --dedupe has the modification time
+        #  of the file it is linked to, so files of the same size but with
+        #  different times are compared by contents.
+        rest = {k: v for k, v in source_index.items() if k not in same_names}
+        same_names |= same_contents(
+            copier.hasher, source_dir, rest, target.path, target.index
+        )
+    return same_names
 
-    info1 = file1.stat()
-    info2 = file2.stat()
-    if info1.st_size != info2.st_size:
-        return False
 
-    if file_time_str(info1.st_mtime) != file_time_str(info2.st_mtime):
-        return False
-    return True
+def delete_extra(  # noqa: PLR0913, PLR0917
+    copier: DifCopier,
+    source_index: dict,
+    target: TargetDir,
+    t: int,
+    prefix: str,
+    delete_pattern: str,
+):
+    """
+    Deletes files in the target that match delete_pattern but are not in
+    source_index, if the copier's deletion limits allow it. For a partial
+    index (watch mode), the names in the target are counted for the
+    --max-delete-percent limit.
+    """
+    #  Files to delete are the set difference of the two indexes.
+    extra = sorted(
+        name
+        for name in target.index.keys() - source_index.keys()
+        if (delete_pattern == "*" or fnmatch(name, delete_pattern))
+        and not is_part_name(name)
+    )
+    if not extra:
+        return
+    if target.partial:
+        names, _ = list_dir_names(
+            target.path, None if delete_pattern == "*" else delete_pattern
+        )
+        n_target = sum(1 for name in names if not is_part_name(name))
+    else:
+        n_target = target.n_read
+    if not copier.delete_check(target.path, len(extra), n_target):
+        return
+    for name in extra:
+        copier.delete(
+            target.path / name,
+            f"{prefix}{name}",
+            t,
+            partial(target.index.pop, name, None),
+        )
+    target.changed = True
+
+
+def record_state(
+    copier: DifCopier, t: int, target_dir: Path, target_index: dict | None
+):
+    """
+    Records the target index in the state file, if there were no failures
+    for the target. Otherwise, or if target_index is None (a partial index
+    in watch mode), the directory's record is removed.
+    """
+    if (
+        target_index is not None
+        and copier.target_counts.get(t, {}).get("failed", 0) == 0
+    ):
+        copier.state.put_index(target_dir, target_index)
+    else:
+        copier.state.forget(target_dir)
+
+
+def copy_differing_files(
+    source_spec,
+    target_dir,
+    recursive=False,
+    copier: DifCopier | None = None,
+    delete=False,
+):
+    """
+    Copies files matching source_spec that differ from those in target_dir.
+    The target_dir can be a single directory or a list of directories. If a
+    copier is not given, one is created (with a single job) and closed
+    before returning. If delete is True, files in the target that match
+    source_spec but are not in the source are deleted.
+    """
+    if copier is None:
+        copier = DifCopier()
+        try:
+            copy_differing_files(source_spec, target_dir, recursive, copier, delete)
+        finally:
+            copier.close()
+        return
 
+    if isinstance(target_dir, (str, Path)):
+        target_dir = [target_dir]
+    target_paths = [Path(t) for t in target_dir]
+    copier.target_roots = [str(t) for t in target_paths]
 
-def copy_differing_files(source_spec, target_dir):
     say(f"Source: {source_spec}")
-    say(f"Target: {target_dir}")
+    for t in target_paths:
+        say(f"Target: {t}")
 
     source_path = Path(source_spec)
 
     if source_path.is_dir():
-        source_files = [p for p in source_path.iterdir() if p.is_file()]
+        source_dir = source_path
+        pattern = None
     else:
-        source_files = [
-            p for p in source_path.parent.glob(source_path.name) if p.is_file()
-        ]
+        source_dir = source_path.parent
+        pattern = source_path.name
+
+    delete_pattern = (pattern or "*") if delete else None
 
-    if not source_files:
+    if not sync_tree(
+        copier, source_dir, pattern, target_paths, recursive, delete_pattern
+    ):
         say(f"No files found matching '{source_spec}'")
+
+
+def sync_tree(  # noqa: PLR0913, PLR0917
+    copier: DifCopier,
+    source_dir: Path,
+    pattern: str | None,
+    target_paths: list[Path],
+    recursive: bool,
+    delete_pattern: str | None,
+) -> bool:
+    """
+    Syncs the files in source_dir (and, if recursive, its sub-directories)
+    that match the pattern to the target directories. Returns False if no
+    source files were found.
+    """
+    if copier.pipeline:
+        pipeline = MetadataPipeline(copier, copier.pipeline)
+        return asyncio.run(
+            pipeline.run(source_dir, pattern, target_paths, recursive, delete_pattern)
+        )
+
+    stats = copier.stats
+    if not recursive:
+        with stats.timed("source_scan"):
+            source_index = scan_dir_index(source_dir, pattern)
+        stats.source_files += len(source_index)
+        if not source_index and delete_pattern is None:
+            return False
+        sync_dir(copier, source_dir, source_index, target_paths, "", delete_pattern)
+        return bool(source_index)
+
+    found = False
+    walk = stats.timed_iter(walk_source(source_dir, pattern), "source_scan")
+    for rel_dir, source_index in walk:
+        stats.source_files += len(source_index)
+        #  An empty source directory is still synced when deleting, so
+        #  extra files in the target are deleted.
+        if not source_index and delete_pattern is None:
+            continue
+        found = found or bool(source_index)
+        prefix = "" if rel_dir == Path() else f"{rel_dir}{os.sep}"
+        sync_dir(
+            copier,
+            source_dir / rel_dir,
+            source_index,
+            [t / rel_dir for t in target_paths],
+            prefix,
+            delete_pattern,
+        )
+    return found
+
+
+def add_change(changes: dict, rel_dir: Path, name: str | None):
+    """
+    Adds a changed file to the changes dictionary, which maps a directory
+    (relative to the source) to the set of changed names in it. A name of
+    None marks the whole directory, and its sub-directories, as changed.
+    """
+    if name is None:
+        changes[rel_dir] = None
         return
+    names = changes.setdefault(rel_dir, set())
+    if names is not None:
+        names.add(name)
+
+
+class InotifyWatcher:
+    """
+    Reports changes to files in the source tree using the Linux inotify API
+    (called through ctypes), so changes are seen as they happen without
+    reading the directories again. Raises OSError if inotify is not
+    available.
+    """
 
-    source_files.sort()
+    method = "inotify"
 
-    for source_file in source_files:
-        target_file = Path(target_dir) / source_file.name
+    def __init__(self, source_dir: Path, recursive: bool):
+        if not sys.platform.startswith("linux") or ctypes is None:
+            raise OSError("inotify is not available")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.source_dir = source_dir
+        self.recursive = recursive
+        self.dirs = {}
+        try:
+            self.add_tree(Path(), required=True)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, rel_dir: Path, required=False):
+        """
+        Adds a watch for the directory, and each of its sub-directories if
+        recursive, not following symbolic links.
+        """
+        stack = [rel_dir]
+        while stack:
+            rel = stack.pop()
+            dir_path = self.source_dir / rel
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dir_path), INOTIFY_MASK
+            )
+            if wd < 0:
+                if required:
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err), str(dir_path))
+                continue
+            required = False
+            self.dirs[wd] = rel
+            if not self.recursive:
+                continue
+            with contextlib.suppress(OSError), os.scandir(dir_path) as entries:
+                stack.extend(
+                    rel / entry.name
+                    for entry in entries
+                    if entry.is_dir(follow_symlinks=False)
+                )
+
+    def read_events(self, changes: dict, timeout: float | None) -> bool:
+        """
+        Waits up to timeout seconds (or indefinitely if None) for events, and
+        adds the changed files to changes. Returns False if the wait timed
+        out with no events.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        data = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos + INOTIFY_EVENT_SIZE <= len(data):
+            wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT_SIZE
+            name = os.fsdecode(data[pos : pos + name_len].rstrip(b"\0"))
+            pos += name_len
+            if mask & IN_Q_OVERFLOW:
+                #  Events were lost, so the whole source is compared again.
+                add_change(changes, Path(), None)
+                continue
+            rel_dir = self.dirs.get(wd)
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            if rel_dir is None or not name:
+                continue
+            if mask & IN_ISDIR:
+                #  A new (or moved in) sub-directory is watched, and all of
+                #  its files are compared. Removed directories are left in
+                #  the target, as they are when not watching.
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(rel_dir / name)
+                    add_change(changes, rel_dir / name, None)
+                continue
+            add_change(changes, rel_dir, name)
+        return True
+
+    def changes(self, debounce: float) -> dict:
+        """
+        Waits for files to change, then keeps collecting changes until there
+        have been none for debounce seconds, so a burst of changes (or the
+        many writes to one file) is handled as one batch. A batch is not
+        held for more than WATCH_MAX_DELAY times the debounce time.
+        """
+        changes = {}
+        self.read_events(changes, None)
+        deadline = time.monotonic() + debounce * WATCH_MAX_DELAY
+        while time.monotonic() < deadline and self.read_events(changes, debounce):
+            pass
+        return changes
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollWatcher:
+    """
+    Reports changes to files in the source tree by reading the directories
+    again every interval seconds and comparing the indexes with the last
+    read. This is used where inotify is not available.
+    """
+
+    method = "polling"
+
+    def __init__(
+        self, source_dir: Path, pattern: str | None, recursive: bool, interval: float
+    ):
+        self.source_dir = source_dir
+        self.pattern = pattern
+        self.recursive = recursive
+        self.interval = interval
+        self.indexes = self.scan()
+
+    def scan(self) -> dict:
+        if self.recursive:
+            return dict(walk_source(self.source_dir, self.pattern))
+        return {Path(): scan_dir_index(self.source_dir, self.pattern)}
+
+    def changes(self, debounce: float) -> dict:
+        """
+        Waits until a read of the source finds changed, new, or removed
+        files, and returns them. Changes made within one interval are
+        handled as one batch, so the debounce time is not used.
+        """
+        while True:
+            time.sleep(self.interval)
+            indexes = self.scan()
+            changes = {}
+            for rel_dir, index in indexes.items():
+                old = self.indexes.get(rel_dir, {})
+                for name in index.keys() | old.keys():
+                    if index.get(name) != old.get(name):
+                        add_change(changes, rel_dir, name)
+            self.indexes = indexes
+            if changes:
+                return changes
+
+    def close(self):
+        self.indexes = {}
+
+
+def sync_changes(  # noqa: PLR0913, PLR0917
+    copier: DifCopier,
+    source_dir: Path,
+    pattern: str | None,
+    target_paths: list[Path],
+    changes: dict,
+    recursive=False,
+    delete=False,
+):
+    """
+    Copies the changed files (from a watcher) that differ from those in the
+    target directories. Only the changed files are compared, except in
+    directories marked as changed as a whole. If delete is True, changed
+    files that no longer exist in the source are deleted from the targets.
+    Changes in directories that no longer exist in the source are ignored.
+    """
+    delete_pattern = (pattern or "*") if delete else None
+    stats = copier.stats
+
+    for rel_dir in sorted(changes):
+        dir_path = source_dir / rel_dir
+        if not dir_path.is_dir():
+            continue
+        names = changes[rel_dir]
+        if names is None:
+            if recursive:
+                walk = walk_source(dir_path, pattern)
+            else:
+                walk = [(Path(), scan_dir_index(dir_path, pattern))]
+            for sub_dir, source_index in stats.timed_iter(walk, "source_scan"):
+                stats.source_files += len(source_index)
+                rel = rel_dir / sub_dir
+                sync_dir(
+                    copier,
+                    source_dir / rel,
+                    source_index,
+                    [t / rel for t in target_paths],
+                    "" if rel == Path() else f"{rel}{os.sep}",
+                    delete_pattern,
+                )
+            continue
+
+        if pattern:
+            names = {name for name in names if fnmatch(name, pattern)}
+        if not names:
+            continue
+        with stats.timed("source_scan"):
+            source_index = list_dir_stat(dir_path, names, {})
+        stats.source_files += len(source_index)
+        sync_dir(
+            copier,
+            dir_path,
+            source_index,
+            [t / rel_dir for t in target_paths],
+            "" if rel_dir == Path() else f"{rel_dir}{os.sep}",
+            delete_pattern,
+            names,
+        )
+
+
+def watch_source(opts: AppOptions, copier: DifCopier, batches: int | None = None):
+    """
+    Copies the differing files, then watches the source for changes and
+    copies the changed files, until interrupted (Ctrl+C) or, if batches is
+    given, after that many batches of changes. The watch starts before the
+    first copy, so changes made while it runs are not missed.
+    """
+    source_path = Path(opts.source_spec)
+    if source_path.is_dir():
+        source_dir = source_path
+        pattern = None
+    else:
+        source_dir = source_path.parent
+        pattern = source_path.name
+
+    try:
+        watcher = InotifyWatcher(source_dir, opts.recursive)
+    except OSError:
+        watcher = PollWatcher(source_dir, pattern, opts.recursive, opts.watch_interval)
+
+    target_paths = [Path(t) for t in opts.target_dirs]
+    try:
+        copy_differing_files(
+            opts.source_spec, target_paths, opts.recursive, copier, opts.delete
+        )
+        copier.retire(wait=True)
+        say(f"Watching for changes ({watcher.method}). Press Ctrl+C to stop.")
+        n = 0
+        while batches is None or n < batches:
+            #  Do not leave log lines buffered while waiting for changes.
+            flush_log()
+            changes = watcher.changes(opts.debounce)
+            sync_changes(
+                copier,
+                source_dir,
+                pattern,
+                target_paths,
+                changes,
+                opts.recursive,
+                opts.delete,
+            )
+            copier.retire(wait=True)
+            n += 1
+    except KeyboardInterrupt:
+        say("Stopped watching.")
+    finally:
+        watcher.close()
+
+
+def parse_size(text: str) -> int:
+    """
+    Returns the number of bytes for a size given as a number with an
+    optional K, M, G, or T suffix (powers of 1024). Raises ValueError if
+    the text is not a valid size.
+    """
+    s = text.strip().upper().rstrip("B")
+    mult = 1
+    if s and s[-1] in SIZE_SUFFIXES:
+        mult = SIZE_SUFFIXES[s[-1]]
+        s = s[:-1]
+    n = int(float(s) * mult)
+    if n < 0:
+        raise ValueError(text)
+    return n
+
+
+def iter_list_entries(f, chunk_size: int = 64 * 1024):
+    """
+    Generator that reads entries from an open list-file without reading the
+    whole file into memory. If the first chunk read contains a NUL
+    character, entries are NUL-delimited (as from 'find -print0') and are
+    used as-is. Otherwise there is one entry per line, leading and trailing
+    whitespace is removed, and blank lines and comments (lines starting
+    with '#') are skipped.
+    """
+    sep = None
+    rest = ""
+    while True:
+        chunk = f.read(chunk_size)
+        if sep is None:
+            sep = "\0" if "\0" in chunk else "\n"
+        if not chunk:
+            break
+        parts = (rest + chunk).split(sep)
+        rest = parts.pop()
+        for part in parts:
+            entry = list_entry(part, sep)
+            if entry:
+                yield entry
+    entry = list_entry(rest, sep)
+    if entry:
+        yield entry
+
+
+def list_entry(text: str, sep: str) -> str:
+    if sep == "\0":
+        return text.rstrip("\n")
+    s = text.strip()
+    #  List-file can have comments.
+    if s.startswith("#"):
+        return ""
+    return s
 
-        if same_time_and_size(source_file, target_file):
-            say(f"  Same: {source_file.name}")
-        else:
-            say(f"  COPY: {source_file.name}")
-            #  shutil.copy2 preserves the file modification time.
-            shutil.copy2(source_file, target_file)
 
+def has_wildcard(name: str) -> bool:
+    return any(c in name for c in "*?[")
 
-def get_source_list(source_spec: str) -> list[str]:
-    assert source_spec.startswith("@")  # noqa: S101
-    file_name = source_spec.strip("@")
+
+def copy_list_files(
+    source_spec: str, target_dirs: list, recursive: bool, copier: DifCopier
+):
+    """
+    Copies the files given in a list-file (source_spec is the file name
+    prefixed with '@', or '@-' to read from stdin). Duplicate entries are
+    dropped. Entries for files and wildcard patterns are grouped by parent
+    directory, so each source directory is read once, and the target
+    index is kept for the run so each target directory is read once.
+    Entries for directories (and, with recursive, wildcard patterns) are
+    processed as they would be if given as the source_spec.
+    """
+    file_name = source_spec[1:]
     say(f"Reading list-file: {file_name}")
-    if not Path(file_name).exists():
-        complain(f"Cannot find source list file: '{file_name}'")
-        raise SystemExit
-    result = []
-    with Path(file_name).open() as f:
-        lines = f.readlines()
-    for line in lines:
-        s = line.strip()
-        #  List-file can have comments.
-        if s and not s.startswith("#"):
-            result.append(s)
-    return result
-
-
-def get_args(arglist=None):
+
+    groups = {}
+    specs = {}
+    with copier.stats.timed("list_parse"):
+        if file_name == "-":
+            entries = iter_list_entries(sys.stdin)
+            for entry in entries:
+                add_list_entry(entry, recursive, groups, specs)
+        else:
+            with Path(file_name).open(errors="surrogateescape") as f:
+                for entry in iter_list_entries(f):
+                    add_list_entry(entry, recursive, groups, specs)
+
+    target_paths = [Path(t) for t in target_dirs]
+    copier.target_roots = [str(t) for t in target_paths]
+    #  An archive target already has an index cache of its members.
+    own_cache = copier.index_cache is None
+    if own_cache:
+        copier.index_cache = {}
+    try:
+        for parent, (names, patterns) in groups.items():
+            with copier.stats.timed("source_scan"):
+                source_index = list_dir_index(parent, names, patterns, specs)
+            copier.stats.source_files += len(source_index)
+            if not source_index:
+                continue
+            say(f"Source: {parent} ({len(source_index)} files from list-file)")
+            for t in target_paths:
+                say(f"Target: {t}")
+            sync_dir(copier, parent, source_index, target_paths)
+
+        for spec in specs:
+            copy_differing_files(str(spec), target_dirs, recursive, copier)
+    finally:
+        if own_cache:
+            copier.index_cache = None
+
+
+def add_list_entry(entry: str, recursive: bool, groups: dict, specs: dict):
+    p = Path(entry)
+    wild = has_wildcard(p.name)
+    if recursive and wild:
+        specs[p] = None
+        return
+    names, patterns = groups.setdefault(p.parent, (set(), set()))
+    if wild:
+        patterns.add(p.name)
+    else:
+        names.add(p.name)
+
+
+def list_dir_index(parent: Path, names: set, patterns: set, specs: dict) -> dict:
+    """
+    Returns the index of the files in the parent directory that are named
+    in names or match any of the patterns. Names that are directories are
+    added to specs. When there are only a few names, and no patterns, each
+    file is checked with stat() instead of reading the whole directory.
+    """
+    if patterns or len(names) >= LIST_SCAN_MIN:
+        index = list_dir_scan(parent, names, patterns, specs)
+    else:
+        index = list_dir_stat(parent, names, specs)
+    for name in sorted(names - index.keys()):
+        if parent / name not in specs:
+            say(f"No files found matching '{parent / name}'")
+    return index
+
+
+def list_dir_scan(parent: Path, names: set, patterns: set, specs: dict) -> dict:
+    subdirs = []
+    dir_index = scan_dir_index(parent, None, subdirs)
+    for name in subdirs:
+        if name in names:
+            specs[parent / name] = None
+    for pat in sorted(patterns):
+        if not any(fnmatch(name, pat) for name in dir_index):
+            say(f"No files found matching '{parent / pat}'")
+    return {
+        name: info
+        for name, info in dir_index.items()
+        if name in names or any(fnmatch(name, pat) for pat in patterns)
+    }
+
+
+def list_dir_stat(parent: Path, names: set, specs: dict) -> dict:
+    index = {}
+    for name in names:
+        try:
+            st = (parent / name).stat()
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            specs[parent / name] = None
+        elif stat.S_ISREG(st.st_mode):
+            index[name] = FileInfo(st.st_size, st.st_mtime_ns, st.st_ino)
+    return index
+
+
+def get_args(arglist=None):  # noqa: PLR0912, PLR0915
     ap = argparse.ArgumentParser(
         description=(
             "Copy only files that have different sizes or modification "
@@ -126,23 +2961,302 @@ def get_args(arglist=None):
 
     ap.add_argument(
         "source_spec",
+        nargs="?",
         type=str,
         action="store",
         help="Source directory or file specification. This can be the path "
         "for a single file. It can also include a wilcard character to "
         "match multiple files ('source/path/*.txt' for example). If a "
         "directory name is given then all files in the directory are "
-        "included, but sub-directories are not. This script does not do "
-        "recursive processing of sub-directories. The source can also be "
+        "included, but sub-directories are not, unless the --recursive "
+        "option is used. The source can also be "
         "a list file (a text file with the path to a source file on each "
-        "line) if the file name is prefixed with an '@' symbol.",
+        "line) if the file name is prefixed with an '@' symbol. Use '@-' to "
+        "read the list from stdin. The list can also be NUL-delimited (such "
+        "as the output of 'find -print0').",
     )
 
     ap.add_argument(
         "target_dir",
+        nargs="*",
+        type=str,
+        action="store",
+        help="Directory to update with any changed files. More than one "
+        "target directory can be given. A changed source file is read once "
+        "and written to each target directory that needs it (except for "
+        "in-place updates with --delta-min-size, which read the source for "
+        "each target).",
+    )
+
+    ap.add_argument(
+        "-r",
+        "--recursive",
+        dest="recursive",
+        action="store_true",
+        help="Also process files in sub-directories of the source directory. "
+        "The directory structure is recreated in the target directory. If a "
+        "wildcard pattern is given, it is matched against the file names in "
+        "each sub-directory.",
+    )
+
+    ap.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        action="store",
+        help="Number of files to copy at the same time. The output is still "
+        "in the same order as for a single job. Default is 1.",
+    )
+
+    ap.add_argument(
+        "--large-jobs",
+        dest="large_jobs",
+        type=int,
+        action="store",
+        help="With --jobs, the number of files of 64M or more to copy at the "
+        "same time. These use their own threads, in addition to --jobs, so "
+        "large files do not hold up small ones. By default, large files "
+        "share the --jobs threads.",
+    )
+
+    ap.add_argument(
+        "--order",
+        dest="order",
+        choices=["name", "small", "large", "oldest"],
+        default="name",
+        action="store",
+        help="Order in which to process the files in each directory: by "
+        "name (the default), smallest first, largest first, or oldest "
+        "modification time first.",
+    )
+
+    ap.add_argument(
+        "--pipeline",
+        dest="pipeline",
+        type=int,
+        metavar="N",
+        action="store",
+        help="Read the source and target directories in an asyncio pipeline, "
+        "with up to N requests for file information in flight at once, "
+        "while earlier directories are compared and copied. This helps on "
+        "network filesystems (SMB, NFS) where each request waits on the "
+        "network. Not used with a list-file or --watch changes.",
+    )
+
+    ap.add_argument(
+        "--bwlimit",
+        dest="bwlimit",
+        type=str,
+        action="store",
+        help="Limit the total copy rate to this many bytes per second (with "
+        "a K, M, or G suffix, such as '20M'). By default, there is no limit.",
+    )
+
+    ap.add_argument(
+        "--compare",
+        dest="compare",
+        choices=["time", "hash"],
+        default="time",
+        action="store",
+        help="How to decide whether a file differs. 'time' (the default) "
+        "compares the size and modification time. 'hash' compares the size "
+        "and a hash of the contents, so files with different modification "
+        "times but the same contents are not copied. Hashes are cached in "
+        "the --state file, if one is used.",
+    )
+
+    ap.add_argument(
+        "--delta-min-size",
+        dest="delta_min_size",
+        type=str,
+        action="store",
+        help="Update existing target files of at least this size (bytes, or "
+        "with a K, M, or G suffix) in place, writing only the blocks that "
+        "differ from the source. By default, changed files are always "
+        "copied in full.",
+    )
+
+    ap.add_argument(
+        "--resume-min-size",
+        dest="resume_min_size",
+        type=str,
+        default="64M",
+        action="store",
+        help="Copy files of at least this size (bytes, or with a K, M, or G "
+        "suffix) to a temporary file in the target directory, then rename it "
+        "to the target file when complete. If the copy is interrupted, the "
+        "next run resumes from the last checkpoint. A file copied to more than "
+        "one target directory at once is not resumable, so that it is read "
+        "only once. Use 'off' to always copy directly to the target file. "
+        "Default is 64M.",
+    )
+
+    ap.add_argument(
+        "--state",
+        dest="state_file",
+        type=str,
+        action="store",
+        help="Name of a state file (SQLite database) in which to record the "
+        "contents of each target directory after it is updated. On later "
+        "runs, a target directory that has not been modified since it was "
+        "recorded is not read again. Changes to the contents of existing "
+        "target files, that do not add or remove files, may not be "
+        "detected when this option is used.",
+    )
+
+    ap.add_argument(
+        "--delete",
+        dest="delete",
+        action="store_true",
+        help="Delete files in the target directory that are not in the "
+        "source (mirror). If source_spec has a wildcard pattern, only "
+        "target files matching the pattern are deleted. Sub-directories in "
+        "the target are not removed. Cannot be used with a list-file.",
+    )
+
+    ap.add_argument(
+        "--max-delete",
+        dest="max_delete",
+        type=int,
+        action="store",
+        help="With --delete, the maximum number of files to delete in the "
+        "run. Deletions for a directory that would go over the limit are "
+        "not done. By default, there is no limit on the number of files.",
+    )
+
+    ap.add_argument(
+        "--max-delete-percent",
+        dest="max_delete_percent",
+        type=float,
+        default=50.0,
+        action="store",
+        help="With --delete, files are not deleted from a target directory "
+        "if they are more than this percentage of the files in that "
+        "directory. Default is 50.",
+    )
+
+    ap.add_argument(
+        "--dedupe",
+        dest="dedupe",
+        action="store_true",
+        help="Instead of copying a file, create a hardlink to a file already "
+        "in a target directory that has the same contents, if there is one "
+        "on the same filesystem. Target files are indexed by size, and only "
+        "files of the same size are hashed. The index is kept in the --state "
+        "file, if used, so it carries over to later runs. Existing target "
+        "files are replaced, not overwritten in place, and target files of "
+        "the same size but a different time are compared by contents. "
+        "Cannot be used with --plan or --archive.",
+    )
+
+    ap.add_argument(
+        "--plan",
+        dest="plan_file",
         type=str,
         action="store",
-        help="Directory to update with any changed files.",
+        help="Compare the files but do not copy them. Instead, write a plan "
+        "file (JSON Lines, one record per file) that can be run later using "
+        "the --apply option.",
+    )
+
+    ap.add_argument(
+        "--apply",
+        dest="apply_file",
+        type=str,
+        action="store",
+        help="Copy the files listed in a plan file created using the --plan "
+        "option. The source_spec and target_dir arguments are not used. A "
+        "file is skipped if it has changed since the plan was created.",
+    )
+
+    ap.add_argument(
+        "--watch",
+        dest="watch",
+        action="store_true",
+        help="After copying, keep watching the source for changes and copy "
+        "each changed file (or, with --delete, delete it from the target) "
+        "until stopped with Ctrl+C. Uses inotify on Linux, otherwise reads "
+        "the source again every --watch-interval seconds. Only the changed "
+        "files are compared. Cannot be used with a list-file, --plan, or "
+        "--apply.",
+    )
+
+    ap.add_argument(
+        "--watch-interval",
+        dest="watch_interval",
+        type=float,
+        default=2.0,
+        action="store",
+        help="With --watch, the number of seconds between reads of the "
+        "source when inotify is not available. Default is 2.",
+    )
+
+    ap.add_argument(
+        "--debounce",
+        dest="debounce",
+        type=float,
+        default=0.5,
+        action="store",
+        help="With --watch, wait until there have been no changes for this "
+        "many seconds before copying, so a burst of changes is copied as "
+        "one batch. Default is 0.5.",
+    )
+
+    ap.add_argument(
+        "--archive",
+        dest="archive",
+        action="store_true",
+        help="The target is an archive file (.tar, .tar.gz, .tgz, or .zip), "
+        "which is created if it does not exist, instead of a directory. Files "
+        "that differ from the archive's members are added to it: as a new "
+        "volume (such as 'name.0001.tar') for a tar archive, or appended to a "
+        "zip archive. The member index is kept in a '.copydif-index' file "
+        "next to the archive. Cannot be used with more than one target, "
+        "--delete, --watch, --plan, --apply, or --compare=hash.",
+    )
+
+    ap.add_argument(
+        "--compress-level",
+        dest="compress_level",
+        type=int,
+        choices=range(10),
+        default=6,
+        metavar="N",
+        action="store",
+        help="With --archive, the compression level (0 to 9) for a .tar.gz, "
+        ".tgz, or .zip archive. A .tar.gz archive is compressed by --jobs "
+        "threads. Use 0 to store zip members without compression. Default "
+        "is 6.",
+    )
+
+    ap.add_argument(
+        "--stats",
+        dest="stats",
+        action="store_true",
+        help="After the summary, show statistics for the run: files scanned, "
+        "copied, and deleted, bytes copied, throughput, the time spent in "
+        "each phase (list-file parsing, source scan, target scan, compare, "
+        "and copy), and the slowest copies.",
+    )
+
+    ap.add_argument(
+        "--stats-json",
+        dest="stats_json",
+        type=str,
+        action="store",
+        help="Write the statistics for the run to this file as JSON.",
+    )
+
+    ap.add_argument(
+        "--stats-top",
+        dest="stats_top",
+        type=int,
+        default=10,
+        action="store",
+        help="Number of the slowest copies to include in the statistics. "
+        "Default is 10.",
     )
 
     ap.add_argument(
@@ -154,8 +3268,69 @@ def get_args(arglist=None):
         "default, there is no log file.",
     )
 
+    ap.add_argument(
+        "--log-thread",
+        dest="log_thread",
+        action="store_true",
+        help="Write the log file from a background thread.",
+    )
+
     args = ap.parse_args(arglist)
 
+    if args.apply_file:
+        if args.source_spec or args.plan_file:
+            ap.error("--apply cannot be used with source_spec or --plan")
+        if not Path(args.apply_file).is_file():
+            ap.error(f"cannot find plan file '{args.apply_file}'")
+    elif not (args.source_spec and args.target_dir):
+        ap.error("the following arguments are required: source_spec, target_dir")
+
+    if args.delete and str(args.source_spec).startswith("@"):
+        ap.error("--delete cannot be used with a list-file")
+
+    if args.watch and (
+        args.plan_file or args.apply_file or str(args.source_spec).startswith("@")
+    ):
+        ap.error("--watch cannot be used with a list-file, --plan, or --apply")
+
+    if args.watch_interval <= 0 or args.debounce < 0:
+        ap.error("--watch-interval must be above 0 and --debounce at least 0")
+
+    if args.dedupe and (args.plan_file or args.archive):
+        ap.error("--dedupe cannot be used with --plan or --archive")
+
+    if args.jobs < 1:
+        ap.error("--jobs must be at least 1")
+
+    if args.pipeline is not None and args.pipeline < 1:
+        ap.error("--pipeline must be at least 1")
+
+    if args.large_jobs is not None and args.large_jobs < 1:
+        ap.error("--large-jobs must be at least 1")
+
+    bwlimit = None
+    if args.bwlimit is not None:
+        try:
+            bwlimit = parse_size(args.bwlimit)
+        except ValueError:
+            bwlimit = 0
+        if bwlimit < 1:
+            ap.error(f"invalid rate for --bwlimit: '{args.bwlimit}'")
+
+    resume_min_size = None
+    if args.resume_min_size.lower() != "off":
+        try:
+            resume_min_size = parse_size(args.resume_min_size)
+        except ValueError:
+            ap.error(f"invalid size for --resume-min-size: '{args.resume_min_size}'")
+
+    delta_min_size = None
+    if args.delta_min_size is not None:
+        try:
+            delta_min_size = parse_size(args.delta_min_size)
+        except ValueError:
+            ap.error(f"invalid size for --delta-min-size: '{args.delta_min_size}'")
+
     if args.log_file:
         log_path = Path(args.log_file)
         if log_path.exists() and not log_path.is_file():
@@ -170,42 +3345,143 @@ def get_args(arglist=None):
         log_path = None
 
     if log_path:
-        global log_file  # noqa: PLW0603
-        log_file = str(log_path)
+        close_log()
+        global log_writer  # noqa: PLW0603
+        log_writer = LogWriter(str(log_path), args.log_thread)
 
     source_spec = args.source_spec
 
-    if str(source_spec).startswith("@"):
-        source_list = get_source_list(source_spec)
-    else:
-        source_list = None
+    if str(source_spec).startswith("@") and source_spec != "@-":
+        file_name = source_spec[1:]
+        if not Path(file_name).exists():
+            complain(f"Cannot find source list file: '{file_name}'")
+            raise SystemExit
+
+    target_dirs = args.target_dir
+    if args.archive:
+        check_archive_args(ap, args)
+        target_dirs = []
+    for target_dir in target_dirs:
+        p = Path(target_dir)
+        if not p.exists():
+            complain(f"Cannot find target '{p}'")
+            raise SystemExit
+        if not p.is_dir():
+            complain(f"Target must be a directory: '{p}'")
+            raise SystemExit
+
+    return AppOptions(
+        source_spec=source_spec,
+        target_dirs=args.target_dir,
+        recursive=args.recursive,
+        jobs=args.jobs,
+        state_file=args.state_file,
+        compare=args.compare,
+        delta_min_size=delta_min_size,
+        resume_min_size=resume_min_size,
+        bwlimit=bwlimit,
+        order=args.order,
+        large_jobs=args.large_jobs,
+        pipeline=args.pipeline,
+        plan_file=args.plan_file,
+        apply_file=args.apply_file,
+        delete=args.delete,
+        max_delete=args.max_delete,
+        max_delete_percent=args.max_delete_percent,
+        dedupe=args.dedupe,
+        watch=args.watch,
+        archive=args.archive,
+        compress_level=args.compress_level,
+        stats=args.stats,
+        stats_json=args.stats_json,
+        stats_top=args.stats_top,
+        watch_interval=args.watch_interval,
+        debounce=args.debounce,
+    )
 
-    target_dir = args.target_dir
-    p = Path(target_dir)
-    if not p.exists():
-        complain(f"Cannot find target '{p}'")
-        raise SystemExit
-    if not p.is_dir():
-        complain(f"Target must be a directory: '{p}'")
-        raise SystemExit
 
-    return (source_spec, target_dir, source_list)
+def check_archive_args(ap: argparse.ArgumentParser, args: argparse.Namespace):
+    if (
+        len(args.target_dir) != 1
+        or args.delete
+        or args.watch
+        or args.plan_file
+        or args.apply_file
+        or args.compare == "hash"
+    ):
+        ap.error(
+            "--archive needs one target, and cannot be used with --delete, "
+            "--watch, --plan, --apply, or --compare=hash"
+        )
+    archive = Path(args.target_dir[0])
+    if archive_kind(archive) is None:
+        ap.error(f"archive must be a .tar, .tar.gz, .tgz, or .zip file: '{archive}'")
+    if not archive.parent.is_dir():
+        ap.error(f"cannot find directory for archive: '{archive.parent}'")
+    if archive.exists() and not archive.is_file():
+        ap.error(f"archive is not a file: '{archive}'")
 
 
 def main(arglist=None):
     print(f"\n{app_title}\n")
 
-    source_spec, target_dir, source_list = get_args(arglist)
+    opts = get_args(arglist)
+
+    global rate_limiter  # noqa: PLW0603
+    rate_limiter = None if opts.bwlimit is None else TokenBucket(opts.bwlimit)
+    try:
+        return run(opts)
+    finally:
+        rate_limiter = None
+        close_log()
 
+
+def run(opts: AppOptions) -> int:
     write_log(app_title)
 
-    if source_list is None:
-        copy_differing_files(source_spec, target_dir)
+    state = None if opts.state_file is None else SyncState(opts.state_file)
+    if opts.dedupe and state is None:
+        #  Without a state file, the content index is kept for this run.
+        state = SyncState(":memory:")
+    use_hasher = opts.compare == "hash" or opts.dedupe
+    hasher = Hasher(opts.jobs, state) if use_hasher else None
+    if opts.plan_file:
+        copier = PlanWriter(opts.plan_file, hasher)
+    elif opts.archive:
+        copier = ArchiveCopier(opts.target_dirs[0], opts)
     else:
-        for item in source_list:
-            copy_differing_files(item, target_dir)
+        copier = DifCopier(opts, state, hasher)
+    try:
+        if opts.apply_file:
+            apply_plan(opts.apply_file, copier)
+        elif opts.watch:
+            watch_source(opts, copier)
+        elif opts.source_spec.startswith("@"):
+            copy_list_files(opts.source_spec, opts.target_dirs, opts.recursive, copier)
+        else:
+            copy_differing_files(
+                opts.source_spec, opts.target_dirs, opts.recursive, copier, opts.delete
+            )
+    finally:
+        copier.close()
+        if hasher is not None:
+            hasher.close()
+        if state is not None:
+            state.close()
+
+    say(copier.summary())
+    report_stats(opts, copier)
+
+    return 1 if copier.errors else 0
+
 
-    return 0
+def report_stats(opts: AppOptions, copier: DifCopier):
+    if opts.stats:
+        say(copier.stats.report(copier))
+    if opts.stats_json:
+        with Path(opts.stats_json).open("w") as f:
+            json.dump(copier.stats.as_dict(copier), f, indent=2)
+            f.write("\n")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import json
+
+import bench_copydif
+
+
+def test_bench_saves_and_compares_baseline(tmp_path, capsys):
+    baseline = tmp_path / "baseline.json"
+    args = [
+        "tiny_files",
+        "mostly_changed",
+        "--scale=0.01",
+        "--repeat=1",
+        f"--baseline={baseline}",
+        f"--work-dir={tmp_path}",
+    ]
+
+    assert bench_copydif.main([*args, "--save-baseline"]) == 0
+    saved = json.loads(baseline.read_text())
+    tiny = saved["scenarios"]["tiny_files"]
+    assert tiny["files_copied"] == 20
+    assert tiny["os_calls"]["scandir"] >= 1
+    assert saved["scenarios"]["mostly_changed"]["files_copied"] == 18
+
+    #  With a very large tolerance, the second run does not regress.
+    assert bench_copydif.main([*args, "--tolerance=1000"]) == 0
+    assert "No regressions" in capsys.readouterr().out
+
+
+def test_compare_results_reports_regressions():
+    baseline = {
+        "python": "3.12.0",
+        "scenarios": {
+            "tiny_files": {
+                "scale": 1.0,
+                "function_seconds": 1.0,
+                "main_seconds": 1.0,
+                "os_calls": {"stat": 100},
+            }
+        },
+    }
+    results = {
+        "python": "3.12.0",
+        "scenarios": {
+            "tiny_files": {
+                "scale": 1.0,
+                "function_seconds": 1.2,
+                "main_seconds": 2.0,
+                "os_calls": {"stat": 200},
+            }
+        },
+    }
+
+    regressions = bench_copydif.compare_results(results, baseline, 0.5)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("tiny_files: main_seconds 2 ")
+
+    #  Calls are not compared with a baseline from another version.
+    results["python"] = "3.13.0"
+    assert len(bench_copydif.compare_results(results, baseline, 0.5)) == 1
+
+    #  Results for another scale are not compared.
+    results["scenarios"]["tiny_files"]["scale"] = 2.0
+    assert bench_copydif.compare_results(results, baseline, 0.5) == []
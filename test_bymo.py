@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import os
-from datetime import datetime, timedelta
+import struct
+import zlib
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 import pytest
@@ -19,6 +21,7 @@ def make_test_file(
     assert f.stat().st_mtime == time_stamp
     return f
 
+
 @pytest.fixture()
 def tmp_dir_with_test_files(tmp_path: Path) -> tuple[Path, list[Path]]:
     base_dt = datetime.fromisoformat("2022-02-14")
@@ -216,3 +219,382 @@ def test_by_year_option(tmp_dir_with_test_files):
 
     # All files were moved to the year directories.
     assert all(f.exists() for f in targets)
+
+
+def test_buckets_precompute_boundaries(monkeypatch):
+    bucket = bymo.Buckets()
+    jan = datetime.fromisoformat("2022-01-10").timestamp()
+    mar = datetime.fromisoformat("2022-03-20").timestamp()
+    bucket.prepare(jan, mar)
+    assert bucket.names == ["2022_01", "2022_02", "2022_03"]
+
+    #  Naming a file in the prepared range does not build a datetime.
+    monkeypatch.setattr(bymo, "datetime", None)
+    noon = datetime.fromisoformat("2022-02-14 12:00").timestamp()
+    for minutes in range(100):
+        assert bucket.name(noon + minutes * 60) == "2022_02"
+
+    #  The last and first seconds of a month are in different buckets.
+    end_of_jan = datetime.fromisoformat("2022-01-31 23:59:59").timestamp()
+    assert bucket.name(end_of_jan) == "2022_01"
+    assert bucket.name(end_of_jan + 1) == "2022_02"
+
+    #  The range is extended for dates outside of it.
+    monkeypatch.undo()
+    assert bucket.name(datetime.fromisoformat("2021-12-31").timestamp()) == "2021_12"
+    assert bucket.name(datetime.fromisoformat("2022-05-01").timestamp()) == "2022_05"
+    assert bucket.names[0] == "2021_12"
+    assert bucket.names[-1] == "2022_05"
+
+
+@pytest.mark.parametrize(
+    ("granularity", "nested", "expected"),
+    [
+        ("year", False, "2022"),
+        ("quarter", False, "2022_Q1"),
+        ("month", False, "2022_02"),
+        ("week", False, "2022_W07"),
+        ("day", False, "2022_02_14"),
+        ("quarter", True, str(Path("2022", "Q1"))),
+        ("day", True, str(Path("2022", "02", "14"))),
+    ],
+)
+def test_bucket_granularities(granularity, nested, expected):
+    bucket = bymo.Buckets(granularity, nested)
+    ts = datetime.fromisoformat("2022-02-14 18:30").timestamp()
+    assert bucket.name(ts) == expected
+    assert bucket.is_bucket(Path(expected).parts[0])
+
+
+@pytest.mark.parametrize("granularity", list(bymo.GRANULARITIES))
+def test_buckets_at_range_edges(granularity):
+    #  The buckets for the first and last years datetime can represent
+    #  have no neighbor to step to, which must not raise.
+    last = datetime.fromisoformat("9999-12-31 10:00").timestamp()
+    first = datetime.fromisoformat("0001-01-02 10:00").timestamp()
+    assert bymo.Buckets(granularity).name(last).startswith("9999")
+    assert bymo.Buckets(granularity).name(first).startswith("0001")
+    #  A timestamp that is not a date at all has no bucket.
+    assert bymo.Buckets(granularity).name(first - 400 * 86400) is None
+
+
+def test_buckets_refuse_wide_range():
+    bucket = bymo.Buckets("day")
+    bad = datetime.fromisoformat("0001-01-02 10:00").timestamp()
+    good = datetime.fromisoformat("2022-02-14 18:30").timestamp()
+    #  A single bad date in a batch does not build 700K+ buckets.
+    bucket.prepare(bad, good, 2)
+    assert bucket.names == []
+    assert bucket.name(bad) == "0001_01_02"
+    assert bucket.name(good) == "2022_02_14"
+    assert len(bucket.names) <= bymo.MIN_PRECOMPUTE
+
+
+def test_iso_week_at_year_end():
+    bucket = bymo.Buckets("week")
+    #  2021-01-03 is a Sunday, in the last ISO week of 2020.
+    assert bucket.name(datetime.fromisoformat("2021-01-03").timestamp()) == "2020_W53"
+    assert bucket.name(datetime.fromisoformat("2021-01-04").timestamp()) == "2021_W01"
+
+
+def test_nested_day_buckets(tmp_dir_with_test_files):
+    d, files = tmp_dir_with_test_files
+    os.chdir(d)
+
+    assert bymo.main(["-m", "--bucket", "day", "--nested"]) == 0
+    for f in files:
+        assert not f.exists()
+    assert (d / "2022" / "02" / "14" / "file-1.txt").exists()
+
+
+def test_iter_moves_single_pass(tmp_dir_with_test_files):
+    d, files = tmp_dir_with_test_files
+    (d / "sub.txt").mkdir()
+    (d / "with space.txt").write_text("x")
+
+    bucket = bymo.Buckets()
+    moves = list(bymo.iter_moves(d, ["*.txt", "*.opt"], bucket, False))
+
+    #  Directories are not moved, even if they match.
+    assert sorted(m.src for m in moves) == [
+        "file-1.txt",
+        "file-3.opt",
+        "file-4.txt",
+        "with space.txt",
+    ]
+    assert {mo_dir(f) for f in files if f.suffix != ".ini"} <= {
+        m.dst_dir for m in moves
+    }
+    assert Path(mo_dir(d / "with space.txt"), "with_space.txt") in {
+        m.dst for m in moves
+    }
+
+
+def test_move_executor_renames_on_same_device(tmp_dir_with_test_files, monkeypatch):
+    d, files = tmp_dir_with_test_files
+    targets = [Path(d / mo_dir(f) / f.name) for f in files]
+    os.chdir(d)
+
+    def no_shutil_move(*args):
+        raise AssertionError("shutil.move should not be used on the same device")
+
+    monkeypatch.setattr(bymo.shutil, "move", no_shutil_move)
+
+    assert bymo.main(["-m"]) == 0
+    assert all(not f.exists() for f in files)
+    assert all(t.exists() for t in targets)
+
+
+def test_move_executor_copies_across_devices(tmp_path, capsys):
+    d = tmp_path / "files"
+    d.mkdir()
+    ts = datetime.fromisoformat("2022-02-14").timestamp()
+    files = [make_test_file(d, f"file-{n}.txt", ts) for n in range(10)]
+    moves = list(bymo.iter_moves(d, None, bymo.Buckets(), False))
+    os.chdir(d)
+
+    mover = bymo.MoveExecutor(d, jobs=2)
+    #  Pretend the sub-directory is on another device (a mount point).
+    (d / "2022_02").mkdir()
+    mover.dirs["2022_02"] = False
+    for mv in sorted(moves):
+        mover.move(mv)
+    mover.close()
+
+    assert mover.errors == 0
+    assert mover.executor is None
+    assert all(not f.exists() for f in files)
+    assert all((d / "2022_02" / f.name).exists() for f in files)
+
+    #  Results are reported in the order the moves were queued.
+    out = capsys.readouterr().out
+    moved = [ln.split('"')[1] for ln in out.splitlines() if ln.startswith("Move ")]
+    assert moved == sorted(f.name for f in files)
+    assert out.count("(moved)") == len(files)
+
+
+def test_move_executor_reports_failures(tmp_dir_with_test_files, capsys):
+    d, files = tmp_dir_with_test_files
+    targets = [Path(d / mo_dir(f) / f.name) for f in files]
+    os.chdir(d)
+    moves = list(bymo.iter_moves(d, None, bymo.Buckets(), False))
+    files[0].unlink()
+
+    mover = bymo.MoveExecutor(d)
+    for mv in moves:
+        mover.move(mv)
+    mover.close()
+
+    assert mover.errors == 1
+    assert "(FAILED:" in capsys.readouterr().out
+    assert not targets[0].exists()
+    assert all(t.exists() for t in targets[1:])
+
+
+def test_recursive_moves_files_in_sub_directories(tmp_dir_with_test_files):
+    d, files = tmp_dir_with_test_files
+    sub = d / "sub" / "deeper"
+    sub.mkdir(parents=True)
+    ts = datetime.fromisoformat("2021-06-01").timestamp()
+    sub_file = make_test_file(sub, "file-5.txt", ts)
+    #  A sub-directory with a bucket name (from an earlier run) is skipped.
+    done = d / "2020_01"
+    done.mkdir()
+    done_file = make_test_file(done, "file-6.txt", ts)
+    targets = [Path(d / mo_dir(f) / f.name) for f in files]
+    sub_target = sub / mo_dir(sub_file) / sub_file.name
+    os.chdir(d)
+
+    assert bymo.main(["-m", "-r"]) == 0
+    assert all(t.exists() for t in targets)
+    assert sub_target.exists()
+    assert done_file.exists()
+
+
+def test_iter_moves_streams_plan(tmp_dir_with_test_files, capsys):
+    d, files = tmp_dir_with_test_files
+    sub = d / "sub"
+    sub.mkdir()
+    make_test_file(sub, "file-5.txt", files[0].stat().st_mtime)
+    bucket = bymo.Buckets()
+
+    moves = bymo.iter_moves(d, None, bucket, False, recursive=True)
+    first = next(moves)
+    assert "sub" not in first.src
+    rest = list(moves)
+    assert len(rest) == len(files)
+    assert rest[-1].src == str(Path("sub", "file-5.txt"))
+    assert rest[-1].dst_dir == str(Path("sub", mo_dir(files[0])))
+
+    bymo.print_moves(bymo.iter_moves(d, None, bucket, False, recursive=True))
+    lines = capsys.readouterr().out.splitlines()
+    #  Five moves to four sub-directories.
+    assert len(lines) == 5 + 4
+    #  Each mkdir comes right before the first move into the directory.
+    assert lines[0].startswith("mkdir ")
+    assert lines[1].startswith("mv ")
+
+
+def test_buckets_is_bucket():
+    assert bymo.Buckets().is_bucket("2022_02")
+    assert not bymo.Buckets().is_bucket("2022")
+    assert bymo.Buckets("year").is_bucket("2022")
+    assert not bymo.Buckets("year").is_bucket("photos")
+
+
+def exif_tiff(date_text: str) -> bytes:
+    """Returns little-endian TIFF data with DateTimeOriginal in an EXIF IFD."""
+    value = date_text.encode("ascii") + b"\x00"
+    #  Header (8), IFD0 with one entry (18), EXIF IFD with one entry (18).
+    exif_ifd = 8 + 18
+    text_offset = exif_ifd + 18
+    ifd0 = struct.pack("<HHHII", 1, 0x8769, 4, 1, exif_ifd) + b"\x00" * 4
+    ifd1 = struct.pack("<HHHII", 1, 0x9003, 2, len(value), text_offset)
+    return b"II*\x00" + struct.pack("<I", 8) + ifd0 + ifd1 + b"\x00" * 4 + value
+
+
+def make_jpeg(file_path: Path, date_text: str):
+    app1 = b"Exif\x00\x00" + exif_tiff(date_text)
+    file_path.write_bytes(
+        b"\xff\xd8\xff\xe1"
+        + struct.pack(">H", len(app1) + 2)
+        + app1
+        + b"\xff\xda\x00\x02"
+        + b"\x00" * 100
+    )
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(kind + data)
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", crc)
+
+
+def make_png(file_path: Path, text: str):
+    file_path.write_bytes(
+        b"\x89PNG\r\n\x1a\n"
+        + png_chunk(b"IHDR", b"\x00" * 13)
+        + png_chunk(b"tEXt", b"Creation Time\x00" + text.encode("latin-1"))
+        + png_chunk(b"IDAT", b"\x00" * 10)
+        + png_chunk(b"IEND", b"")
+    )
+
+
+def make_mp4(file_path: Path, created: datetime):
+    seconds = int((created - datetime(1904, 1, 1, tzinfo=timezone.utc)).total_seconds())
+    mvhd_data = b"\x00\x00\x00\x00" + struct.pack(">II", seconds, seconds)
+    mvhd = struct.pack(">I4s", 8 + len(mvhd_data), b"mvhd") + mvhd_data
+    moov = struct.pack(">I4s", 8 + len(mvhd), b"moov") + mvhd
+    #  The movie box comes after the media data, as written by most cameras.
+    mdat = struct.pack(">I4s", 8 + 5000, b"mdat") + b"\x00" * 5000
+    ftyp = struct.pack(">I4s", 16, b"ftyp") + b"isom\x00\x00\x02\x00"
+    file_path.write_bytes(ftyp + mdat + moov)
+
+
+def test_read_capture_time(tmp_path):
+    jpg = tmp_path / "a.jpg"
+    make_jpeg(jpg, "2019:07:04 12:30:00")
+    assert bymo.read_capture_time(str(jpg)) == datetime(2019, 7, 4, 12, 30).timestamp()
+
+    png = tmp_path / "b.png"
+    make_png(png, "2018-03-01T08:00:00")
+    assert bymo.read_capture_time(str(png)) == datetime(2018, 3, 1, 8).timestamp()
+
+    created = datetime(2017, 5, 6, 7, 8, 9, tzinfo=timezone.utc)
+    mp4 = tmp_path / "c.mp4"
+    make_mp4(mp4, created)
+    assert bymo.read_capture_time(str(mp4)) == created.timestamp()
+
+    other = tmp_path / "d.jpg"
+    other.write_bytes(b"not a jpeg")
+    assert bymo.read_capture_time(str(other)) is None
+
+
+@pytest.mark.parametrize(
+    "date_text", ["9999:12:31 10:00:00", "0001:01:01 00:00:00", "1850:01:01 00:00:00"]
+)
+def test_implausible_capture_dates_are_ignored(tmp_path, date_text):
+    jpg = tmp_path / "a.jpg"
+    make_jpeg(jpg, date_text)
+    assert bymo.read_capture_time(str(jpg)) is None
+
+    mp4 = tmp_path / "b.mp4"
+    make_mp4(mp4, datetime.now(timezone.utc) + timedelta(days=365))
+    assert bymo.read_capture_time(str(mp4)) is None
+
+    #  With 'auto', the modification time is used instead.
+    dates = bymo.DateReader("auto", ":memory:")
+    try:
+        moves = list(
+            bymo.iter_moves(tmp_path, ["*.jpg"], bymo.Buckets(), False, dates=dates)
+        )
+    finally:
+        dates.close()
+    assert [mv.dst_dir for mv in moves] == [mo_dir(jpg)]
+
+
+def test_date_reader_caches_dates(tmp_path, monkeypatch):
+    d = tmp_path / "files"
+    d.mkdir()
+    make_jpeg(d / "a.jpg", "2019:07:04 12:30:00")
+    (d / "b.jpg").write_bytes(b"no exif")
+    make_test_file(d, "c.txt", datetime.fromisoformat("2022-02-14").timestamp())
+    cache = tmp_path / "cache" / "dates.sqlite"
+    bucket = bymo.Buckets()
+
+    parsed = []
+
+    def counting_read(file_path):
+        parsed.append(Path(file_path).name)
+        return real_read(file_path)
+
+    real_read = bymo.read_capture_time
+    monkeypatch.setattr(bymo, "read_capture_time", counting_read)
+
+    def plan(source):
+        dates = bymo.DateReader(source, cache)
+        try:
+            return {
+                mv.src: mv.dst_dir
+                for mv in bymo.iter_moves(d, None, bucket, False, dates=dates)
+            }
+        finally:
+            dates.close()
+
+    assert plan("exif") == {"a.jpg": "2019_07"}
+    assert sorted(parsed) == ["a.jpg", "b.jpg"]
+
+    #  Files are not parsed again, including those without a capture date.
+    assert plan("auto") == {
+        "a.jpg": "2019_07",
+        "b.jpg": mo_dir(d / "b.jpg"),
+        "c.txt": "2022_02",
+    }
+    assert len(parsed) == 2
+
+
+def test_move_by_capture_date(tmp_path):
+    d = tmp_path / "files"
+    d.mkdir()
+    make_jpeg(d / "a.jpg", "2019:07:04 12:30:00")
+    os.chdir(d)
+
+    args = ["-m", "--date-source", "exif", "--date-cache", str(tmp_path / "c.db")]
+    assert bymo.main(args) == 0
+    assert (d / "2019_07" / "a.jpg").exists()
+
+
+def test_date_reader_parses_in_pool(tmp_path):
+    d = tmp_path / "files"
+    d.mkdir()
+    for n in range(bymo.PARSE_POOL_MIN + 4):
+        make_jpeg(d / f"{n}.jpg", f"2019:07:{n + 1:02d} 12:00:00")
+    bucket = bymo.Buckets()
+
+    dates = bymo.DateReader("exif", ":memory:", jobs=2)
+    try:
+        moves = list(bymo.iter_moves(d, None, bucket, False, dates=dates))
+        assert dates.executor is not None
+    finally:
+        dates.close()
+    assert len(moves) == bymo.PARSE_POOL_MIN + 4
+    assert all(mv.dst_dir == "2019_07" for mv in moves)
@@ -1,7 +1,17 @@
 from __future__ import annotations
 
+import asyncio
+import errno
+import gzip
+import io
+import json
 import os
+import re
 import shutil
+import tarfile
+import threading
+import time
+import zipfile
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Tuple
@@ -281,3 +291,1077 @@ def test_source_only_has_dir(source_3files_and_target, capsys):
 
     assert result == 0
     assert "No files found matching" in captured.out
+
+
+def test_same_time_ignores_fractional_seconds(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+
+    for file in list(source_path.glob("*")):
+        shutil.copy2(file, target_path.joinpath(file.name))
+
+    #  Target file time differs only by a fraction of a second.
+    t = target_path / "file1.txt"
+    ns = t.stat().st_mtime_ns + 250_000_000
+    os.utime(t, ns=(ns, ns))
+
+    args = [str(source_path), str(target_path)]
+    result = copydif.main(args)
+
+    captured = capsys.readouterr()
+
+    assert result == 0
+    assert captured.out.count("Same:") == 3
+    assert captured.out.count("COPY:") == 0
+
+
+def test_recursive_copies_sub_directories(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+
+    sub_path = source_path / "sub" / "deeper"
+    sub_path.mkdir(parents=True)
+    (sub_path / "file4.txt").write_text("file4")
+
+    args = [str(source_path), str(target_path), "--recursive"]
+    result = copydif.main(args)
+
+    captured = capsys.readouterr()
+
+    assert result == 0
+    assert captured.out.count("COPY:") == 4
+    assert (target_path / "sub" / "deeper" / "file4.txt").exists()
+
+    #  A second run finds nothing to copy.
+    result = copydif.main(args)
+    captured = capsys.readouterr()
+    assert captured.out.count("Same:") == 4
+    assert captured.out.count("COPY:") == 0
+
+
+def test_not_recursive_by_default(source_3files_and_target):
+    source_path, target_path = source_3files_and_target
+
+    sub_path = source_path / "sub"
+    sub_path.mkdir()
+    (sub_path / "file4.txt").write_text("file4")
+
+    args = [str(source_path), str(target_path)]
+    result = copydif.main(args)
+
+    assert result == 0
+    assert not (target_path / "sub").exists()
+
+
+def test_jobs_output_in_order(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+
+    #  Make file2 the same in the target so output mixes Same and COPY.
+    shutil.copy2(source_path / "file2.csv", target_path / "file2.csv")
+
+    args = [str(source_path), str(target_path), "--jobs", "4"]
+    result = copydif.main(args)
+
+    captured = capsys.readouterr()
+
+    assert result == 0
+    assert len(list(target_path.glob("*"))) == 3
+    lines = [
+        s.split(" (")[0].strip()
+        for s in captured.out.splitlines()
+        if s.startswith("  ")
+    ]
+    assert lines == [
+        "COPY: file1.txt",
+        "Same: file2.csv",
+        "COPY: file3.dat",
+    ]
+    assert "Summary: 3 files checked, 2 copied" in captured.out
+
+
+@pytest.mark.parametrize("size", [0, 5, 3 * 1024 * 1024 + 7])
+def test_copy_file_preserves_contents_and_mtime(tmp_path, size):
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    src.write_bytes(os.urandom(size))
+    set_mtime_per_base(str(src), 5)
+
+    method = copydif.copy_file(src, dst)
+
+    assert method in ("reflink", "copy_file_range", "sendfile", "buffered")
+    assert dst.read_bytes() == src.read_bytes()
+    assert dst.stat().st_mtime == src.stat().st_mtime
+
+
+def test_copy_falls_back_to_buffered(tmp_path, monkeypatch):
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    src.write_bytes(b"x" * 100_000)
+
+    monkeypatch.setattr(copydif, "fcntl", None)
+    monkeypatch.delattr(copydif.os, "copy_file_range", raising=False)
+    monkeypatch.delattr(copydif.os, "sendfile", raising=False)
+
+    assert copydif.copy_file(src, dst) == "buffered"
+    assert dst.read_bytes() == src.read_bytes()
+
+
+def test_copy_falls_through_when_nothing_copied(tmp_path, monkeypatch):
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    src.write_bytes(os.urandom(100_000))
+
+    #  Some file systems report end of file at once.
+    monkeypatch.setattr(copydif, "fcntl", None)
+    monkeypatch.setattr(copydif.os, "copy_file_range", lambda *a: 0, raising=False)
+    monkeypatch.setattr(copydif.os, "sendfile", lambda *a: 0, raising=False)
+
+    assert copydif.copy_file(src, dst) == "buffered"
+    assert dst.read_bytes() == src.read_bytes()
+
+
+def test_state_file_reuses_target_index(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+    state_file = source_path.parent / "state.db"
+
+    for file in list(source_path.glob("*")):
+        shutil.copy2(file, target_path.joinpath(file.name))
+
+    #  The state is only recorded for a directory that has not been
+    #  modified in the last few seconds.
+    set_mtime_per_base(str(target_path), 0)
+
+    args = [str(source_path), str(target_path), f"--state={state_file}"]
+    assert copydif.main(args) == 0
+    assert state_file.exists()
+
+    #  Change a target file without changing the directory's mtime. The
+    #  recorded index is used, so the change is not seen.
+    set_mtime_per_base(str(target_path / "file1.txt"), 5)
+    set_mtime_per_base(str(target_path), 0)
+
+    capsys.readouterr()
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+    assert captured.out.count("Same:") == 3
+
+    #  Without the state file the target directory is read again.
+    args = [str(source_path), str(target_path)]
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+    assert captured.out.count("COPY:") == 1
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_compare_hash(source_3files_and_target, capsys, jobs):
+    source_path, target_path = source_3files_and_target
+
+    src_files = sorted(source_path.glob("*"))
+
+    for file in src_files:
+        shutil.copy2(file, target_path.joinpath(file.name))
+
+    #  Same size and time, different contents.
+    src_files[0].write_text("fileX")
+    set_mtime_per_base(str(src_files[0]), 0)
+
+    #  Same contents, different time.
+    set_mtime_per_base(str(src_files[1]), 10)
+
+    args = [str(source_path), str(target_path), "--compare=hash", "-j", jobs]
+    result = copydif.main(args)
+
+    captured = capsys.readouterr()
+
+    assert result == 0
+    assert "COPY: file1.txt" in captured.out
+    assert "Same: file2.csv" in captured.out
+    assert "Same: file3.dat" in captured.out
+    assert (target_path / "file1.txt").read_text() == "fileX"
+
+
+def test_hash_cache_in_state_file(tmp_path, monkeypatch):
+    f = tmp_path / "file.txt"
+    f.write_text("contents")
+    state = copydif.SyncState(str(tmp_path / "state.db"))
+    hasher = copydif.Hasher(1, state)
+    info = copydif.FileInfo(8, f.stat().st_mtime_ns, f.stat().st_ino)
+    digest = hasher.digests([(f, info)])[0]
+    assert digest is not None
+    state.close()
+
+    def no_hashing(file_name):
+        raise AssertionError("File should not be hashed again.")
+
+    monkeypatch.setattr(copydif, "file_digest", no_hashing)
+
+    state = copydif.SyncState(str(tmp_path / "state.db"))
+    hasher = copydif.Hasher(1, state)
+    assert hasher.digests([(f, info)]) == [digest]
+    state.close()
+
+
+@pytest.mark.parametrize("target_size", [8, 40, 64])
+def test_delta_copy_writes_changed_blocks(tmp_path, monkeypatch, target_size):
+    monkeypatch.setattr(copydif, "DELTA_BLOCK_SIZE", 8)
+
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    data = bytes(range(40))
+    src.write_bytes(data)
+    set_mtime_per_base(str(src), 5)
+
+    #  Target differs in the second block only (when it is long enough).
+    old = bytearray((data * 2)[:target_size])
+    if target_size > 8:
+        old[9] = 255
+    dst.write_bytes(bytes(old))
+
+    result = copydif.delta_copy(src, dst)
+
+    assert dst.read_bytes() == data
+    assert dst.stat().st_mtime == src.stat().st_mtime
+    if target_size == 40:
+        assert result == "delta, 1 of 5 blocks"
+
+
+def test_delta_min_size_option(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+
+    shutil.copy2(source_path / "file1.txt", target_path / "file1.txt")
+    (source_path / "file1.txt").write_text("file1 changed")
+
+    args = [str(source_path), str(target_path), "--delta-min-size=1K"]
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+    assert "(delta" not in captured.out
+
+    (source_path / "file1.txt").write_text("file1 changed again")
+
+    args = [str(source_path), str(target_path), "--delta-min-size=4"]
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+    assert "COPY: file1.txt (delta, 1 of 1 blocks)" in captured.out
+    assert (target_path / "file1.txt").read_text() == "file1 changed again"
+
+
+@pytest.mark.parametrize("log_thread", [False, True])
+def test_log_file_format(source_3files_and_target, log_thread):
+    source_path, target_path = source_3files_and_target
+
+    log_path = source_path.parent / "copydif.log"
+    log_path.write_text("[2023-01-16 13:33:00] Existing line.\n")
+
+    args = [str(source_path), str(target_path), f"--log-file={log_path}"]
+    if log_thread:
+        args.append("--log-thread")
+    assert copydif.main(args) == 0
+
+    lines = log_path.read_text().splitlines()
+    assert lines[0] == "[2023-01-16 13:33:00] Existing line."
+    assert lines[1].endswith(f"] {copydif.app_title}")
+    assert lines[-1].endswith("] Summary: 3 files checked, 3 copied (15 bytes)")
+    assert all(re.match(r"\[\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\] \S", s) for s in lines)
+    assert copydif.log_writer is None
+
+
+def test_plan_and_apply(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+    plan_file = source_path.parent / "plan.jsonl"
+
+    shutil.copy2(source_path / "file2.csv", target_path / "file2.csv")
+
+    args = [str(source_path), str(target_path), f"--plan={plan_file}"]
+    assert copydif.main(args) == 0
+
+    #  Planning does not copy anything.
+    assert len(list(target_path.glob("*"))) == 1
+
+    records = [json.loads(s) for s in plan_file.read_text().splitlines()]
+    assert [(r["name"], r["action"], r["reason"]) for r in records] == [
+        ("file1.txt", "copy", "missing"),
+        ("file2.csv", "same", "same"),
+        ("file3.dat", "copy", "missing"),
+    ]
+
+    #  A file changed after planning is skipped when the plan is applied.
+    (source_path / "file3.dat").write_text("changed")
+
+    capsys.readouterr()
+    args = [f"--apply={plan_file}"]
+    assert copydif.main(args) == 1
+    captured = capsys.readouterr()
+
+    assert "COPY: file1.txt" in captured.out
+    assert "SKIP: file3.dat" in captured.err
+    assert (target_path / "file1.txt").exists()
+    assert not (target_path / "file3.dat").exists()
+
+
+def test_apply_makes_each_target_dir_once(source_3files_and_target, monkeypatch):
+    source_path, target_path = source_3files_and_target
+    plan_file = source_path.parent / "plan.jsonl"
+    args = [str(source_path), str(target_path), f"--plan={plan_file}"]
+    assert copydif.main(args) == 0
+
+    made = []
+    original = copydif.DifCopier.make_dir
+
+    def counting_make_dir(self, target_dir):
+        made.append(target_dir)
+        original(self, target_dir)
+
+    monkeypatch.setattr(copydif.DifCopier, "make_dir", counting_make_dir)
+
+    assert copydif.main([f"--apply={plan_file}"]) == 0
+    assert made == [target_path]
+    assert len(list(target_path.glob("*"))) == 3
+
+
+def test_delete_extra_target_files(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+
+    for file in list(source_path.glob("*")):
+        shutil.copy2(file, target_path.joinpath(file.name))
+    (target_path / "extra.txt").write_text("extra")
+    (target_path / "extra.csv").write_text("extra")
+
+    #  Only target files matching the wildcard pattern are deleted.
+    args = [str(source_path / "*.txt"), str(target_path), "--delete"]
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+
+    assert "DELETE: extra.txt" in captured.out
+    assert not (target_path / "extra.txt").exists()
+    assert (target_path / "extra.csv").exists()
+
+    args = [str(source_path), str(target_path), "--delete"]
+    assert copydif.main(args) == 0
+    assert not (target_path / "extra.csv").exists()
+    assert len(list(target_path.glob("*"))) == 3
+
+
+def test_delete_limits(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+
+    for file in list(source_path.glob("*")):
+        shutil.copy2(file, target_path.joinpath(file.name))
+    for name in ["x1", "x2", "x3", "x4"]:
+        (target_path / name).write_text(name)
+
+    #  4 of 7 files is more than the default limit of 50 percent.
+    args = [str(source_path), str(target_path), "--delete"]
+    assert copydif.main(args) == 1
+    captured = capsys.readouterr()
+    assert "NOT DELETING 4 files" in captured.err
+    assert len(list(target_path.glob("*"))) == 7
+
+    args = [
+        str(source_path),
+        str(target_path),
+        "--delete",
+        "--max-delete-percent=100",
+        "--max-delete=3",
+    ]
+    assert copydif.main(args) == 1
+    captured = capsys.readouterr()
+    assert "--max-delete limit (3)" in captured.err
+    assert len(list(target_path.glob("*"))) == 7
+
+    args = [str(source_path), str(target_path), "--delete", "--max-delete-percent=60"]
+    assert copydif.main(args) == 0
+    assert len(list(target_path.glob("*"))) == 3
+
+
+def test_delete_limit_ignores_new_copies(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+
+    for name in ["x1", "x2", "x3", "x4"]:
+        (target_path / name).write_text(name)
+    (source_path / "file4.txt").write_text("file4")
+
+    #  All 4 existing target files would be deleted. The 4 new copies do
+    #  not count toward the percentage.
+    args = [str(source_path), str(target_path), "--delete"]
+    assert copydif.main(args) == 1
+    captured = capsys.readouterr()
+    assert "NOT DELETING 4 files" in captured.err
+    assert "100%" in captured.err
+    assert all((target_path / name).exists() for name in ["x1", "x2", "x3", "x4"])
+
+
+@pytest.mark.parametrize("pipeline", [[], ["--pipeline=4"]])
+def test_delete_from_empty_source_dir(source_3files_and_target, pipeline):
+    source_path, target_path = source_3files_and_target
+    (source_path / "sub").mkdir()
+    (target_path / "sub").mkdir()
+    (target_path / "sub" / "x").write_text("x")
+
+    args = [str(source_path), str(target_path), "-r", "--delete", *pipeline]
+    assert copydif.main([*args, "--max-delete-percent=100"]) == 0
+    assert not (target_path / "sub" / "x").exists()
+    assert (target_path / "file1.txt").exists()
+
+
+def test_delete_not_allowed_with_list_file(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+    list_file: Path = source_path.parent / "listfile.txt"
+    list_file.write_text(f"{source_path / 'file1.txt'}\n")
+
+    args = [f"@{list_file}", str(target_path), "--delete"]
+    with pytest.raises(SystemExit):
+        copydif.main(args)
+    captured = capsys.readouterr()
+    assert "--delete cannot be used with a list-file" in captured.err
+
+
+def test_multiple_targets(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+    target2 = source_path.parent / "target2"
+    target2.mkdir()
+    target3 = source_path.parent / "target3"
+    target3.mkdir()
+
+    shutil.copy2(source_path / "file1.txt", target2 / "file1.txt")
+
+    args = [str(source_path), str(target_path), str(target2), str(target3)]
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+
+    for t in [target_path, target2, target3]:
+        assert sorted(p.name for p in t.glob("*")) == [
+            "file1.txt",
+            "file2.csv",
+            "file3.dat",
+        ]
+        assert (t / "file3.dat").stat().st_mtime == base_dt.timestamp()
+
+    assert f"Same: file1.txt -> {target2}" in captured.out
+    assert f"COPY: file1.txt -> {target3} (fan-out to 2)" in captured.out
+    assert "Summary: 3 files checked, 8 copied" in captured.out
+    assert f"{target2}: 2 copied (10 bytes)" in captured.out
+
+
+def test_fan_out_copy_continues_past_failed_target(tmp_path):
+    src = tmp_path / "src.bin"
+    src.write_bytes(b"data" * 1000)
+    good = tmp_path / "good.bin"
+    bad = tmp_path / "no_such_dir" / "bad.bin"
+
+    results = copydif.fan_out_copy(src, [bad, good])
+
+    assert isinstance(results[0], OSError)
+    assert results[1] == "fan-out to 2"
+    assert good.read_bytes() == src.read_bytes()
+
+
+def test_list_file_duplicates_and_grouping(
+    source_3files_and_target, capsys, monkeypatch
+):
+    source_path, target_path = source_3files_and_target
+
+    scanned = []
+    real_scan = copydif.scan_dir_index
+
+    def counting_scan(dir_path, *args):
+        scanned.append(Path(dir_path))
+        return real_scan(dir_path, *args)
+
+    monkeypatch.setattr(copydif, "scan_dir_index", counting_scan)
+
+    lines = (
+        f"# A comment.\n"
+        f"{source_path / 'file1.txt'}\n"
+        f"{source_path / '*.dat'}\n"
+        f"{source_path / 'file1.txt'}\n"
+        f"\n"
+        f"{source_path / '*.dat'}\n"
+    )
+    list_file: Path = source_path.parent / "listfile.txt"
+    list_file.write_text(lines)
+
+    args = [f"@{list_file}", str(target_path)]
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+
+    assert captured.out.count("COPY:") == 2
+    assert sorted(p.name for p in target_path.glob("*")) == ["file1.txt", "file3.dat"]
+    assert scanned.count(source_path) == 1
+    assert scanned.count(target_path) == 1
+
+
+def test_list_file_nul_delimited_from_stdin(
+    source_3files_and_target, capsys, monkeypatch
+):
+    source_path, target_path = source_3files_and_target
+
+    #  A file name with a space, and a trailing newline as from 'find -print0'.
+    (source_path / "file 4.txt").write_text("file4")
+    names = ["file2.csv", "file 4.txt"]
+    text = "\0".join(str(source_path / name) for name in names) + "\0\n"
+
+    monkeypatch.setattr(copydif.sys, "stdin", io.StringIO(text))
+
+    args = ["@-", str(target_path)]
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+
+    assert captured.out.count("COPY:") == 2
+    assert sorted(p.name for p in target_path.glob("*")) == ["file 4.txt", "file2.csv"]
+
+
+def test_list_file_directory_entry(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+
+    list_file: Path = source_path.parent / "listfile.txt"
+    list_file.write_text(f"{source_path}\n{source_path / 'ImNotHere.txt'}\n")
+
+    args = [f"@{list_file}", str(target_path)]
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+
+    assert "No files found matching" in captured.out
+    assert len(list(target_path.glob("*"))) == 3
+
+
+def test_resumable_copy_resumes_from_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(copydif, "RESUME_CHECKPOINT", 1000)
+
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    data = os.urandom(5000)
+    src.write_bytes(data)
+    set_mtime_per_base(str(src), 5)
+    st = src.stat()
+    info = copydif.FileInfo(st.st_size, st.st_mtime_ns)
+
+    #  Leave a partial file and checkpoint as from an interrupted copy.
+    part, ckpt = copydif.part_paths(dst)
+    part.write_bytes(data[:3000] + b"junk after the checkpoint")
+    copydif.save_checkpoint(ckpt, info, 3000)
+
+    assert copydif.resumable_copy(src, dst, info) in ("resumed at 3,000", "reflink")
+    assert dst.read_bytes() == data
+    assert dst.stat().st_mtime == src.stat().st_mtime
+    assert not part.exists()
+    assert not ckpt.exists()
+
+
+def test_resumable_copy_falls_back_across_file_systems(tmp_path, monkeypatch):
+    monkeypatch.setattr(copydif, "RESUME_CHECKPOINT", 1000)
+    monkeypatch.setattr(copydif, "fcntl", None)
+
+    def cross_device(*args):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(copydif.os, "copy_file_range", cross_device, raising=False)
+
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    data = os.urandom(5000)
+    src.write_bytes(data)
+    st = src.stat()
+    info = copydif.FileInfo(st.st_size, st.st_mtime_ns)
+
+    part, ckpt = copydif.part_paths(dst)
+    part.write_bytes(data[:3000])
+    copydif.save_checkpoint(ckpt, info, 3000)
+
+    #  Resuming falls back to read and write at a non-zero offset.
+    assert copydif.resumable_copy(src, dst, info) == "resumed at 3,000"
+    assert dst.read_bytes() == data
+    assert not part.exists()
+
+
+def test_resumable_copy_restarts_if_partial_file_differs(tmp_path):
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    data = os.urandom(5000)
+    src.write_bytes(data)
+    st = src.stat()
+    info = copydif.FileInfo(st.st_size, st.st_mtime_ns)
+
+    part, ckpt = copydif.part_paths(dst)
+    part.write_bytes(b"x" * 3000)
+    copydif.save_checkpoint(ckpt, info, 3000)
+
+    assert copydif.resume_offset(src, part, ckpt, info) == 0
+    assert not copydif.resumable_copy(src, dst, info).startswith("resumed")
+    assert dst.read_bytes() == data
+
+
+def test_resume_min_size_option(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+
+    args = [str(source_path), str(target_path), "--resume-min-size=1"]
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+
+    assert captured.out.count("COPY:") == 3
+    assert "(resumable)" in captured.out or "(reflink)" in captured.out
+    assert sorted(p.name for p in target_path.iterdir()) == [
+        "file1.txt",
+        "file2.csv",
+        "file3.dat",
+    ]
+
+
+def test_resume_off_for_several_targets(source_3files_and_target, tmp_path, capsys):
+    source_path, target_path = source_3files_and_target
+    target2 = tmp_path / "target2"
+    target2.mkdir()
+
+    args = [str(source_path), str(target_path), str(target2), "--resume-min-size=1"]
+    assert copydif.main(args) == 0
+    out = capsys.readouterr().out
+
+    #  The source is read once for both targets, not resumed for each.
+    assert out.count("(fan-out to 2)") == 6
+    assert "(resumable)" not in out
+
+
+def test_stale_part_files_are_removed(source_3files_and_target):
+    source_path, target_path = source_3files_and_target
+    info = copydif.FileInfo(999, 1)
+
+    #  A checkpoint for an older version of file1.txt.
+    part1, ckpt1 = copydif.part_paths(target_path / "file1.txt")
+    part1.write_text("old")
+    copydif.save_checkpoint(ckpt1, info, 3)
+    #  A partial copy of a source file that was deleted.
+    part2, ckpt2 = copydif.part_paths(target_path / "gone.bin")
+    part2.write_text("gone")
+    copydif.save_checkpoint(ckpt2, info, 4)
+    #  A partial copy of a file that is not matched by the pattern.
+    (source_path / "other.bin").write_text("other")
+    part3, _ = copydif.part_paths(target_path / "other.bin")
+    part3.write_text("other")
+
+    args = [str(source_path / "*.txt"), str(target_path), "--resume-min-size=off"]
+    assert copydif.main(args) == 0
+    assert not any(p.exists() for p in (part1, ckpt1, part2, ckpt2))
+    assert part3.exists()
+    assert (target_path / "file1.txt").read_text() == "file1"
+
+
+def test_order_small_first(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+
+    (source_path / "file1.txt").write_text("file1 is the largest file")
+    (source_path / "file2.csv").write_text("file2 is larger")
+
+    args = [str(source_path), str(target_path), "--order=small"]
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+
+    lines = [s.split()[1] for s in captured.out.splitlines() if "COPY:" in s]
+    assert lines == ["file3.dat", "file2.csv", "file1.txt"]
+
+
+def test_token_bucket_waits_when_overdrawn(monkeypatch):
+    waits = []
+    monkeypatch.setattr(copydif.time, "sleep", waits.append)
+
+    bucket = copydif.TokenBucket(1000)
+    bucket.consume(1000)
+    assert waits == []
+
+    bucket.consume(500)
+    assert len(waits) == 1
+    assert 0.4 < waits[0] <= 0.5
+
+
+def test_bwlimit_and_large_jobs_options(source_3files_and_target, monkeypatch):
+    source_path, target_path = source_3files_and_target
+    monkeypatch.setattr(copydif, "LARGE_FILE_SIZE", 5)
+
+    args = [
+        str(source_path),
+        str(target_path),
+        "--bwlimit=10M",
+        "--jobs=2",
+        "--large-jobs=1",
+        "--resume-min-size=off",
+    ]
+    assert copydif.main(args) == 0
+    assert len(list(target_path.glob("*"))) == 3
+    assert copydif.rate_limiter is None
+
+
+def test_large_copy_does_not_hold_up_small_ones(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(copydif, "LARGE_FILE_SIZE", 100)
+    src = tmp_path / "src"
+    tgt = tmp_path / "tgt"
+    src.mkdir()
+    tgt.mkdir()
+    large = src / "large.bin"
+    large.write_bytes(b"x" * 100)
+    small = [src / f"small{n:02d}.txt" for n in range(30)]
+    for f in small:
+        f.write_text(f.name)
+
+    release = threading.Event()
+    released = []
+    run_copy = copydif.DifCopier.run_copy
+
+    def slow_run_copy(source_file, info, jobs, *args):
+        if source_file == large:
+            released.append(release.wait(5))
+        return run_copy(source_file, info, jobs, *args)
+
+    monkeypatch.setattr(copydif.DifCopier, "run_copy", staticmethod(slow_run_copy))
+
+    copier = copydif.DifCopier(
+        copydif.AppOptions(jobs=2, large_jobs=1, resume_min_size=None)
+    )
+    for f in [large, *small]:
+        st = f.stat()
+        info = copydif.FileInfo(st.st_size, st.st_mtime_ns)
+        copier.copy(f, [(0, tgt / f.name, None)], f.name, info)
+
+    #  All of the small files are copied while the large copy is waiting.
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and not all(
+        (tgt / f.name).exists() for f in small
+    ):
+        time.sleep(0.01)
+    assert all((tgt / f.name).exists() for f in small)
+    assert not (tgt / "large.bin").exists()
+
+    release.set()
+    copier.close()
+    assert released == [True]
+    assert copier.files_copied == 31
+    #  Results are still reported in the order the files were queued.
+    lines = [s for s in capsys.readouterr().out.splitlines() if "COPY:" in s]
+    assert "large.bin" in lines[0]
+
+
+def test_sync_changes_compares_only_changed_files(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+    copydif.copy_differing_files(str(source_path), str(target_path))
+
+    (source_path / "file1.txt").write_text("file1 changed")
+    (source_path / "file2.csv").unlink()
+    (source_path / "file4.txt").write_text("file4")
+    #  A difference in a file that is not reported as changed is not seen.
+    (target_path / "file3.dat").write_text("different")
+    capsys.readouterr()
+
+    copier = copydif.DifCopier(copydif.AppOptions())
+    changes = {Path(): {"file1.txt", "file2.csv", "file4.txt"}}
+    copydif.sync_changes(copier, source_path, None, [target_path], changes, delete=True)
+    copier.close()
+    captured = capsys.readouterr()
+
+    assert (target_path / "file1.txt").read_text() == "file1 changed"
+    assert (target_path / "file4.txt").read_text() == "file4"
+    assert "DELETE: file2.csv" in captured.out
+    assert not (target_path / "file2.csv").exists()
+    assert (target_path / "file3.dat").read_text() == "different"
+    assert copier.files_checked == 2
+
+
+def test_poll_watcher_reports_changes(source_3files_and_target):
+    source_path, _ = source_3files_and_target
+    (source_path / "sub").mkdir()
+    watcher = copydif.PollWatcher(source_path, None, True, 0.01)
+
+    (source_path / "file1.txt").write_text("file1 changed")
+    (source_path / "file2.csv").unlink()
+    (source_path / "sub" / "new.txt").write_text("new")
+
+    assert watcher.changes(0) == {
+        Path(): {"file1.txt", "file2.csv"},
+        Path("sub"): {"new.txt"},
+    }
+
+
+def test_sync_changes_checks_max_delete_percent(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+    copydif.copy_differing_files(str(source_path), str(target_path))
+    (source_path / "file1.txt").unlink()
+    (source_path / "file2.csv").unlink()
+    capsys.readouterr()
+
+    #  The percentage is of the files in the target, not of the changes.
+    changes = {Path(): {"file1.txt", "file2.csv"}}
+    copier = copydif.DifCopier(copydif.AppOptions())
+    copydif.sync_changes(copier, source_path, None, [target_path], changes, delete=True)
+    copier.close()
+    captured = capsys.readouterr()
+
+    assert "67% of the files is over the --max-delete-percent" in captured.err
+    assert (target_path / "file1.txt").exists()
+    assert (target_path / "file2.csv").exists()
+
+    copier = copydif.DifCopier(copydif.AppOptions(max_delete_percent=70.0))
+    copydif.sync_changes(copier, source_path, None, [target_path], changes, delete=True)
+    copier.close()
+
+    assert not (target_path / "file1.txt").exists()
+    assert not (target_path / "file2.csv").exists()
+
+
+def test_watch_copies_changed_files(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+    try:
+        copydif.InotifyWatcher(source_path, False).close()
+    except OSError:
+        pytest.skip("inotify is not available")
+
+    def change_files():
+        time.sleep(0.2)
+        (source_path / "file1.txt").write_text("file1 changed")
+        (source_path / "file5.txt").write_text("file5")
+
+    thread = threading.Thread(target=change_files)
+    thread.start()
+    opts = copydif.AppOptions(
+        source_spec=str(source_path), target_dirs=[str(target_path)], debounce=0.2
+    )
+    copier = copydif.DifCopier(opts)
+    copydif.watch_source(opts, copier, batches=1)
+    copier.close()
+    thread.join()
+    captured = capsys.readouterr()
+
+    assert "Watching for changes (inotify)" in captured.out
+    assert (target_path / "file1.txt").read_text() == "file1 changed"
+    assert (target_path / "file5.txt").read_text() == "file5"
+    assert copier.files_checked == 5
+
+
+def test_watch_flushes_log_before_waiting(source_3files_and_target, monkeypatch):
+    source_path, target_path = source_3files_and_target
+    log_path = source_path.parent / "copydif.log"
+    logged = []
+
+    class Watcher:
+        method = "test"
+
+        def __init__(self, *_):
+            pass
+
+        def changes(self, _):
+            logged.append(log_path.read_text())
+            return {}
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(copydif, "InotifyWatcher", Watcher)
+    monkeypatch.setattr(copydif.LogWriter, "flush_secs", 3600)
+    monkeypatch.setattr(copydif, "log_writer", copydif.LogWriter(str(log_path)))
+    opts = copydif.AppOptions(
+        source_spec=str(source_path), target_dirs=[str(target_path)]
+    )
+    copier = copydif.DifCopier(opts)
+    copydif.watch_source(opts, copier, batches=1)
+    copier.close()
+    copydif.close_log()
+
+    assert "Watching for changes (test)" in logged[0]
+
+
+def test_watch_not_allowed_with_plan(source_3files_and_target, capsys):
+    source_path, target_path = source_3files_and_target
+    args = [str(source_path), str(target_path), "--watch", "--plan=x.jsonl"]
+    with pytest.raises(SystemExit):
+        copydif.main(args)
+    assert "--watch cannot be used" in capsys.readouterr().err
+
+
+def test_stats_report_and_json(source_3files_and_target, tmp_path, capsys):
+    source_path, target_path = source_3files_and_target
+    stats_file = tmp_path / "stats.json"
+
+    args = [
+        str(source_path),
+        str(target_path),
+        "--stats",
+        f"--stats-json={stats_file}",
+        "--stats-top=2",
+        "--jobs=2",
+    ]
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+
+    assert "Statistics:" in captured.out
+    assert "Files scanned: 3 source, 0 target" in captured.out
+    assert "Phase times (s): list parse " in captured.out
+
+    stats = json.loads(stats_file.read_text())
+    assert stats["source_files_scanned"] == 3
+    assert stats["files_copied"] == 3
+    assert stats["bytes_copied"] == 15
+    assert set(stats["phases"]) == set(copydif.RunStats.PHASES)
+    assert len(stats["slowest"]) == 2
+    assert stats["slowest"][0]["seconds"] >= stats["slowest"][1]["seconds"]
+
+
+@pytest.mark.parametrize("archive_name", ["backup.tar", "backup.tar.gz", "backup.zip"])
+def test_archive_target(source_3files_and_target, tmp_path, capsys, archive_name):
+    source_path, _ = source_3files_and_target
+    archive = tmp_path / archive_name
+    args = [str(source_path), str(archive), "--archive", "--jobs=2"]
+
+    assert copydif.main(args) == 0
+    assert "3 copied" in capsys.readouterr().out
+
+    #  Nothing has changed, so no files are added (and no new volume).
+    assert copydif.main(args) == 0
+    assert "0 copied" in capsys.readouterr().out
+    assert copydif.archive_volumes(archive) == [archive]
+
+    (source_path / "file2.csv").write_text("file2 changed")
+    assert copydif.main(args) == 0
+    assert "1 copied" in capsys.readouterr().out
+
+    #  Without the index file, the index is read from the archive, and
+    #  saved again even though no files are added.
+    copydif.archive_index_file(archive).unlink()
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+    assert "Reading archive index" in captured.out
+    assert "0 copied" in captured.out
+    assert copydif.archive_index_file(archive).exists()
+    assert copydif.main(args) == 0
+    assert "Reading archive index" not in capsys.readouterr().out
+
+    if archive_name.endswith(".zip"):
+        with zipfile.ZipFile(archive) as zf:
+            assert zf.read("file2.csv") == b"file2 changed"
+        return
+    volumes = copydif.archive_volumes(archive)
+    assert [v.name for v in volumes][1:] == [archive_name.replace(".", ".0001.", 1)]
+    with tarfile.open(volumes[1]) as tf:
+        assert tf.getnames() == ["file2.csv"]
+        assert tf.extractfile("file2.csv").read() == b"file2 changed"
+
+
+def test_gzip_chunk_writer_output_is_one_stream(tmp_path, monkeypatch):
+    monkeypatch.setattr(copydif, "GZIP_CHUNK_SIZE", 10)
+    file_name = tmp_path / "data.gz"
+    writer = copydif.GzipChunkWriter(file_name, 6, 3)
+    for i in range(20):
+        writer.write(f"line {i}\n".encode())
+    writer.close()
+
+    expected = "".join(f"line {i}\n" for i in range(20)).encode()
+    assert gzip.decompress(file_name.read_bytes()) == expected
+
+
+def test_dedupe_links_identical_files(source_3files_and_target, tmp_path, capsys):
+    source_path, target_path = source_3files_and_target
+    state_file = tmp_path / "state.db"
+    dup1 = source_path / "dup1.bin"
+    dup2 = source_path / "dup2.bin"
+    dup1.write_text("same contents")
+    dup2.write_text("same contents")
+    set_mtime_per_base(str(dup1), 0)
+    set_mtime_per_base(str(dup2), 1)
+    args = [str(source_path), str(target_path), "--dedupe", f"--state={state_file}"]
+
+    assert copydif.main(args) == 0
+    captured = capsys.readouterr()
+    assert "LINK: dup2.bin" in captured.out
+    assert ", 1 hardlinked" in captured.out
+    assert (target_path / "dup1.bin").samefile(target_path / "dup2.bin")
+
+    #  The linked file has the time of dup1.bin, so it is compared by
+    #  contents and found to be the same.
+    os.utime(target_path)
+    assert copydif.main(args) == 0
+    assert "0 copied" in capsys.readouterr().out
+
+    #  A changed file replaces the link, so the other file is not changed.
+    dup2.write_text("new contents!")
+    assert copydif.main(args) == 0
+    assert (target_path / "dup2.bin").read_text() == "new contents!"
+    assert (target_path / "dup1.bin").read_text() == "same contents"
+
+    #  The content index in the state file is used on later runs.
+    dup3 = source_path / "dup3.bin"
+    shutil.copy(dup1, dup3)
+    assert copydif.main(args) == 0
+    assert "LINK: dup3.bin" in capsys.readouterr().out
+    assert (target_path / "dup3.bin").samefile(target_path / "dup1.bin")
+
+
+@pytest.mark.parametrize("delta", [[], ["--delta-min-size=1"]])
+def test_copy_without_dedupe_replaces_links(source_3files_and_target, delta):
+    source_path, target_path = source_3files_and_target
+    (source_path / "a.txt").write_text("same")
+    (source_path / "b.txt").write_text("same")
+    set_mtime_per_base(str(source_path / "a.txt"), 0)
+    set_mtime_per_base(str(source_path / "b.txt"), 1)
+
+    assert copydif.main([str(source_path), str(target_path), "--dedupe"]) == 0
+    assert (target_path / "a.txt").samefile(target_path / "b.txt")
+
+    #  A run without --dedupe does not write through the shared link.
+    (source_path / "b.txt").write_text("changed b")
+    assert copydif.main([str(source_path), str(target_path), *delta]) == 0
+    assert (target_path / "a.txt").read_text() == "same"
+    assert (target_path / "b.txt").read_text() == "changed b"
+    assert not (target_path / "a.txt").samefile(target_path / "b.txt")
+
+
+def test_pipeline_matches_serial_walk(source_3files_and_target, tmp_path, capsys):
+    source_path, target_path = source_3files_and_target
+    for sub in ("b", "a/deeper", "c"):
+        sub_path = source_path / sub
+        sub_path.mkdir(parents=True)
+        (sub_path / "file4.txt").write_text("file4")
+    (target_path / "extra.txt").write_text("extra")
+    serial_target = tmp_path / "serial"
+    shutil.copytree(target_path, serial_target)
+
+    def copy_lines(target):
+        args = [str(source_path), str(target), "-r", "--delete"]
+        args += ["--max-delete-percent=100", "--pipeline=8"]
+        if target == serial_target:
+            args.pop()
+        assert copydif.main(args) == 0
+        out = capsys.readouterr().out
+        return [line for line in out.splitlines() if line.startswith("  ")]
+
+    lines = copy_lines(target_path)
+    assert lines == copy_lines(serial_target)
+    assert "  DELETE: extra.txt" in lines
+    assert (target_path / "a" / "deeper" / "file4.txt").exists()
+
+    #  A second run finds nothing to copy.
+    assert copy_lines(target_path) == [
+        line.replace("COPY", "Same").split(" (")[0]
+        for line in lines
+        if "DELETE" not in line
+    ]
+
+
+def test_pipeline_stat_names_in_slices(tmp_path, monkeypatch):
+    names = [f"file{i}.txt" for i in range(50)]
+    for name in names[::2]:
+        (tmp_path / name).write_text(name)
+    pipeline = copydif.MetadataPipeline(copydif.DifCopier(copydif.AppOptions()), 2)
+    calls = []
+
+    async def stat_first_slice():
+        release = asyncio.Event()
+
+        async def call(func, *args):
+            calls.append(args)
+            await release.wait()
+            return func(*args)
+
+        monkeypatch.setattr(pipeline, "call", call)
+        task = asyncio.ensure_future(pipeline.stat_names(tmp_path, names))
+        for _ in range(5):
+            await asyncio.sleep(0)
+        #  Only the first slice of names has been started.
+        assert len(calls) == 8
+        release.set()
+        return await task
+
+    index = asyncio.run(stat_first_slice())
+    assert sorted(index) == sorted(names[::2])
+    assert len(calls) == len(names)